@@ -41,6 +41,14 @@ fi
 
 echo "File '${filename}' exists and has size ${actualsize} bytes!"
 
+# Resources used by each phase of the job (archived with the logs)
+if [[ -f job_metrics.json ]]; then
+	echo "############## job metrics : ##############"
+	cat job_metrics.json
+else
+	echo "File 'job_metrics.json' does not exist!"
+fi
+
 echo "Validation OK!"
 
 exit 0
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Environment sessions of alienv packages (load_packages_separately mode).
+# Resolving the dependencies of a package with alienv is slow on a cold CVMFS cache:
+# the environment of a package is therefore loaded once, with a single alienv call,
+# and all the commands using the package are run directly in this environment.
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+ALIENV = "/cvmfs/alice.cern.ch/bin/alienv"
+LOAD_TIMEOUT = 900
+
+class AlienvError(Exception):
+
+    def __init__(self, packages, msg):
+        self.packages = packages
+        self.msg = msg
+
+    def __str__(self):
+        return "Could not load the alienv package(s) {}: {}".format(self.packages, self.msg)
+
+class CommandResult:
+
+    def __init__(self, cmd, rc, out, err, timed_out=False):
+        self.cmd = cmd
+        self.rc = rc
+        self.out = out
+        self.err = err
+        self.timed_out = timed_out
+
+    def Write(self, myfile):
+        """Writes the command, its return code and its output to a log file."""
+        if self.timed_out:
+            myfile.write("Command '{}' timed out\n".format(self.cmd))
+        else:
+            myfile.write("Command '{}' exited with return code '{}'\n".format(self.cmd, self.rc))
+        myfile.write(self.out)
+        myfile.write("\n")
+        myfile.write(self.err)
+        myfile.write("\n")
+        myfile.flush()
+
+class AlienvSession:
+    """Environment of one or more alienv packages. The environment is loaded on first
+    use; commands are then run in it (in a new shell if given as a string) without
+    calling alienv again."""
+
+    def __init__(self, packages, alienv=ALIENV):
+        if isinstance(packages, str):
+            packages = [packages]
+        self.packages = packages
+        self.alienv = alienv
+        self._env = None
+
+    @property
+    def env(self):
+        if self._env is None:
+            self.Load()
+        return self._env
+
+    def Load(self, timeout=LOAD_TIMEOUT):
+        start = time.time()
+        cmd = [self.alienv, "setenv", ",".join(self.packages), "-c", "env", "-0"]
+        print("ALIENV> loading {}".format(",".join(self.packages)))
+        try:
+            out = subprocess.check_output(cmd, timeout=timeout)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise AlienvError(self.packages, e)
+        env = {}
+        for entry in out.split(b"\0"):
+            name, sep, value = entry.decode(errors="replace").partition("=")
+            if sep:
+                env[name] = value
+        if not "PATH" in env:
+            raise AlienvError(self.packages, "empty environment")
+        self._env = env
+        print("ALIENV> {} loaded in {:.1f} s".format(",".join(self.packages), time.time() - start))
+
+    def Popen(self, cmd, **kwargs):
+        """Starts cmd in the environment of the session, see subprocess.Popen."""
+        return subprocess.Popen(cmd, shell=isinstance(cmd, str), env=self.env, **kwargs)
+
+    def Run(self, cmd, timeout=None, cwd=None):
+        """Runs cmd in the environment of the session and captures its output.
+        If it does not finish within timeout seconds, it is killed (with all the
+        processes it started) and the result is flagged as timed out."""
+        print("ALIENV> executing {}".format(cmd if isinstance(cmd, str) else " ".join(cmd)))
+        proc = self.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        timed_out = False
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            out, err = proc.communicate()
+            timed_out = True
+        encoding = sys.stdout.encoding if sys.stdout.encoding else "utf-8"
+        return CommandResult(cmd, proc.returncode, out.decode(encoding, errors="replace"), err.decode(encoding, errors="replace"), timed_out)
+
+_sessions = {}
+
+def GetSession(packages):
+    """Returns the session of packages, shared by all the callers in the process."""
+    key = packages if isinstance(packages, str) else ",".join(packages)
+    if not key in _sessions:
+        _sessions[key] = AlienvSession(packages)
+    return _sessions[key]
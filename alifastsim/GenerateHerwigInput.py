@@ -3,6 +3,7 @@
 import argparse
 import yaml
 import lhapdf_utils
+import herwig_utils
 
 def GetCMSEnergy(config_params):
     if config_params["beam_type"] != "pp":
@@ -67,19 +68,25 @@ def GenerateHerwigInput(config_params, outputdir, events):
         if "herwig_config" in config_params and "tune" in config_params["herwig_config"]:
             myfile.write("read {}\n".format(config_params["herwig_config"]["tune"]))
 
-        #HEP MC writer
+        #HEP MC writer (file name and number of events are set per job, see herwig_utils.WriteSetupFile)
         myfile.write("read snippets/HepMC.in\n")
         myfile.write("set /Herwig/Analysis/HepMC:Filename events.hepmc\n")
         myfile.write("set /Herwig/Analysis/HepMC:PrintEvent {}\n".format(events))
         myfile.write('saverun herwig /Herwig/Generators/EventGenerator\n')
 
-def main(yamlConfigFile, outputdir, events):
+def main(yamlConfigFile, outputdir, events, herwig_cache=None):
     f = open(yamlConfigFile, 'r')
     configparams = yaml.load(f, Loader=yaml.SafeLoader)
     f.close()
 
     GenerateHerwigInput(configparams, outputdir, events)
 
+    # Optionally build the run file in advance (requires the Herwig environment),
+    # otherwise the first job of the train builds it
+    if herwig_cache:
+        if not herwig_utils.PrepareHerwigRun("herwig.in", outputdir, herwig_cache):
+            exit(1)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate HERWIG input file.')
     parser.add_argument('config', metavar='config.yaml',
@@ -88,6 +95,8 @@ if __name__ == '__main__':
                         default=50000, type=int)
     parser.add_argument('-o', metavar='job',
                         default='./')
+    parser.add_argument('--build-run', metavar='DIR', dest='herwig_cache',
+                        default=None, help='Build the HERWIG run file into the cache directory DIR')
     args = parser.parse_args()
 
-    main(args.config, args.o, args.numevents)
+    main(args.config, args.o, args.numevents, args.herwig_cache)
@@ -5,6 +5,18 @@ import argparse
 import math
 import yaml
 
+def GetNumberOfSeeds(jobs, seeds_per_job=1):
+    """Number of seed indices needed by a train: with more than one seed per job,
+    job N uses the indices N + k * (jobs + 1), k = 0 ... seeds_per_job - 1."""
+    if seeds_per_job > 1:
+        return (jobs + 1) * seeds_per_job
+    return jobs
+
+def GetSeedsPerJob(config):
+    if "powheg_config" in config and "seeds_per_job" in config["powheg_config"]:
+        return config["powheg_config"]["seeds_per_job"]
+    return 1
+
 def GetParallelInputFileName(powheg_stage, x_grid_iter=1):
     if powheg_stage == 1:
         fname = "powheg_Stage_{}_XGrid_{}.input".format(powheg_stage, x_grid_iter)
@@ -12,14 +24,17 @@ def GetParallelInputFileName(powheg_stage, x_grid_iter=1):
         fname = "powheg_Stage_{}.input".format(powheg_stage)
     return fname
 
-def GenerateParallelPowhegInput(outputdir, powheg_stage, x_grid_iter, events, jobs, powheg_proc, bornonly, qmass, facscfact, renscfact, lhans, beamType, ebeam1, ebeam2, bornktmin, bornsuppfact, storemintupb, powheg_buffer, nPDFset, nPDFerrSet):
+def GenerateParallelPowhegInput(outputdir, powheg_stage, x_grid_iter, events, jobs, seeds_per_job, powheg_proc, bornonly, qmass, facscfact, renscfact, lhans, beamType, ebeam1, ebeam2, bornktmin, bornsuppfact, storemintupb, powheg_buffer, nPDFset, nPDFerrSet):
     fname = "{}/{}".format(outputdir, GetParallelInputFileName(powheg_stage, x_grid_iter))
     shutil.copy("{}-powheg.input".format(powheg_proc), fname)
 
     with open(fname, "a") as myfile:
         myfile.write("numevts {0}\n".format(int(math.ceil(events * (1.0 + powheg_buffer)))))
         myfile.write("manyseeds 1\n")
-        myfile.write("maxseeds {}\n".format(jobs))
+        if powheg_stage == 4:
+            myfile.write("maxseeds {}\n".format(GetNumberOfSeeds(jobs, seeds_per_job)))
+        else:
+            myfile.write("maxseeds {}\n".format(jobs))
         myfile.write("parallelstage {}\n".format(powheg_stage))
         if powheg_proc == "beauty":
             myfile.write("qmass {0}\n".format(qmass))
@@ -104,7 +119,7 @@ def GenerateSinglePowhegInput(outputdir, events, powheg_proc, bornonly, qmass, f
             myfile.write("AA2 1              ! (Atomic number of hadron 2)\n")
 
 
-def main(yamlConfigFile, outputdir, events, powheg_stage, x_grid_iter=1):
+def main(yamlConfigFile, outputdir, events, powheg_stage, x_grid_iter=1, powheg_buffer=None):
     f = open(yamlConfigFile, 'r')
     config = yaml.load(f, Loader=yaml.SafeLoader)
     f.close()
@@ -113,6 +128,7 @@ def main(yamlConfigFile, outputdir, events, powheg_stage, x_grid_iter=1):
     lhans = config["lhans"]
     beamType = config["beam_type"]
     jobs = config["numbjobs"]
+    seeds_per_job = GetSeedsPerJob(config)
     ebeam1 = config["ebeam1"]
     ebeam2 = config["ebeam2"]
     if beamType != "pp":
@@ -169,15 +185,17 @@ def main(yamlConfigFile, outputdir, events, powheg_stage, x_grid_iter=1):
     else:
         bornsuppfact = 0
 
-    if "powheg_buffer" in config:
-        powheg_buffer = config["powheg_buffer"]
-    else:
-        powheg_buffer = 0.1
+    # A buffer given by the caller (e.g. derived from the history of previous trains) takes precedence
+    if powheg_buffer is None:
+        if "powheg_buffer" in config:
+            powheg_buffer = config["powheg_buffer"]
+        else:
+            powheg_buffer = 0.1
 
     shutil.copy("{}-powheg.input".format(powheg_proc), "{}/powheg.input".format(outputdir))
 
     if powheg_stage > 0 and powheg_stage <= 4:
-        GenerateParallelPowhegInput(outputdir, powheg_stage, x_grid_iter, events, jobs, powheg_proc, bornonly, qmass, facscfact, renscfact, lhans, beamType, ebeam1, ebeam2, bornktmin, bornsuppfact, storemintupb, powheg_buffer, nPDFset, nPDFerrSet)
+        GenerateParallelPowhegInput(outputdir, powheg_stage, x_grid_iter, events, jobs, seeds_per_job, powheg_proc, bornonly, qmass, facscfact, renscfact, lhans, beamType, ebeam1, ebeam2, bornktmin, bornsuppfact, storemintupb, powheg_buffer, nPDFset, nPDFerrSet)
     else:
         GenerateSinglePowhegInput(outputdir, events, powheg_proc, bornonly, qmass, facscfact, renscfact, lhans, beamType, ebeam1, ebeam2, bornktmin, bornsuppfact, storemintupb, powheg_buffer, nPDFset, nPDFerrSet)
 
@@ -1,7 +1,9 @@
 #! /usr/bin/env python
 import logging
-import shutil
+import os
 import subprocess
+import yaml
+from alifastsim import staging
 
 def test_slurm():
     try:
@@ -12,6 +14,47 @@ def test_slurm():
     logging.debug("Slurm found in '{}'".format(sbatchpath))
     return True
 
+def use_job_array(batchconfig, njobs):
+    """Several jobs are submitted as a single job array, unless job_array is false in the batch configuration."""
+    if njobs < 2:
+        return False
+    if batchconfig and os.path.isfile(batchconfig):
+        with open(batchconfig, "r") as breader:
+            bcdata = yaml.load(breader, yaml.SafeLoader)
+        if bcdata and "job_array" in bcdata:
+            return bcdata["job_array"]
+    return True
+
+def get_jobid(output):
+    """Batch job ID from the output of sbatch ("Submitted batch job ID") or qsub ("ID.server")."""
+    tokens = output.split()
+    return tokens[-1] if tokens else None
+
+def write_array_jobid(scriptwriter):
+    # Index of the task in the job array (Slurm or Torque): the job number
+    scriptwriter.write("JOBID=${SLURM_ARRAY_TASK_ID:-$PBS_ARRAYID}\n")
+    scriptwriter.write("JOBTAG=$(printf %04d $JOBID)\n")
+
+def write_clean_command(jobscriptwriter, envscript, jobid):
+    """End of the job scripts of all batch tools: removes the input files of the job and exits with its exit code."""
+    # jobid is the job number, or a shell variable holding the zero-padded job number
+    jobtag = jobid if isinstance(jobid, str) else "%04d" %jobid
+    FilesToDelete = []
+    if "herwig" in envscript:
+        for suffix in ["", ".gz", ".zst"]:
+            FilesToDelete.append("events_%s.hepmc%s" %(jobtag, suffix))
+            FilesToDelete.append("events_%s.hepmc%s.idx" %(jobtag, suffix))
+        FilesToDelete.append("herwig_setup_%s.in" %jobtag)
+    elif "powheg" in envscript:
+        for suffix in ["", ".gz", ".zst"]:
+            FilesToDelete.append("pwgevents-%s.lhe%s" %(jobtag, suffix))
+            FilesToDelete.append("pwgevents-%s.lhe%s.idx" %(jobtag, suffix))
+    for f in FilesToDelete:
+        jobscriptwriter.write("rm -vf %s\n" %f)
+    # Read by the job ledger (job_ledger.py)
+    jobscriptwriter.write("echo \"Job exit code: $JOBSTATUS\"\n")
+    jobscriptwriter.write("exit $JOBSTATUS\n")
+
 def subprocess_call(cmd):
     logging.debug(cmd)
     return subprocess.call(cmd)
@@ -29,7 +72,9 @@ def subprocess_cmd(command):
     proc_stdout = process.communicate(command)[0].strip()
     logging.info(proc_stdout)
 
-def copy_to_workdir(Files):
+def copy_to_workdir(Files, mode="link"):
+    # Hard links (or symlinks) instead of copies where possible, see alifastsim/staging.py
     for inputfile, outputfile in Files.items():
-        logging.info("Copying %s to %s", inputfile, outputfile)
-        shutil.copy(inputfile, outputfile)
+        logging.info("Staging %s to %s", inputfile, outputfile)
+    report = staging.StageFiles(Files, mode)
+    logging.info("Staging: %s", report)
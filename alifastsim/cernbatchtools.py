@@ -15,17 +15,30 @@ class cernbatchtools:
         def __str__(self):
             return "Environment is not configured correctly!"
 
-    def configbatch_slurm(self, scriptwriter, batchconfig, outputfile):
+    def __init__(self):
+        self.__slurm = None
+
+    def configbatch_slurm(self, scriptwriter, batchconfig, outputfile, jobarray=None):
         scriptwriter.write("#SBATCH --output=%s\n" %outputfile)
         scriptwriter.write("#SBATCH -N 1\n")
         scriptwriter.write("#SBATCH -n 1\n")
         scriptwriter.write("#SBATCH -c 1\n")
+        if jobarray:
+            scriptwriter.write("#SBATCH --array=%d-%d\n" %jobarray)
 
-    def configbatch_pbs(self, scriptwriter, batchconfig, outputfile):
+    def configbatch_pbs(self, scriptwriter, batchconfig, outputfile, jobarray=None):
         scriptwriter.write("#PBS -o %s\n" %outputfile)
         scriptwriter.write("#PBS -j oe\n")
+        if jobarray:
+            # Torque syntax (PBS Pro uses -J and is not supported)
+            scriptwriter.write("#PBS -t %d-%d\n" %jobarray)
 
-    def submitJobs(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset):
+    def submitJobs(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset, dependency=None, serial=False):
+        """Submits the jobs, which only start once the jobs in dependency (batch job IDs) succeeded.
+        serial jobs are submitted one by one, never as a job array. Returns the batch job IDs."""
+        if not serial and alisimtools.use_job_array(batchconfig, njobs):
+            return [self.submitJobArray(repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset, dependency)]
+        jobids = []
         for ijob in range(joboffset, njobs + joboffset):
             taskjobscriptname = jobscriptbase
             taskjobscriptname = os.path.join(workdir, taskjobscriptname.replace("RANK", "%04d" %ijob))
@@ -42,30 +55,70 @@ class cernbatchtools:
                 self.writeCleanCommand(jobscriptwriter, envscript, ijob)
                 jobscriptwriter.close()
                 os.chmod(taskjobscriptname, 0o755)
-                output = alisimtools.subprocess_checkoutput([self.get_batchsub(), taskjobscriptname])
+                output = alisimtools.subprocess_checkoutput([self.get_batchsub()] + self.get_dependency_args(dependency) + [taskjobscriptname])
                 logging.info("%s", output)
+                jobids.append(alisimtools.get_jobid(output))
+        return jobids
+
+    def submitJobArray(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset, dependency=None):
+        # One script and one submission for all the jobs, the job number is the index in the array
+        taskjobscriptname = os.path.join(workdir, jobscriptbase.replace("RANK", "ARRAY"))
+        if self.is_slurm():
+            tasklogfile = os.path.join(workdir, logfilebase.replace("RANK", "%4a"))
+        else:
+            # The array index is appended to the name of the log file by PBS
+            tasklogfile = os.path.join(workdir, logfilebase.replace("RANK", "ARRAY"))
+        logging.info("Using jobscript {jobscript} for jobs {first} to {last}, writing to {logfile}".format(jobscript=taskjobscriptname, first=joboffset, last=njobs + joboffset - 1, logfile=tasklogfile))
+        with open(taskjobscriptname, 'w') as jobscriptwriter:
+            jobscriptwriter.write("#!/bin/bash\n")
+            jobscriptwriter.write(alipackagetools.GenerateComments())
+            self.get_batchhandler()(jobscriptwriter, batchconfig, tasklogfile, (joboffset, njobs + joboffset - 1))
+            alisimtools.write_array_jobid(jobscriptwriter)
+            self.writeSimCommand(repo, jobscriptwriter, envscript, workdir, simtask.create_task_command_array("JOBID"))
+            jobscriptwriter.write("cd %s\n" %workdir)
+            jobscriptwriter.write("echo WD: $PWD\n")
+            self.writeCleanCommand(jobscriptwriter, envscript, "${JOBTAG}")
+        os.chmod(taskjobscriptname, 0o755)
+        output = alisimtools.subprocess_checkoutput([self.get_batchsub()] + self.get_dependency_args(dependency) + [taskjobscriptname])
+        logging.info("%s", output)
+        return alisimtools.get_jobid(output)
+
+    def get_dependency_args(self, dependency):
+        if not dependency:
+            return []
+        if self.is_slurm():
+            # The dependent jobs are cancelled if a job they depend on fails
+            return ["--dependency=afterok:%s" %":".join(dependency), "--kill-on-invalid-dep=yes"]
+        # Job arrays (ID[]) have their own dependency type in PBS
+        singlejobs = [jobid for jobid in dependency if not "[]" in jobid]
+        arrays = [jobid for jobid in dependency if "[]" in jobid]
+        conditions = []
+        if singlejobs:
+            conditions.append("afterok:%s" %":".join(singlejobs))
+        if arrays:
+            conditions.append("afterokarray:%s" %":".join(arrays))
+        return ["-W", "depend=%s" %",".join(conditions)]
+
+    def is_slurm(self):
+        # The batch system is detected once per submitter
+        if self.__slurm is None:
+            self.__slurm = alisimtools.test_slurm()
+        return self.__slurm
 
     def get_batchhandler(self):
-        return self.configbatch_slurm if alisimtools.test_slurm() else self.configbatch_pbs
+        return self.configbatch_slurm if self.is_slurm() else self.configbatch_pbs
    
     def get_batchsub(self):
-        return "sbatch" if alisimtools.test_slurm() else "qsub"
+        return "sbatch" if self.is_slurm() else "qsub"
 
     def writeSimCommand(self, repo, scriptwriter, envscript, workdir, simcommand):
         scriptwriter.write("source $HOME/%s\n" %envscript)
         scriptwriter.write("%s\n" %simcommand)
+        # Exit code of the job, so that the jobs depending on it only run if it succeeded
+        scriptwriter.write("JOBSTATUS=$?\n")
 
     def writeCleanCommand(self, jobscriptwriter, envscript, jobid):
-        FilesToDelete = []
-        if "herwig" in envscript:
-            FilesToDelete.append("events_%04d.hepmc" %jobid)
-            FilesToDelete.append("herwig_%04d.in" %jobid)
-            FilesToDelete.append("herwig_%04d.run" %jobid)
-        elif "powheg" in envscript:
-            FilesToDelete.append("pwgevents-%04d.lhe" %jobid)
-            FilesToDelete.append("pwgevents-%04d.lhe.bak" %jobid)
-        for f in FilesToDelete:
-            jobscriptwriter.write("rm -v %s\n" %f)
+        alisimtools.write_clean_command(jobscriptwriter, envscript, jobid)
 
     def run_build(self, repo, workdir, envscript):
         currentdir = os.getcwd()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+# Runs the jobs of a train on the local machine (a workstation or an interactive
+# allocation), with a pool of processes instead of a batch system. Selected with
+# "backend: local" in the batch configuration. submitJobs only returns once all
+# the jobs ran, so the jobs of a submission depending on failed jobs are skipped.
+
+import concurrent.futures
+import itertools
+import logging
+import os
+import subprocess
+import time
+import yaml
+import sim_workers
+from alifastsim import Tools as alisimtools
+from alifastsim import PackageTools as alipackagetools
+
+# Exit codes of the jobs run by this process, by job ID (None: skipped)
+job_status = {}
+job_counter = itertools.count(1)
+
+class localbatchtools:
+
+    def __init__(self, batchconfig):
+        with open(batchconfig, "r") as breader:
+            bcdata = yaml.load(breader, yaml.SafeLoader)
+        self.__concurrency = os.cpu_count()
+        if "concurrency" in bcdata:
+            self.__concurrency = int(bcdata["concurrency"])
+        # Memory (MB) needed by a job: a job only starts if it is available
+        self.__memory_per_job = 0
+        if "memory_per_job" in bcdata:
+            self.__memory_per_job = int(bcdata["memory_per_job"])
+        # Memory (MB) the jobs may use in total
+        if "memory" in bcdata and self.__memory_per_job > 0:
+            self.__concurrency = min(self.__concurrency, max(1, int(bcdata["memory"]) // self.__memory_per_job))
+        self.__memory = sim_workers.MemoryGate(self.__memory_per_job)
+
+    def submitJobs(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset, dependency=None, serial=False):
+        """Runs the jobs if the jobs in dependency (job IDs) succeeded. Returns the job IDs.
+        The jobs always run as separate processes, serial is accepted for the interface of the batch tools."""
+        jobs = []
+        for ijob in range(joboffset, njobs + joboffset):
+            taskjobscriptname = os.path.join(workdir, jobscriptbase.replace("RANK", "%04d" %ijob))
+            tasklogfile = os.path.join(workdir, logfilebase.replace("RANK", "%04d" %ijob))
+            with open(taskjobscriptname, 'w') as jobscriptwriter:
+                jobscriptwriter.write("#!/bin/bash\n")
+                jobscriptwriter.write(alipackagetools.GenerateComments())
+                self.writeSimCommand(repo, jobscriptwriter, envscript, workdir, simtask.create_task_command_serial(ijob))
+                jobscriptwriter.write("cd %s\n" %workdir)
+                jobscriptwriter.write("echo WD: $PWD\n")
+                self.writeCleanCommand(jobscriptwriter, envscript, ijob)
+            os.chmod(taskjobscriptname, 0o755)
+            jobs.append(("local.%d.%d" %(os.getpid(), next(job_counter)), ijob, taskjobscriptname, tasklogfile))
+
+        failed_dependencies = [jobid for jobid in (dependency if dependency else []) if job_status.get(jobid) != 0]
+        if failed_dependencies:
+            logging.error("Skipping jobs %s, the jobs %s they depend on failed", jobscriptbase, " ".join(failed_dependencies))
+            for jobid, _, _, _ in jobs:
+                job_status[jobid] = None
+            return [jobid for jobid, _, _, _ in jobs]
+
+        logging.info("Running %d jobs %s, %d at a time", njobs, jobscriptbase, min(njobs, self.__concurrency))
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(njobs, self.__concurrency))) as executor:
+            results = list(executor.map(self.runJob, jobs))
+        failed = [(ijob, tasklogfile, returncode) for (_, ijob, _, tasklogfile), (returncode, _) in zip(jobs, results) if returncode != 0]
+        runtimes = [runtime for _, runtime in results] or [0]
+        logging.info("%d of %d jobs succeeded in %.0f s (job runtime: min %.0f s, max %.0f s)", njobs - len(failed), njobs, time.time() - start, min(runtimes), max(runtimes))
+        for ijob, tasklogfile, returncode in failed:
+            logging.error("Job %d failed with exit code %d, see %s", ijob, returncode, tasklogfile)
+        return [jobid for jobid, _, _, _ in jobs]
+
+    def runJob(self, job):
+        jobid, ijob, taskjobscriptname, tasklogfile = job
+        reservation = self.__memory.Acquire()
+        try:
+            logging.debug("Starting job %d (%s), writing to %s", ijob, taskjobscriptname, tasklogfile)
+            start = time.time()
+            with open(tasklogfile, "w") as logwriter:
+                returncode = subprocess.call(["/bin/bash", taskjobscriptname], stdout=logwriter, stderr=subprocess.STDOUT)
+            runtime = time.time() - start
+            job_status[jobid] = returncode
+            logging.info("Job %d done with exit code %d after %.0f s", ijob, returncode, runtime)
+        finally:
+            self.__memory.Release(reservation)
+        return returncode, runtime
+
+    def writeSimCommand(self, repo, scriptwriter, envscript, workdir, simcommand):
+        scriptwriter.write("source $HOME/%s\n" %envscript)
+        scriptwriter.write("%s\n" %simcommand)
+        scriptwriter.write("JOBSTATUS=$?\n")
+
+    def writeCleanCommand(self, jobscriptwriter, envscript, jobid):
+        alisimtools.write_clean_command(jobscriptwriter, envscript, jobid)
+
+    def run_build(self, repo, workdir, envscript):
+        subprocess.call(["/bin/bash", "-c", "source %s/%s && make" %(os.environ["HOME"], envscript)], cwd=workdir)
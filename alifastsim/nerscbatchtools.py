@@ -16,6 +16,35 @@ def is_nersc_system():
             break
     return nersc_host
 
+# Cores, hardware threads per core and memory (MB) of the compute nodes
+nodecores = {"edison": 24, "cori": 68}
+nodethreads = {"edison": 2, "cori": 4}
+nodememory = {"edison": 64000, "cori": 96000}
+
+def get_task_layout(bcdata, nerscsystem):
+    """Tasks per node, threads per task and logical CPUs per task of an allocation, from
+    tasks_per_node (default: one task per core), threads_per_task (default: 1) and
+    memory_per_task (MB, reduces the number of tasks per node) of the batch configuration."""
+    taskspernode = nodecores[nerscsystem]
+    if "tasks_per_node" in bcdata:
+        taskspernode = int(bcdata["tasks_per_node"])
+    threadspertask = 1
+    if "threads_per_task" in bcdata:
+        threadspertask = int(bcdata["threads_per_task"])
+    if "memory_per_task" in bcdata:
+        taskspernode = min(taskspernode, nodememory[nerscsystem] // int(bcdata["memory_per_task"]))
+    logicalcpus = nodecores[nerscsystem] * nodethreads[nerscsystem]
+    taskspernode = max(1, min(taskspernode, logicalcpus // threadspertask))
+    # Each task gets the same number of logical CPUs, whole cores as long as there are at most as many tasks as cores
+    cpuspertask = max(threadspertask, logicalcpus // taskspernode)
+    if cpuspertask >= nodethreads[nerscsystem]:
+        # Rounded down to whole cores, but not below threads_per_task (rounded up to whole cores): fewer tasks per node if needed
+        cpuspertask = max(cpuspertask - cpuspertask % nodethreads[nerscsystem], int(math.ceil(float(threadspertask) / nodethreads[nerscsystem])) * nodethreads[nerscsystem])
+        if taskspernode > logicalcpus // cpuspertask:
+            logging.warning("%d tasks per node with %d threads do not fit on whole cores, using %d tasks per node", taskspernode, threadspertask, logicalcpus // cpuspertask)
+            taskspernode = logicalcpus // cpuspertask
+    return {"tasks_per_node": taskspernode, "threads_per_task": threadspertask, "cpus_per_task": cpuspertask}
+
 class nerscbatchtools:
 
     class cern_buildexception(Exception):
@@ -26,38 +55,51 @@ class nerscbatchtools:
         def __str__(self):
             return "Environment is not configured correctly!"
 
-    def configbatch_slurm(self, scriptwriter, batchconfig, nnodes, ntasks, ncpu, outputfile):
+    def configbatch_slurm(self, scriptwriter, batchconfig, nnodes, ntasks, ncpu, outputfile, jobarray=None, qos=None):
         breader = open(batchconfig, "r")
         bcdata = yaml.load(breader, yaml.SafeLoader)
         breader.close()
         nerscsystem = os.environ["NERSC_HOST"]
-        scriptwriter.write("#SBATCH --qos=%s\n" %bcdata["qos"])
-        taskspernode={"edison":24, "cori": 68}
-        if bcdata["qos"] != "shared":
+        # qos overrides the QOS of the batch configuration
+        if not qos:
+            qos = bcdata["qos"]
+        scriptwriter.write("#SBATCH --qos=%s\n" %qos)
+        tasklayout = get_task_layout(bcdata, nerscsystem)
+        if qos != "shared":
                 scriptwriter.write("#SBATCH --nodes=%d\n" %nnodes)
-                scriptwriter.write("#SBATCH --tasks-per-node=%d\n" %taskspernode[nerscsystem])
+                scriptwriter.write("#SBATCH --tasks-per-node=%d\n" %tasklayout["tasks_per_node"])
                 if nerscsystem == "cori":
                     scriptwriter.write("#SBATCH --constraint=knl\n")
         else:
                 scriptwriter.write("#SBATCH --ntasks=%d\n" %ntasks)
-                scriptwriter.write("#SBATCH --cpus-per-task=%d\n" %ncpu)
+                scriptwriter.write("#SBATCH --cpus-per-task=%d\n" %(ncpu * tasklayout["threads_per_task"]))
+                if "memory_per_task" in bcdata:
+                    scriptwriter.write("#SBATCH --mem=%dM\n" %(ntasks * int(bcdata["memory_per_task"])))
         scriptwriter.write("#SBATCH --output=%s\n" %outputfile)
         scriptwriter.write("#SBATCH --image=docker:mfasel/cc7-alice:latest\n")
         scriptwriter.write("#SBATCH --license=cscratch1,project\n") 
         scriptwriter.write("#SBATCH --time=%s\n" %bcdata["time"])
+        if jobarray:
+            scriptwriter.write("#SBATCH --array=%d-%d\n" %jobarray)
 
-    def submitJobs(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset):
+    def submitJobs(self, repo, simtask, workdir, jobscriptbase, logfilebase, envscript, batchconfig, njobs, joboffset, dependency=None, serial=False):
+        """Submits the jobs, which only start once the jobs in dependency (batch job IDs) succeeded.
+        serial jobs (e.g. short bookkeeping jobs) are submitted one by one in the shared QOS,
+        instead of taking whole nodes in the MPI QOS. Returns the batch job IDs."""
         breader = open(batchconfig, "r")
         bcdata = yaml.load(breader, yaml.SafeLoader)
         breader.close()
         
-        ismpiqueue = bcdata["qos"] != "shared"
+        ismpiqueue = bcdata["qos"] != "shared" and not serial
         nerscsystem = os.environ["NERSC_HOST"]
+        jobids = []
         if ismpiqueue:
             #determine nodes and number of CPUs
-            taskspernode={"edison":24, "cori": 68}
-            nnodes = int(math.ceil(float(njobs)/float(taskspernode[nerscsystem])))
-            nslots = int(nnodes) * int(taskspernode[nerscsystem])
+            tasklayout = get_task_layout(bcdata, nerscsystem)
+            # One slot for the manager of the task farm (mpiwrapper.py), the others run the jobs
+            nnodes = int(math.ceil(float(njobs + 1)/float(tasklayout["tasks_per_node"])))
+            nslots = nnodes * tasklayout["tasks_per_node"]
+            logging.info("%d nodes, %d tasks per node with %d logical CPUs each", nnodes, tasklayout["tasks_per_node"], tasklayout["cpus_per_task"])
             taskjobscriptname = jobscriptbase
             taskjobscriptname = os.path.join(workdir, taskjobscriptname.replace("RANK", "MPI"))
             generallogfile = logfilebase
@@ -68,11 +110,28 @@ class nerscbatchtools:
                 jobscriptwriter.write(alipackagetools.GenerateComments())
                 self.configbatch_slurm(jobscriptwriter, batchconfig, nnodes, 0, 0, generallogfile)
                 jobscriptwriter.write("module load cray-python/2.7.15.1\n")  # python with mpi, needed for srun
-                self.writeSimCommandMPI(repo, jobscriptwriter, nslots, njobs, joboffset, envscript, workdir, simtask.create_task_command_mpi(), os.path.join(workdir,logfilebase))
+                self.writeSimCommandMPI(repo, jobscriptwriter, nslots, njobs, joboffset, envscript, workdir, simtask.create_task_command_mpi(), os.path.join(workdir,logfilebase), tasklayout)
                 jobscriptwriter.close()
                 os.chmod(taskjobscriptname, 0o755)
-                output = alisimtools.subprocess_checkoutput([self.get_batchsub(), taskjobscriptname])
+                output = alisimtools.subprocess_checkoutput([self.get_batchsub()] + self.get_dependency_args(dependency) + [taskjobscriptname])
                 logging.info("%s", output)
+                jobids.append(alisimtools.get_jobid(output))
+
+        elif not serial and alisimtools.use_job_array(batchconfig, njobs):
+            #submit the serial jobs as a single job array, the job number is the index in the array
+            taskjobscriptname = os.path.join(workdir, jobscriptbase.replace("RANK", "ARRAY"))
+            tasklogfile = os.path.join(workdir, logfilebase.replace("RANK", "%4a"))
+            with open(taskjobscriptname, "w") as jobscriptwriter:
+                jobscriptwriter.write("#!/bin/bash\n")
+                jobscriptwriter.write(alipackagetools.GenerateComments())
+                self.configbatch_slurm(jobscriptwriter, batchconfig, 1, 1, 1, tasklogfile, (joboffset, njobs + joboffset - 1))
+                alisimtools.write_array_jobid(jobscriptwriter)
+                self.writeSimCommand(repo, jobscriptwriter, envscript, workdir, simtask.create_task_command_array("JOBID"))
+                self.writeCleanCommand(jobscriptwriter, envscript, "${JOBTAG}")
+            os.chmod(taskjobscriptname, 0o755)
+            output = alisimtools.subprocess_checkoutput([self.get_batchsub()] + self.get_dependency_args(dependency) + [taskjobscriptname])
+            logging.info("%s", output)
+            jobids.append(alisimtools.get_jobid(output))
 
         else:
             #submit multiple serial jobs
@@ -84,14 +143,21 @@ class nerscbatchtools:
                 with open(taskjobscriptname, "w") as jobscriptwriter:
                     jobscriptwriter.write("#!/bin/bash\n")
                     jobscriptwriter.write(alipackagetools.GenerateComments())
-                    self.configbatch_slurm(jobscriptwriter, batchconfig, 1, 1, 1, tasklogfile)
+                    self.configbatch_slurm(jobscriptwriter, batchconfig, 1, 1, 1, tasklogfile, qos="shared" if serial else None)
                     self.writeSimCommand(repo, jobscriptwriter, envscript, workdir, simtask.create_task_command_serial(ijob))
                     self.writeCleanCommand(jobscriptwriter, envscript, ijob)
                     jobscriptwriter.close()
                     os.chmod(taskjobscriptname, 0o755)
-                    output = alisimtools.subprocess_checkoutput([self.get_batchsub(), taskjobscriptname])
+                    output = alisimtools.subprocess_checkoutput([self.get_batchsub()] + self.get_dependency_args(dependency) + [taskjobscriptname])
                     logging.info("%s", output)
-                    
+                    jobids.append(alisimtools.get_jobid(output))
+        return jobids
+
+    def get_dependency_args(self, dependency):
+        if not dependency:
+            return []
+        # The dependent jobs are cancelled if a job they depend on fails
+        return ["--dependency=afterok:%s" %":".join(dependency), "--kill-on-invalid-dep=yes"]
 
     def get_batchhandler(self):
         return self.configbatch_slurm
@@ -101,21 +167,18 @@ class nerscbatchtools:
 
     def writeSimCommand(self, repo, scriptwriter, envscript, workdir, simcommand):
         scriptwriter.write("shifter %s/nersc/shifterrun.sh %s/%s %s \"%s\"\n" %(repo, os.environ["CSCRATCH"], envscript, workdir, simcommand))
+        # Exit code of the job, so that the jobs depending on it only run if it succeeded
+        scriptwriter.write("JOBSTATUS=$?\n")
 
-    def writeSimCommandMPI(self, repo, scriptwriter, nslots, njobs, joboffset, envscript, workdir, simcommand, logfiletemplate):
-        scriptwriter.write("srun -n %d python %s/nersc/mpiwrapper.py %d %d %s/%s %s \"%s\" %s\n" %(nslots, repo, njobs, joboffset, os.environ["CSCRATCH"], envscript, workdir, simcommand, logfiletemplate))
+    def writeSimCommandMPI(self, repo, scriptwriter, nslots, njobs, joboffset, envscript, workdir, simcommand, logfiletemplate, tasklayout):
+        # Each task is pinned to its logical CPUs: whole cores, or hardware threads if the node is oversubscribed
+        nerscsystem = os.environ["NERSC_HOST"]
+        cpubind = "cores" if tasklayout["cpus_per_task"] >= nodethreads[nerscsystem] else "threads"
+        scriptwriter.write("export OMP_NUM_THREADS=%d\n" %tasklayout["threads_per_task"])
+        scriptwriter.write("srun -n %d -c %d --cpu-bind=%s python %s/nersc/mpiwrapper.py %d %d %s/%s %s \"%s\" %s\n" %(nslots, tasklayout["cpus_per_task"], cpubind, repo, njobs, joboffset, os.environ["CSCRATCH"], envscript, workdir, simcommand, logfiletemplate))
 
     def writeCleanCommand(self, jobscriptwriter, envscript, jobid):
-        FilesToDelete = []
-        if "herwig" in envscript:
-            FilesToDelete.append("events_%04d.hepmc" %jobid)
-            FilesToDelete.append("herwig_%04d.in" %jobid)
-            FilesToDelete.append("herwig_%04d.run" %jobid)
-        elif "powheg" in envscript:
-            FilesToDelete.append("pwgevents-%04d.lhe" %jobid)
-            FilesToDelete.append("pwgevents-%04d.lhe.bak" %jobid)
-        for f in FilesToDelete:
-            jobscriptwriter.write("rm -vf %s\n" %f)
+        alisimtools.write_clean_command(jobscriptwriter, envscript, jobid)
 
     def run_build(self, repo, workdir, envscript):
         currentdir = os.getcwd()
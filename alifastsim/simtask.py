@@ -10,12 +10,21 @@ class simtask:
     
     def create_task_command_serial(self, jobid):
         taskcommand = self.__create_task_command_main()
-        taskcommand += " %s %d" %(self.__jobidstring, jobid)
+        # Tasks without job number (e.g. the checks between POWHEG stages)
+        if self.__jobidstring:
+            taskcommand += " %s %d" %(self.__jobidstring, jobid)
+        return "%s" %taskcommand
+
+    def create_task_command_array(self, jobidvariable):
+        taskcommand = self.__create_task_command_main()
+        if self.__jobidstring:
+            taskcommand += " %s $%s" %(self.__jobidstring, jobidvariable)
         return "%s" %taskcommand
 
     def create_task_command_mpi(self):
         taskcommand = self.__create_task_command_main()
-        taskcommand += " %s RANK" %(self.__jobidstring)
+        if self.__jobidstring:
+            taskcommand += " %s RANK" %(self.__jobidstring)
         return "%s" %taskcommand
 
     def __create_task_command_main(self):
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Staging of the files needed by a job (sources, libraries, macros) into its work
+# directory. Files are hard-linked where possible, symlinked when the work directory
+# is on a different file system (or hard links are not permitted), and copied only
+# as a last resort, or when requested. The staged files are only read by the jobs.
+
+import errno
+import logging
+import os
+import shutil
+
+STAGE_MODES = ["link", "symlink", "copy"]
+
+class StagingReport:
+    """Counts the staged files per method and the bytes that were not copied."""
+
+    def __init__(self):
+        self.files = {"link": 0, "symlink": 0, "copy": 0}
+        self.bytes_saved = 0
+        self.bytes_copied = 0
+
+    def Add(self, method, size):
+        self.files[method] += 1
+        if method == "copy":
+            self.bytes_copied += size
+        else:
+            self.bytes_saved += size
+
+    def __str__(self):
+        return "{} files hard-linked, {} symlinked, {} copied: {:.1f} MB saved, {:.1f} MB copied".format(
+            self.files["link"], self.files["symlink"], self.files["copy"], self.bytes_saved / 1024.0 ** 2, self.bytes_copied / 1024.0 ** 2)
+
+def StageFile(src, dest, mode="link", report=None):
+    """Makes src available as dest, trying the methods in STAGE_MODES starting from
+    mode. An existing dest is replaced. Returns the method that was used."""
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            method = "link"
+            if report: report.Add(method, os.path.getsize(src))
+            return method
+        os.remove(dest)
+    size = os.path.getsize(src)
+    method = "copy"
+    for candidate in STAGE_MODES[STAGE_MODES.index(mode):-1]:
+        try:
+            if candidate == "link":
+                os.link(src, dest)
+            else:
+                os.symlink(os.path.abspath(src), dest)
+            method = candidate
+            break
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EACCES, errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+    if method == "copy":
+        shutil.copy(src, dest)
+    if report: report.Add(method, size)
+    return method
+
+def StageFiles(files, mode="link", report=None):
+    """Stages the files in the dictionary {source: destination}. Returns the report."""
+    if report is None:
+        report = StagingReport()
+    for src, dest in files.items():
+        method = StageFile(src, dest, mode, report)
+        logging.debug("Staged %s to %s (%s)", src, dest, method)
+    return report
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Benchmark of the compressed event files (.lhe.gz, .lhe.zst) against plain text.
+# For each format the disk footprint, the compression time, the time needed to
+# build the event index (i.e. to count the events) and the throughput of the
+# decompressed stream handed to the simulation are measured on a synthetic LHE file.
+# The events are filled with random momenta, cycling over a block larger than the
+# compression windows, so that the compression ratio is not overestimated.
+#
+# ./benchmarks/eventfile_compression.py --size 1 --workdir /scratch/bench
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import event_index
+import lhe_utils
+
+LHE_HEADER = "<LesHouchesEvents version=\"1.0\">\n<header>\n</header>\n<init>\n  2212  2212  3.500E+03  3.500E+03  -1  -1  10800  10800  -4  1\n  1.0E+00  1.0E+00  1.0E+00  10001\n</init>\n"
+LHE_FOOTER = "</LesHouchesEvents>\n"
+BLOCK_EVENTS = 20000
+
+def GenerateEvent(rnd):
+    lines = ["<event>", "      5  10001  1.0E+00  {:.5E} -1.00000E+00  1.7E-01".format(rnd.uniform(5, 500))]
+    for i in range(5):
+        px, py, pz = rnd.gauss(0, 50), rnd.gauss(0, 50), rnd.gauss(0, 500)
+        lines.append("       21   -1    0    0  511  514  {:.9E}  {:.9E}  {:.9E}  {:.9E}  0.000000000E+00  0.0E+00  9.0E+00".format(px, py, pz, (px ** 2 + py ** 2 + pz ** 2) ** 0.5))
+    lines.append("</event>")
+    return "\n".join(lines) + "\n"
+
+def GenerateLHEFile(fname, size):
+    rnd = random.Random(12345)
+    block = "".join(GenerateEvent(rnd) for i in range(BLOCK_EVENTS))
+    nblocks = max(1, int(size / len(block)))
+    with open(fname, "w") as fout:
+        fout.write(LHE_HEADER)
+        for i in range(nblocks):
+            fout.write(block)
+        fout.write(LHE_FOOTER)
+    return nblocks * BLOCK_EVENTS
+
+def MeasureIndex(eventfile):
+    event_index.RemoveIndex(eventfile)
+    start = time.time()
+    index = lhe_utils.IndexLHEFile(eventfile)
+    return time.time() - start, index
+
+def MeasureStream(index):
+    # Same path as the hand-off of an input file to the simulation (without the FIFO)
+    start = time.time()
+    lhe_utils.WriteLHEShard(index, 0, 1, os.devnull)
+    return time.time() - start
+
+def main(size, workdir, keep):
+    lhefile = os.path.join(workdir, "bench_pwgevents.lhe")
+    print("Generating synthetic LHE file {} ({:.2f} GB)...".format(lhefile, size))
+    nevents = GenerateLHEFile(lhefile, size * 1024 ** 3)
+    data_size = os.path.getsize(lhefile)
+    print("{} events, {} bytes".format(nevents, data_size))
+
+    print("{:8s} {:>14s} {:>8s} {:>12s} {:>12s} {:>14s}".format("format", "size (bytes)", "ratio", "compress (s)", "index (s)", "stream (MB/s)"))
+    files = [lhefile]
+    for compression in [""] + list(event_index.COMPRESSION_SUFFIXES):
+        eventfile = lhefile + compression
+        compress_time = 0.0
+        if compression:
+            start = time.time()
+            event_index.CompressEventFile(lhefile, eventfile)
+            compress_time = time.time() - start
+            files.append(eventfile)
+        index_time, index = MeasureIndex(eventfile)
+        if lhe_utils.GetNumberOfEvents(index) != nevents:
+            print("Wrong number of events in {}: {}".format(eventfile, lhe_utils.GetNumberOfEvents(index)))
+        stream_time = MeasureStream(index)
+        file_size = os.path.getsize(eventfile)
+        print("{:8s} {:14d} {:8.2f} {:12.2f} {:12.2f} {:14.1f}".format(compression if compression else "plain", file_size, float(data_size) / file_size, compress_time, index_time, data_size / 1024.0 ** 2 / stream_time))
+
+    if not keep:
+        for eventfile in files:
+            os.remove(eventfile)
+            event_index.RemoveIndex(eventfile)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the compressed event files against plain text.')
+    parser.add_argument('--size', metavar='GB', default=1.0, type=float, help='Size of the synthetic (uncompressed) LHE file in GB')
+    parser.add_argument('--workdir', metavar='DIR', default='./')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic event files')
+    args = parser.parse_args()
+
+    main(args.size, args.workdir, args.keep)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Benchmark of the empty event append on a synthetic LHE file.
+# Compares the in-place tail append (lhe_utils.AppendEmptyEvent) with the
+# previous implementation, which loaded the whole file in memory and wrote it back.
+# Each method runs in a separate process, so that its peak RSS can be measured.
+#
+# ./benchmarks/lhe_empty_event.py --size 5 --workdir /scratch/bench
+# ./benchmarks/lhe_empty_event.py --size 1 --legacy   (needs RAM for the whole file)
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lhe_utils
+
+LHE_HEADER = "<LesHouchesEvents version=\"1.0\">\n<header>\n</header>\n<init>\n  2212  2212  3.500E+03  3.500E+03  -1  -1  10800  10800  -4  1\n  1.0E+00  1.0E+00  1.0E+00  10001\n</init>\n"
+LHE_EVENT = "<event>\n      5  10001  1.0E+00  2.5E+01 -1.00000E+00  1.7E-01\n" + \
+            "       21   -1    0    0  511  514  0.0E+00  0.0E+00  1.2E+02  1.2E+02  0.0E+00  0.0E+00  9.0E+00\n" * 5 + \
+            "</event>\n"
+LHE_FOOTER = "</LesHouchesEvents>\n"
+
+def GenerateLHEFile(fname, size):
+    nevents = int(size / len(LHE_EVENT))
+    block = LHE_EVENT * 1000
+    with open(fname, "w") as fout:
+        fout.write(LHE_HEADER)
+        for i in range(nevents // 1000):
+            fout.write(block)
+        fout.write(LHE_EVENT * (nevents % 1000))
+        fout.write(LHE_FOOTER)
+    return nevents
+
+def LegacyAddEmptyEvent(lhefile):
+    backup_filename = lhefile + ".bak"
+    os.rename(lhefile, backup_filename)
+    with open(backup_filename, 'r') as fin:
+        lhe = fin.read().splitlines()
+    last_event_stop_index = -1
+    for i, line in reversed(list(enumerate(lhe))):
+        if line == "</event>":
+            last_event_stop_index = i
+            break
+    lhe.insert(last_event_stop_index + 1, "<event>")
+    lhe.insert(last_event_stop_index + 2, "      0  10001  1.0  1.0 -1.00000E+00  1.0")
+    lhe.insert(last_event_stop_index + 3, "</event>")
+    with open(lhefile, 'w') as fout:
+        for line in lhe:
+            fout.write(line + "\n")
+    os.remove(backup_filename)
+
+def RunMethod(method, lhefile, queue):
+    start = time.time()
+    method(lhefile)
+    wall = time.time() - start
+    queue.put((wall, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def Measure(method, lhefile):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=RunMethod, args=(method, lhefile, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+def main(size, workdir, legacy, keep):
+    lhefile = os.path.join(workdir, "bench_pwgevents.lhe")
+    print("Generating synthetic LHE file {} ({:.2f} GB)...".format(lhefile, size))
+    nevents = GenerateLHEFile(lhefile, size * 1024 ** 3)
+    filesize = os.path.getsize(lhefile)
+    print("{} events, {} bytes".format(nevents, filesize))
+
+    methods = [("in-place tail append", lhe_utils.AppendEmptyEvent)]
+    if legacy:
+        methods.append(("legacy full rewrite", LegacyAddEmptyEvent))
+    for name, method in methods:
+        with open(lhefile, "r+b") as fout:
+            fout.truncate(filesize)
+            fout.seek(filesize - len(LHE_FOOTER))
+            fout.write(LHE_FOOTER.encode())
+        wall, maxrss = Measure(method, lhefile)
+        print("{:25s}: wall time {:8.3f} s, peak RSS {:8.1f} MB, file size {} bytes".format(name, wall, maxrss / 1024.0, os.path.getsize(lhefile)))
+
+    if not keep:
+        os.remove(lhefile)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the empty event append on a synthetic LHE file.')
+    parser.add_argument('--size', metavar='GB', default=5.0, type=float, help='Size of the synthetic LHE file in GB')
+    parser.add_argument('--workdir', metavar='DIR', default='./')
+    parser.add_argument('--legacy', action='store_true', help='Also run the previous implementation (loads the whole file in memory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic LHE file')
+    args = parser.parse_args()
+
+    main(args.size, args.workdir, args.legacy, args.keep)
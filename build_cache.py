@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of the compiled analysis code (AnalysisCode.so, its
+# dictionaries and .pcm files) and of the ACLiC-compiled runJetSimulation.C.
+# Entries are keyed by a hash of the sources, the Makefile and the AliPhysics/ROOT
+# build in use. The build is protected by a file lock, so that on a node or on a
+# shared file system exactly one job compiles and all the other jobs reuse it.
+
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+from file_lock import FileLock
+
+BUILD_SOURCES = ["Makefile", "HepMC.tar", "OnTheFlySimulationGenerator.cxx", "OnTheFlySimulationGenerator.h",
+                 "*_dev.cxx", "*_dev.h", "runJetSimulation.C", "start_simulation.C", "compile_simulation.C"]
+LIBRARY_PRODUCTS = ["AnalysisCode.so", "AnalysisCode.rootmap", "*_Dict_rdict.pcm"]
+MACRO_PRODUCTS = ["runJetSimulation_C.so", "runJetSimulation_C.d", "runJetSimulation_C_ACLiC_dict_rdict.pcm"]
+KEY_FILE = ".build_key"
+
+def ExpandPatterns(srcdir, patterns):
+    files = []
+    for pattern in patterns:
+        for f in sorted(glob.glob(os.path.join(srcdir, pattern))):
+            if os.path.isfile(f) and not f in files:
+                files.append(f)
+    return files
+
+def GetBuildTag(aliphysics="", env=None):
+    """Identifies the AliPhysics/ROOT build the code is compiled against
+    (taken from the environment env, by default the current one)."""
+    if env is None:
+        env = os.environ
+    tag = [aliphysics, env.get("ALIPHYSICS_VERSION", ""), env.get("ROOT_VERSION", "")]
+    for var in ["ALICE_PHYSICS", "ALICE_ROOT", "ROOTSYS"]:
+        if var in env:
+            tag.append(os.path.realpath(env[var]))
+    return ":".join(tag)
+
+def GetBuildKey(srcdir, build_tag):
+    """Hash of the build sources (names and content) and of the build tag."""
+    h = hashlib.sha256()
+    h.update(build_tag.encode())
+    for f in ExpandPatterns(srcdir, BUILD_SOURCES):
+        h.update(os.path.basename(f).encode() + b"\0")
+        with open(f, "rb") as fin:
+            for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()[:20]
+
+def CopyFileAtomic(src, dest):
+    """Copies src to dest through a temporary file, so that a process using dest
+    (e.g. a library loaded by a running job) keeps reading the old file."""
+    tmpfile = "{}.tmp{}".format(dest, os.getpid())
+    shutil.copy(src, tmpfile)
+    os.replace(tmpfile, dest)
+
+class BuildCache:
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.entry = os.path.join(cache_dir, key)
+
+    def Lock(self):
+        return FileLock(os.path.join(self.cache_dir, "{}.lock".format(self.key)))
+
+    def Has(self, patterns):
+        """True if the cache entry contains the main product (the first one in patterns),
+        the others are optional (e.g. the rootmap)."""
+        return os.path.isfile(os.path.join(self.entry, patterns[0]))
+
+    def Store(self, srcdir, patterns):
+        if not os.path.isdir(self.entry):
+            os.makedirs(self.entry)
+        for f in ExpandPatterns(srcdir, patterns):
+            CopyFileAtomic(f, os.path.join(self.entry, os.path.basename(f)))
+
+    def Restore(self, destdir, patterns):
+        """Copies the products in patterns from the cache to destdir. The copies get
+        a new modification time, so that they are newer than the sources (ACLiC
+        does not compile a macro again if its library is newer)."""
+        for f in ExpandPatterns(self.entry, patterns):
+            CopyFileAtomic(f, os.path.join(destdir, os.path.basename(f)))
+
+def IsUpToDate(destdir, key):
+    keyfile = os.path.join(destdir, KEY_FILE)
+    if not os.path.isfile(keyfile) or not os.path.isfile(os.path.join(destdir, LIBRARY_PRODUCTS[0])):
+        return False
+    with open(keyfile) as fin:
+        return fin.read().strip() == key
+
+def WriteKey(destdir, key):
+    with open(os.path.join(destdir, KEY_FILE), "w") as fout:
+        fout.write(key + "\n")
+
+def PrepareBuild(srcdir, cache_dir, build_tag, logfile=None, env=None):
+    """Makes sure that the compiled analysis code and macro matching the sources in
+    srcdir are available in srcdir: they are taken from the cache, or built (by
+    a single process, holding the lock, in the environment env) and stored in the
+    cache. Returns False if the analysis code could not be built."""
+    key = GetBuildKey(srcdir, build_tag)
+    if IsUpToDate(srcdir, key):
+        print("Analysis code already built (build key {})".format(key))
+        return True
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    cache = BuildCache(cache_dir, key)
+    with cache.Lock():
+        # Another job may hold the lock while it is building: check again after acquiring it
+        if IsUpToDate(srcdir, key):
+            print("Analysis code already built (build key {})".format(key))
+            return True
+        if cache.Has(LIBRARY_PRODUCTS):
+            print("Using the analysis code from the build cache {}".format(cache.entry))
+        else:
+            print("Compiling analysis code (build key {})...".format(key))
+            if subprocess.call(["make"], cwd=srcdir, stdout=logfile, stderr=logfile, env=env) != 0 or not os.path.isfile(os.path.join(srcdir, LIBRARY_PRODUCTS[0])):
+                print("Compilation of the analysis code failed!")
+                return False
+            cache.Store(srcdir, LIBRARY_PRODUCTS)
+        if not cache.Has(MACRO_PRODUCTS):
+            cache.Restore(srcdir, LIBRARY_PRODUCTS)
+            for f in ExpandPatterns(srcdir, MACRO_PRODUCTS):
+                os.remove(f)
+            print("Compiling the simulation macro...")
+            subprocess.call(["aliroot", "-b", "-l", "-q", "compile_simulation.C"], cwd=srcdir, stdout=logfile, stderr=logfile, env=env)
+            if ExpandPatterns(srcdir, MACRO_PRODUCTS[:1]):
+                cache.Store(srcdir, MACRO_PRODUCTS)
+            else:
+                # ACLiC compiles the macro at run time, as without the cache
+                print("Compilation of the simulation macro failed, it will be compiled by each job.")
+        cache.Restore(srcdir, LIBRARY_PRODUCTS + MACRO_PRODUCTS)
+        WriteKey(srcdir, key)
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the analysis code, or take it from the build cache.')
+    parser.add_argument('--cache-dir', metavar='DIR', default='build_cache')
+    parser.add_argument('--aliphysics', metavar='VERSION', default='', help='AliPhysics version (part of the build key)')
+    parser.add_argument('--key', action='store_true', help='Only print the build key')
+    args = parser.parse_args()
+
+    if args.key:
+        print(GetBuildKey("./", GetBuildTag(args.aliphysics)))
+    elif not PrepareBuild("./", args.cache_dir, GetBuildTag(args.aliphysics)):
+        sys.exit(1)
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+
+# Byte-offset index of the event records in a generator output file (LHE, HepMC).
+# The index is built in a single buffered pass over the file and stored in a small
+# sidecar file (<file>.idx) next to it, so that a file already seen does not need to
+# be scanned again.
+#
+# Sidecar layout: one line of JSON with the metadata, followed by the event offsets
+# as an array of unsigned 64 bit integers (native byte order).
+#
+# Event files compressed with gzip (.gz) or zstandard (.zst) are decompressed on
+# the fly. Their offsets refer to the decompressed content, so that the index of a
+# file is still valid after it has been compressed.
+
+import abc
+import array
+import errno
+import gzip
+import io
+import json
+import os
+import select
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    # The zstd command line tool is used instead
+    zstandard = None
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+def GetIndexFileName(eventfile):
+    return eventfile + INDEX_SUFFIX
+
+def GetCompression(eventfile):
+    """Returns the compression suffix of eventfile (".gz", ".zst"), or "" if it is not compressed."""
+    for suffix in COMPRESSION_SUFFIXES:
+        if eventfile.endswith(suffix):
+            return suffix
+    return ""
+
+def StripCompressionSuffix(eventfile):
+    suffix = GetCompression(eventfile)
+    if suffix:
+        return eventfile[:-len(suffix)]
+    return eventfile
+
+class StreamReader(io.RawIOBase):
+    """Read-only file object on top of a decompressed stream (the zstandard
+    stream reader or the output of the zstd command). Only forward seeks
+    are supported: they are done by reading and discarding the data."""
+
+    def __init__(self, stream, proc=None):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.proc = proc
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = self.stream.readinto(buf)
+        self.pos += n
+        return n
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Seek from the end of a compressed stream is not supported")
+        if offset < self.pos:
+            raise io.UnsupportedOperation("Backward seek in a compressed stream is not supported")
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, CHUNK_SIZE)):
+                break
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.stream.close()
+        if self.proc:
+            # The decompression may be stopped before the end of the stream
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+        io.RawIOBase.close(self)
+
+def OpenEventFile(eventfile):
+    """Opens an event file for reading, decompressing it on the fly if needed."""
+    compression = GetCompression(eventfile)
+    if compression == ".gz":
+        return gzip.open(eventfile, "rb")
+    if compression == ".zst":
+        if zstandard:
+            reader = zstandard.ZstdDecompressor().stream_reader(open(eventfile, "rb"), read_across_frames=True)
+            return io.BufferedReader(StreamReader(reader), CHUNK_SIZE)
+        proc = subprocess.Popen(["zstd", "-q", "-d", "-c", "--", eventfile], stdout=subprocess.PIPE)
+        return io.BufferedReader(StreamReader(proc.stdout, proc), CHUNK_SIZE)
+    return open(eventfile, "rb")
+
+class StreamWriter(io.RawIOBase):
+    """Write-only file object compressing its input with the zstd command."""
+
+    def __init__(self, eventfile):
+        io.RawIOBase.__init__(self)
+        self.proc = subprocess.Popen(["zstd", "-q", "-f", "-T0", "-{}".format(ZSTD_LEVEL), "-o", eventfile], stdin=subprocess.PIPE)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.proc.stdin.close()
+        rc = self.proc.wait()
+        io.RawIOBase.close(self)
+        if rc != 0:
+            raise OSError("zstd exited with return code {}".format(rc))
+
+def OpenEventFileForWriting(eventfile):
+    """Opens an event file for writing, compressing it on the fly if its name
+    ends with a compression suffix."""
+    compression = GetCompression(eventfile)
+    if compression == ".gz":
+        return gzip.open(eventfile, "wb", compresslevel=GZIP_LEVEL)
+    if compression == ".zst":
+        if zstandard:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(open(eventfile, "wb"))
+        return StreamWriter(eventfile)
+    return open(eventfile, "wb")
+
+def ScanRecords(fileobj, pattern, chunk_size=CHUNK_SIZE):
+    """Yields (offset, end of line offset, tag) for every match of the compiled
+    bytes regex pattern (which should be anchored at the start of a line and
+    have one group). The file is read once in chunks of chunk_size bytes."""
+    base = 0
+    carry = b""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        data = carry + chunk
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            carry = data
+            continue
+        for m in pattern.finditer(data, 0, cut):
+            yield base + m.start(), base + data.find(b"\n", m.end()) + 1, m.group(1)
+        base += cut
+        carry = data[cut:]
+    if carry:
+        for m in pattern.finditer(carry):
+            eol = carry.find(b"\n", m.end())
+            if eol < 0:
+                eol = len(carry)
+            else:
+                eol += 1
+            yield base + m.start(), base + eol, m.group(1)
+
+class EventIndex:
+
+    def __init__(self, eventfile, offsets, header_end, events_end, info=None, data_size=-1):
+        self.eventfile = eventfile
+        self.header_end = header_end
+        self.events_end = events_end
+        self.info = info if info else {}
+        # Size of the (decompressed) content of the event file
+        self.data_size = data_size
+        self.source_size = 0
+        self.source_mtime = 0
+        self._offsets = offsets
+        self._nevents = len(offsets) if offsets is not None else 0
+        self._offsets_pos = 0
+        self.UpdateSourceStat()
+
+    @property
+    def nevents(self):
+        return self._nevents
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = array.array("Q")
+            with open(GetIndexFileName(self.eventfile), "rb") as fin:
+                fin.seek(self._offsets_pos)
+                self._offsets.fromfile(fin, self._nevents)
+        return self._offsets
+
+    def GetEventRange(self, ievent):
+        """Returns the byte range [start, end) of event number ievent (starting from 0)."""
+        if ievent < 0 or ievent >= self._nevents:
+            raise IndexError("Event {} out of range (file {} has {} events)".format(ievent, self.eventfile, self._nevents))
+        start = self.offsets[ievent]
+        if ievent + 1 < self._nevents:
+            end = self.offsets[ievent + 1]
+        else:
+            end = self.events_end
+        return start, end
+
+    def GetEventsRange(self, first, last):
+        """Returns the byte range [start, end) of the events first to last - 1."""
+        if first >= last:
+            return self.header_end, self.header_end
+        start = self.GetEventRange(first)[0]
+        end = self.GetEventRange(last - 1)[1]
+        return start, end
+
+    def ReadEvent(self, ievent):
+        start, end = self.GetEventRange(ievent)
+        with OpenEventFile(self.eventfile) as fin:
+            fin.seek(start)
+            return fin.read(end - start)
+
+    def AppendEvent(self, start, end):
+        self.offsets.append(start)
+        self._nevents += 1
+        self.events_end = end
+
+    def UpdateSourceStat(self):
+        if os.path.isfile(self.eventfile):
+            st = os.stat(self.eventfile)
+            self.source_size = st.st_size
+            self.source_mtime = st.st_mtime_ns
+            if not GetCompression(self.eventfile):
+                self.data_size = st.st_size
+
+    def IsUpToDate(self):
+        if not os.path.isfile(self.eventfile):
+            return False
+        st = os.stat(self.eventfile)
+        return st.st_size == self.source_size and st.st_mtime_ns == self.source_mtime
+
+    def Save(self):
+        """Writes the sidecar index. Returns False if the index could not be written
+        (e.g. the input file is located in a read-only directory)."""
+        offsets = self.offsets
+        metadata = {"version": INDEX_VERSION,
+                    "source_size": self.source_size,
+                    "source_mtime": self.source_mtime,
+                    "nevents": self._nevents,
+                    "header_end": self.header_end,
+                    "events_end": self.events_end,
+                    "data_size": self.data_size,
+                    "byteorder": sys.byteorder,
+                    "info": self.info}
+        indexfile = GetIndexFileName(self.eventfile)
+        tmpfile = "{}.tmp{}".format(indexfile, os.getpid())
+        try:
+            with open(tmpfile, "wb") as fout:
+                fout.write(json.dumps(metadata).encode() + b"\n")
+                offsets.tofile(fout)
+            os.replace(tmpfile, indexfile)
+        except OSError as e:
+            print("Could not write the event index '{}': {}".format(indexfile, e))
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return False
+        return True
+
+    @classmethod
+    def Load(cls, eventfile):
+        """Loads the sidecar index of eventfile. Only the metadata is read, the event
+        offsets are loaded on first use. Returns None if there is no valid index."""
+        indexfile = GetIndexFileName(eventfile)
+        if not os.path.isfile(indexfile):
+            return None
+        try:
+            with open(indexfile, "rb") as fin:
+                metadata = json.loads(fin.readline().decode())
+                offsets_pos = fin.tell()
+        except (OSError, ValueError):
+            return None
+        if metadata.get("version") != INDEX_VERSION or metadata.get("byteorder") != sys.byteorder:
+            return None
+        index = cls.__new__(cls)
+        index.eventfile = eventfile
+        index.header_end = metadata["header_end"]
+        index.events_end = metadata["events_end"]
+        index.info = metadata["info"]
+        index.source_size = metadata["source_size"]
+        index.source_mtime = metadata["source_mtime"]
+        index.data_size = metadata.get("data_size", index.source_size)
+        index._offsets = None
+        index._nevents = metadata["nevents"]
+        index._offsets_pos = offsets_pos
+        if not index.IsUpToDate():
+            return None
+        return index
+
+def GetShardEventRange(nevents, ishard, nshards):
+    """Returns the events [first, last) of shard ishard (starting from 0) when
+    splitting nevents into nshards contiguous shards."""
+    first = nevents * ishard // nshards
+    last = nevents * (ishard + 1) // nshards
+    return first, last
+
+def CopyRange(infd, outfd, start, end):
+    """Copies the byte range [start, end) of infd to outfd (at its current position).
+    The copy is done in the kernel with copy_file_range (regular files) or sendfile
+    (pipes) where available, falling back to a buffered copy."""
+    remaining = end - start
+    offset = start
+    if stat.S_ISREG(os.fstat(outfd).st_mode) and hasattr(os, "copy_file_range"):
+        copy = lambda n: os.copy_file_range(infd, outfd, n, offset)
+    elif hasattr(os, "sendfile"):
+        copy = lambda n: os.sendfile(outfd, infd, offset, n)
+    else:
+        copy = None
+    while remaining > 0 and copy:
+        try:
+            n = copy(min(remaining, 1024 * CHUNK_SIZE))
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                break
+            raise
+        if n == 0:
+            break
+        offset += n
+        remaining -= n
+    while remaining > 0:
+        data = os.pread(infd, min(remaining, CHUNK_SIZE), offset)
+        if not data:
+            break
+        WriteAll(outfd, data)
+        offset += len(data)
+        remaining -= len(data)
+
+def CopyStream(fin, fout, start, end):
+    """Copies the byte range [start, end) of the file object fin (which is
+    only read forward, so that it can be a compressed stream) to fout."""
+    fin.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = fin.read(min(remaining, CHUNK_SIZE))
+        if not data:
+            break
+        WriteStream(fout, data)
+        remaining -= len(data)
+
+def WriteStream(fout, data):
+    if isinstance(fout, io.FileIO):
+        WriteAll(fout.fileno(), data)
+    else:
+        fout.write(data)
+
+def WriteShard(index, ishard, nshards, output, nevents=-1, extra=b""):
+    """Writes shard ishard of nshards of the events in index to output (a file
+    name or a file descriptor, which is closed afterwards). The shard repeats the header of the event file (e.g.
+    the LHE <init> block), followed by its range of events, the bytes in
+    extra and the trailer of the event file. If nevents >= 0 only the first
+    nevents events are distributed across the shards. Compressed event files
+    are decompressed on the fly, and the shard is compressed if output is a
+    file name with a compression suffix."""
+    if nevents < 0:
+        nevents = index.nevents
+    first, last = GetShardEventRange(nevents, ishard, nshards)
+    start, end = index.GetEventsRange(first, last)
+    if isinstance(output, str) and GetCompression(output):
+        fout = OpenEventFileForWriting(output)
+    else:
+        fout = open(output, "wb", buffering=0)
+    with OpenEventFile(index.eventfile) as fin, fout:
+        if GetCompression(index.eventfile) or not isinstance(fout, io.FileIO):
+            CopyStream(fin, fout, 0, index.header_end)
+            CopyStream(fin, fout, start, end)
+            WriteStream(fout, extra)
+            CopyStream(fin, fout, index.events_end, index.data_size)
+        else:
+            infd = fin.fileno()
+            outfd = fout.fileno()
+            CopyRange(infd, outfd, 0, index.header_end)
+            CopyRange(infd, outfd, start, end)
+            WriteAll(outfd, extra)
+            CopyRange(infd, outfd, index.events_end, index.data_size)
+    return last - first
+
+def ConcatenateEventFiles(index, others):
+    """Appends the events of the event files indexed by others (e.g. produced by
+    the same generator with other seeds) to the file of index, in place, keeping
+    only the header and the trailer of the latter. The events are copied in the
+    kernel and the offsets of the appended events are taken from their indices,
+    without scanning the result. Only uncompressed files are supported. Returns
+    the index of the result (not saved)."""
+    offsets = array.array("Q", index.offsets)
+    with open(index.eventfile, "r+b", buffering=0) as fout:
+        tail = os.pread(fout.fileno(), index.data_size - index.events_end, index.events_end)
+        fout.seek(index.events_end)
+        fout.truncate()
+        pos = index.events_end
+        for other in others:
+            if other.nevents == 0:
+                continue
+            shift = pos - other.header_end
+            offsets.extend(offset + shift for offset in other.offsets)
+            with open(other.eventfile, "rb") as fin:
+                CopyRange(fin.fileno(), fout.fileno(), other.header_end, other.events_end)
+            pos += other.events_end - other.header_end
+        WriteAll(fout.fileno(), tail)
+        os.fsync(fout.fileno())
+    return EventIndex(index.eventfile, offsets, index.header_end, pos, index.info, pos + len(tail))
+
+def CompressEventFile(eventfile, output):
+    """Writes a compressed copy of eventfile to output (the compression is chosen
+    from the suffix of output), in a streaming pass. The event index of eventfile,
+    if up to date, is carried over, since the offsets refer to the decompressed
+    content. Returns the size of output in bytes."""
+    index = EventIndex.Load(eventfile)
+    if index:
+        # The offsets are read from the sidecar of eventfile
+        index.offsets
+    with OpenEventFile(eventfile) as fin, OpenEventFileForWriting(output) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+    if index:
+        index.eventfile = output
+        index.UpdateSourceStat()
+        index.Save()
+    return os.path.getsize(output)
+
+class ShardWriter(threading.Thread):
+    """Feeds a shard of an event file into a FIFO, in a background thread.
+    The consumer of the FIFO sees a valid event file containing only the shard,
+    without the shard being ever written to disk."""
+
+    def __init__(self, index, ishard, nshards, fifo, nevents=-1, extra=b""):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.index = index
+        self.ishard = ishard
+        self.nshards = nshards
+        self.nevents = nevents
+        self.extra = extra
+        self.broken_pipe = False
+        self.stopped = threading.Event()
+        self.fifo = os.path.abspath(fifo)
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+    def run(self):
+        fd = OpenFIFOForWriting(self.fifo, self.stopped)
+        if fd < 0:
+            return
+        try:
+            WriteShard(self.index, self.ishard, self.nshards, fd, self.nevents, self.extra)
+        except BrokenPipeError:
+            # The consumer stopped reading before the end of the shard
+            self.broken_pipe = True
+
+    def Finish(self):
+        """Waits for the writer (which gives up if the consumer never opened
+        the FIFO) and removes the FIFO."""
+        self.stopped.set()
+        self.join()
+        os.remove(self.fifo)
+
+def OpenFIFOForReading(fifo, stopped, poll_interval=0.1):
+    """Opens the read end of a FIFO and waits for a writer to send data (or to
+    close its end). Gives up and returns -1 as soon as the threading.Event
+    stopped is set."""
+    fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    while True:
+        readable, _, _ = select.select([fd], [], [], poll_interval)
+        if readable:
+            break
+        if stopped.is_set():
+            os.close(fd)
+            return -1
+    os.set_blocking(fd, True)
+    return fd
+
+def WriteAll(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = view[n:]
+
+def OpenFIFOForWriting(fifo, stopped, poll_interval=0.1):
+    """Opens the write end of a FIFO, waiting for a reader to open the other end.
+    Gives up and returns -1 as soon as the threading.Event stopped is set."""
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if stopped.wait(poll_interval):
+            return -1
+    os.set_blocking(fd, True)
+    return fd
+
+class StreamRelay(threading.Thread, abc.ABC):
+    """Relays the events that a generator writes into the FIFO source to the
+    FIFO sink read by the simulation, in a background thread. Derived classes
+    implement Relay(infd, outfd), which forwards only complete events, counts
+    them in nevents and terminates the stream properly. The pipes provide the
+    back-pressure: the generator blocks when the simulation falls behind."""
+
+    def __init__(self, source, sink):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = os.path.abspath(source)
+        self.sink = os.path.abspath(sink)
+        self.nevents = 0
+        self.complete = False
+        self.broken_pipe = False
+        self.stopped = threading.Event()
+        if os.path.exists(self.sink):
+            os.remove(self.sink)
+        os.mkfifo(self.sink)
+
+    def run(self):
+        infd = OpenFIFOForReading(self.source, self.stopped)
+        if infd < 0:
+            return
+        outfd = OpenFIFOForWriting(self.sink, self.stopped)
+        if outfd < 0:
+            os.close(infd)
+            return
+        try:
+            self.Relay(infd, outfd)
+        except BrokenPipeError:
+            # The simulation stopped reading (e.g. all the requested events were simulated)
+            self.broken_pipe = True
+        finally:
+            os.close(infd)
+            os.close(outfd)
+
+    @abc.abstractmethod
+    def Relay(self, infd, outfd):
+        pass
+
+    def Finish(self):
+        """Waits for the relay (which gives up if one of the two sides never
+        opened its FIFO) and removes the sink FIFO."""
+        self.stopped.set()
+        self.join()
+        os.remove(self.sink)
+
+def RemoveIndex(eventfile):
+    indexfile = GetIndexFileName(eventfile)
+    if os.path.isfile(indexfile):
+        os.remove(indexfile)
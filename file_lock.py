@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Lock shared by the jobs of a node or of a shared file system (e.g. around the
+# build of the analysis code or the installation of a PDF set)
+
+import errno
+import fcntl
+import os
+import time
+
+LOCK_TIMEOUT = 3600
+
+class FileLock:
+    """Exclusive lock on a file, held in a with block. fcntl locks (rather than
+    flock) are used, since they also work on NFS. Raises OSError if the lock
+    could not be acquired within timeout seconds."""
+
+    def __init__(self, lockfile, timeout=LOCK_TIMEOUT, poll_interval=1.0):
+        self.lockfile = lockfile
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.fd = -1
+
+    def __enter__(self):
+        self.fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o664)
+        start = time.time()
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            if time.time() - start > self.timeout:
+                os.close(self.fd)
+                self.fd = -1
+                raise OSError("Timeout waiting for the lock '{}'".format(self.lockfile))
+            time.sleep(self.poll_interval)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = -1
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Utilities to handle the HepMC2 ASCII (IO_GenEvent) files produced by Herwig
+
+import argparse
+import array
+import os
+import re
+import sys
+import event_index
+
+HEPMC_START = b"HepMC::IO_GenEvent-START_EVENT_LISTING"
+HEPMC_END = b"HepMC::IO_GenEvent-END_EVENT_LISTING"
+# Event records are lines "E <event number> ...", other record types (V, P, U, C...) are skipped
+HEPMC_TAGS = re.compile(rb"^(E(?= \d)|HepMC::IO_GenEvent-END_EVENT_LISTING)", re.M)
+HEPMC_EVENT = re.compile(rb"^E \d", re.M)
+
+def IndexHepMCFile(hepfile):
+    """Builds the event index of a HepMC file in a single pass."""
+    offsets = array.array("Q")
+    events_end = -1
+    with event_index.OpenEventFile(hepfile) as fin:
+        for start, eol, tag in event_index.ScanRecords(fin, HEPMC_TAGS):
+            if tag == b"E":
+                offsets.append(start)
+                events_end = -1
+            elif events_end < 0:
+                events_end = start
+        # The whole (decompressed) content was read
+        size = fin.tell()
+    if events_end < 0:
+        events_end = size
+    if len(offsets) > 0:
+        header_end = offsets[0]
+    else:
+        header_end = events_end
+    return event_index.EventIndex(hepfile, offsets, header_end, events_end, data_size=size)
+
+def GetHepMCIndex(hepfile):
+    """Returns the event index of a HepMC file, loading it from the sidecar file
+    if it is up to date, otherwise scanning the HepMC file and saving the index."""
+    index = event_index.EventIndex.Load(hepfile)
+    if index:
+        return index
+    index = IndexHepMCFile(hepfile)
+    index.Save()
+    return index
+
+def GetNumberOfEvents(index):
+    return index.nevents
+
+def GetEvent(hepfile, ievent):
+    """Returns the records of event number ievent (starting from 0) without scanning the file."""
+    return GetHepMCIndex(hepfile).ReadEvent(ievent)
+
+def ConcatenateHepMCFiles(hepfile, others):
+    """Appends the events of the HepMC files others (e.g. produced by Herwig with
+    other seeds) to hepfile, in place, with a single header and trailer. The
+    events are copied in the kernel and the event index is extended without
+    scanning the result. The event numbers are kept as they are (they are not
+    unique in the result). Returns the number of events."""
+    index = event_index.ConcatenateEventFiles(GetHepMCIndex(hepfile), [GetHepMCIndex(other) for other in others])
+    index.Save()
+    return index.nevents
+
+def WriteHepMCShard(index, ishard, nshards, output):
+    """Writes shard ishard of nshards of a HepMC file to output, keeping the
+    HepMC header and trailer. Returns the number of events in the shard."""
+    return event_index.WriteShard(index, ishard, nshards, output)
+
+def CreateHepMCShardView(index, ishard, nshards, fifo):
+    """Returns a (not yet started) ShardWriter feeding shard ishard of nshards
+    of a HepMC file into the FIFO fifo, and the number of events in the shard."""
+    first, last = event_index.GetShardEventRange(index.nevents, ishard, nshards)
+    return event_index.ShardWriter(index, ishard, nshards, fifo), last - first
+
+class HepMCStreamRelay(event_index.StreamRelay):
+    """Relays the HepMC events written by Herwig to the simulation, counting
+    them on the fly. An event is forwarded once the next event record (or the
+    end of the event listing) is seen, so that an incomplete event left by a
+    Herwig crash is never passed to the simulation."""
+
+    def Relay(self, infd, outfd):
+        carry = b""
+        while True:
+            chunk = os.read(infd, event_index.CHUNK_SIZE)
+            if not chunk:
+                break
+            data = carry + chunk
+            footer = data.find(b"\n" + HEPMC_END)
+            if footer >= 0:
+                self.Forward(outfd, data[:footer + 1])
+                carry = b""
+                self.complete = True
+                break
+            # Start of the last (possibly incomplete) event
+            cut = data.rfind(b"\nE ") + 1
+            if cut == 0:
+                carry = data
+                continue
+            self.Forward(outfd, data[:cut])
+            carry = data[cut:]
+        if self.nevents == 0 and not HEPMC_EVENT.match(carry):
+            # HepMC header
+            self.Forward(outfd, carry)
+        event_index.WriteAll(outfd, HEPMC_END + b"\n")
+
+    def Forward(self, outfd, data):
+        self.nevents += len(HEPMC_EVENT.findall(data))
+        event_index.WriteAll(outfd, data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index a HepMC file and print its events.')
+    parser.add_argument('hepfile', metavar='events.hepmc')
+    parser.add_argument('--event', metavar='K', type=int, default=-1,
+                        help='Print event number K (starting from 0)')
+    args = parser.parse_args()
+
+    index = GetHepMCIndex(args.hepfile)
+    print("File {} contains {} events".format(args.hepfile, index.nevents))
+    if args.event >= 0:
+        sys.stdout.write(GetEvent(args.hepfile, args.event).decode())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Cache of the Herwig run files. The costly "Herwig read" step only depends on
+# herwig.in, the input files it reads (tune, snippets...) and the Herwig version:
+# the run file is built once per train (by a single job, holding a lock) and each
+# job only runs "Herwig run" with its own seed and its own setup file, which sets
+# the HepMC output file.
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import event_index
+import hepmc_utils
+from file_lock import FileLock
+
+READ_COMMAND = re.compile(r"^\s*read\s+(\S+)", re.M)
+SAVERUN_COMMAND = re.compile(r"^\s*saverun\s+(\S+)\s+(\S+)", re.M)
+READ_TIMEOUT = 7200
+
+def GetHerwigRepo(env=None):
+    if env is None:
+        env = os.environ
+    return "{}/share/Herwig/HerwigDefaults.rpo".format(env["HERWIG_ROOT"])
+
+def GetInputFiles(herwig_in, workdir):
+    """Returns herwig_in and the local files it reads, recursively. Files that are
+    not found in workdir are taken from the Herwig installation (e.g. the
+    snippets) and are identified by the Herwig version."""
+    files = []
+    pending = [herwig_in]
+    while pending:
+        fname = pending.pop(0)
+        path = os.path.join(workdir, fname)
+        if fname in files or not os.path.isfile(path):
+            continue
+        files.append(fname)
+        with open(path) as fin:
+            pending.extend(READ_COMMAND.findall(fin.read()))
+    return files
+
+def GetHerwigVersion(env=None):
+    if env is None:
+        env = os.environ
+    tag = [env.get("HERWIG_VERSION", ""), env.get("THEPEG_VERSION", "")]
+    for var in ["HERWIG_ROOT", "THEPEG_ROOT"]:
+        if var in env:
+            tag.append(os.path.realpath(env[var]))
+    return ":".join(tag)
+
+def GetRunKey(herwig_in, workdir, env=None):
+    """Hash of herwig_in, of the local files it reads and of the Herwig version."""
+    h = hashlib.sha256()
+    h.update(GetHerwigVersion(env).encode())
+    for fname in GetInputFiles(herwig_in, workdir):
+        h.update(fname.encode() + b"\0")
+        with open(os.path.join(workdir, fname), "rb") as fin:
+            h.update(fin.read())
+    return h.hexdigest()[:20]
+
+def PrepareHerwigRun(herwig_in, workdir, cache_dir, env=None, logfile=None):
+    """Returns the path of the run file built from herwig_in (in workdir), taking it
+    from cache_dir or running "Herwig read" (once, holding the lock) and storing
+    it in cache_dir. Returns None if "Herwig read" failed."""
+    key = GetRunKey(herwig_in, workdir, env)
+    runname = "herwig_{}".format(key)
+    runfile = os.path.join(os.path.abspath(cache_dir), "{}.run".format(runname))
+    if os.path.isfile(runfile):
+        print("Using the HERWIG run file {}".format(runfile))
+        return runfile
+    os.makedirs(cache_dir, exist_ok=True)
+    with FileLock(os.path.join(cache_dir, "{}.lock".format(runname))):
+        if os.path.isfile(runfile):
+            print("Using the HERWIG run file {}".format(runfile))
+            return runfile
+        print("Building the HERWIG run file {}...".format(runfile))
+        # Same input, saving the run under the name of the cache entry
+        with open(os.path.join(workdir, herwig_in)) as fin:
+            herwig_input = SAVERUN_COMMAND.sub(r"saverun {} \2".format(runname), fin.read())
+        readfile = "{}.in".format(runname)
+        with open(os.path.join(workdir, readfile), "w") as fout:
+            fout.write(herwig_input)
+        try:
+            rc = subprocess.call(["Herwig", "read", "--repo={}".format(GetHerwigRepo(env)), readfile],
+                                 cwd=workdir, stdout=logfile, stderr=logfile, env=env, timeout=READ_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            rc = -1
+        os.remove(os.path.join(workdir, readfile))
+        output = os.path.join(workdir, "{}.run".format(runname))
+        if rc != 0 or not os.path.isfile(output):
+            print("Something went wrong in the HERWIG run configuration.")
+            return None
+        tmpfile = "{}.tmp{}".format(runfile, os.getpid())
+        shutil.move(output, tmpfile)
+        os.replace(tmpfile, runfile)
+    return runfile
+
+def WriteSetupFile(setupfile, hepfile, nevents):
+    """Job specific settings applied on top of the cached run file (Herwig run --setupfile)."""
+    with open(setupfile, "w") as fout:
+        fout.write("set /Herwig/Analysis/HepMC:Filename {}\n".format(hepfile))
+        fout.write("set /Herwig/Analysis/HepMC:PrintEvent {}\n".format(nevents))
+
+def GetRunCommand(runfile, setupfile, seed, nevents, tag, env=None):
+    """The tag keeps the log files of jobs sharing the same run file apart."""
+    return ["Herwig", "run", "--repo={}".format(GetHerwigRepo(env)), runfile, "--setupfile={}".format(setupfile),
+            "--tag={}".format(tag), "-s", str(seed), "-N", str(nevents)]
+
+def GetProcessFileName(fname, iprocess):
+    base, ext = os.path.splitext(fname)
+    return "{}_p{}{}".format(base, iprocess, ext)
+
+def RunHerwigParallel(runfile, setupfile, hepfile, nevents, seed, tag, nprocesses, env=None, logfile=None):
+    """Splits nevents over nprocesses concurrent "Herwig run" of the same run file,
+    with the seeds seed, seed + 1, ... and their own setup and HepMC files. The
+    HepMC files are then concatenated into hepfile. Returns the number of
+    processes that succeeded."""
+    procs = []
+    for iprocess in range(nprocesses):
+        process_events = nevents * (iprocess + 1) // nprocesses - nevents * iprocess // nprocesses
+        process_setupfile = GetProcessFileName(setupfile, iprocess)
+        process_hepfile = GetProcessFileName(hepfile, iprocess)
+        WriteSetupFile(process_setupfile, process_hepfile, process_events)
+        cmd = GetRunCommand(runfile, process_setupfile, seed + iprocess, process_events, "{}p{}".format(tag, iprocess), env)
+        if logfile:
+            logfile.write("Running '{}'\n".format(" ".join(cmd)))
+            logfile.flush()
+        procs.append((subprocess.Popen(cmd, stdout=logfile, stderr=subprocess.STDOUT, env=env), process_setupfile, process_hepfile))
+    hepfiles = []
+    for proc, process_setupfile, process_hepfile in procs:
+        proc.wait()
+        os.remove(process_setupfile)
+        if proc.returncode != 0 or not os.path.isfile(process_hepfile):
+            print("HERWIG process {} failed with return code {}.".format(process_hepfile, proc.returncode))
+            continue
+        hepfiles.append(process_hepfile)
+    if not hepfiles:
+        return 0
+    os.replace(hepfiles[0], hepfile)
+    event_index.RemoveIndex(hepfile)
+    event_index.RemoveIndex(hepfiles[0])
+    nevents_generated = hepmc_utils.ConcatenateHepMCFiles(hepfile, hepfiles[1:])
+    for f in hepfiles[1:]:
+        os.remove(f)
+        event_index.RemoveIndex(f)
+    print("{} HERWIG processes generated {} events, stored in {}".format(len(hepfiles), nevents_generated, hepfile))
+    return len(hepfiles)
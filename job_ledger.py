@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# Ledger of the simulation jobs submitted with submitLocalBatch.py: a SQLite database
+# (job_ledger.sqlite in local_path) with one row per train (FastSim_<gen>_<proc>_<ts>),
+# holding what is needed to submit its jobs again, and one row per job, keyed by
+# train name and job number: batch job ID, state, exit code, runtime, output size.
+#
+# A job is "submitted" until its outcome is known, then "done" (exit code 0 and valid
+# AnalysisResults files) or "failed". The outcome is taken from the files the job
+# writes in the train directory: its log file (exit code printed at the end of the
+# job script), mpi_task_status.json (MPI jobs at NERSC) and its job metrics (runtime),
+# only considering the files written after the last submission of the job. A job
+# killed by the scheduler (time limit, preemption, node failure) writes none of them:
+# a job without outcome whose batch job is not pending or running anymore (sacct,
+# qstat) is "failed" as well.
+#
+# ./job_ledger.py status [--train TRAIN] [--jobs] [--state STATE]
+# ./job_ledger.py resubmit --failed [--train TRAIN] [--dry-run]
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from alifastsim import UserConfiguration as aliuserconfig
+
+LEDGER_FILE = "job_ledger.sqlite"
+STATES = ["submitted", "done", "failed"]
+# Line printed by the job scripts after the job ran
+EXIT_CODE = re.compile(r"^Job exit code: (\d+)\s*$", re.M)
+ROOT_MAGIC = b"root"
+# States of the batch jobs which are not over yet (sacct, qstat)
+SLURM_ACTIVE = ["PENDING", "RUNNING", "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "RESIZING", "SUSPENDED", "CONFIGURING", "COMPLETING", "SIGNALING", "STAGE_OUT"]
+PBS_ACTIVE = ["Q", "R", "H", "W", "T", "S", "E", "B", "M", "U"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trains (
+    train TEXT PRIMARY KEY, gen TEXT, proc TEXT, local_dest TEXT, exe_file TEXT, events INTEGER,
+    config TEXT, batch_config TEXT, envscript TEXT, powheg_stage INTEGER, log_template TEXT, submit_time REAL);
+CREATE TABLE IF NOT EXISTS jobs (
+    train TEXT, job INTEGER, batch_job_id TEXT, state TEXT, exit_code INTEGER, runtime REAL, output_size INTEGER,
+    attempts INTEGER, submit_time REAL, update_time REAL, PRIMARY KEY (train, job));
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, train);
+"""
+
+class OpenLedger:
+    """Connection to the ledger of local_path, committed when the with block ends without error."""
+
+    def __init__(self, local_path):
+        self.filename = os.path.join(local_path, LEDGER_FILE)
+
+    def __enter__(self):
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.commit()
+        self.connection.close()
+        return False
+
+def RecordSubmission(ledger, train, params, jobids, submit_time=None):
+    """Records the submission of the jobs of a train. params are the parameters of the
+    train (see submitLocalBatch.RecordJobs), jobids the batch job ID of each job number.
+    Files of the jobs older than submit_time (default: now) belong to previous attempts."""
+    now = submit_time if submit_time else time.time()
+    columns = ["gen", "proc", "local_dest", "exe_file", "events", "config", "batch_config", "envscript", "powheg_stage", "log_template"]
+    ledger.execute("INSERT OR REPLACE INTO trains (train, {}, submit_time) VALUES (?, {}, ?)".format(", ".join(columns), ", ".join("?" * len(columns))),
+                   [train] + [params[column] for column in columns] + [now])
+    for job, jobid in sorted(jobids.items()):
+        # No upsert (ON CONFLICT needs SQLite 3.24, CC7 has 3.7): the row of a new job is created with no attempt
+        ledger.execute("INSERT OR IGNORE INTO jobs (train, job, attempts) VALUES (?, ?, 0)", (train, job))
+        ledger.execute("""UPDATE jobs SET batch_job_id = ?, state = 'submitted', exit_code = NULL, runtime = NULL, output_size = NULL,
+                          attempts = attempts + 1, submit_time = ?, update_time = ? WHERE train = ? AND job = ?""",
+                       (jobid, now, now, train, job))
+
+def IsNewer(filename, since):
+    return os.path.isfile(filename) and os.path.getmtime(filename) >= since
+
+def GetOutputSize(train, job, since):
+    """Size of the AnalysisResults files of a job, None if one of them is not a valid ROOT file."""
+    size = 0
+    fname = "{}_{}_{:04d}".format(train["gen"], train["proc"], job)
+    outputs = [output for output in glob.glob(os.path.join(train["local_dest"], "output", fname, "AnalysisResults*.root")) if IsNewer(output, since)]
+    if not outputs:
+        return None
+    for output in outputs:
+        with open(output, "rb") as fin:
+            if fin.read(len(ROOT_MAGIC)) != ROOT_MAGIC:
+                return None
+        size += os.path.getsize(output)
+    return size
+
+def GetExitCode(train, job, since):
+    """Exit code of a job from its log file or from the status file of the MPI task farm, None if unknown."""
+    logfile = os.path.join(train["local_dest"], train["log_template"].replace("RANK", "{:04d}".format(job)))
+    if IsNewer(logfile, since):
+        with open(logfile, errors="replace") as fin:
+            exit_codes = EXIT_CODE.findall(fin.read())
+        if exit_codes:
+            return int(exit_codes[-1])
+    statusfile = os.path.join(train["local_dest"], "mpi_task_status.json")
+    if IsNewer(statusfile, since):
+        try:
+            with open(statusfile) as fin:
+                status = json.load(fin).get("{:04d}".format(job), {})
+        except (OSError, ValueError):
+            status = {}
+        if status.get("state") in ["done", "failed"]:
+            return status["returncode"]
+    return None
+
+def GetMetrics(train, job, since):
+    """Job metrics written by runFastSim.py, None if the job did not write them (yet)."""
+    metricsfile = os.path.join(train["local_dest"], "job_metrics_{}_{}_{:04d}.json".format(train["gen"], train["proc"], job))
+    if not IsNewer(metricsfile, since):
+        return None
+    try:
+        with open(metricsfile) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+def CheckJob(train, job):
+    """Returns the state, exit code, runtime and output size of a submitted job."""
+    exit_code = GetExitCode(train, job["job"], job["submit_time"])
+    metrics = GetMetrics(train, job["job"], job["submit_time"])
+    output_size = GetOutputSize(train, job["job"], job["submit_time"])
+    runtime = metrics["total"]["wall_time"] if metrics and "total" in metrics else None
+    if exit_code is None and metrics:
+        # Exit code not printed (e.g. PBS job arrays): a job that wrote its metrics ended
+        exit_code = 0 if all(phase["status"] == "done" for phase in metrics["phases"]) else 1
+    if exit_code is None:
+        state = "submitted"
+    elif exit_code == 0 and output_size:
+        state = "done"
+    else:
+        state = "failed"
+    return state, exit_code, runtime, output_size
+
+def GetActiveBatchJobs(batch_job_ids):
+    """Batch jobs the scheduler has as pending or running, None if it cannot be asked
+    (no sacct or qstat on this host). Jobs it does not know anymore are not active."""
+    active = set()
+    if shutil.which("sacct"):
+        try:
+            output = subprocess.check_output(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(batch_job_ids)], universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning("Cannot get the state of the batch jobs: %s", e)
+            return None
+        for line in output.splitlines():
+            fields = line.split("|")
+            if len(fields) == 2 and fields[1].split() and fields[1].split()[0] in SLURM_ACTIVE:
+                # Tasks of job arrays are listed as ID_INDEX
+                active.add(fields[0].split("_")[0])
+        return active
+    if shutil.which("qstat"):
+        for jobid in batch_job_ids:
+            try:
+                output = subprocess.check_output(["qstat", jobid], stderr=subprocess.DEVNULL, universal_newlines=True)
+            except subprocess.CalledProcessError:
+                # Unknown job
+                continue
+            except OSError as e:
+                logging.warning("Cannot get the state of the batch jobs: %s", e)
+                return None
+            # Job ID, name, user, time used, state, queue
+            for line in output.splitlines():
+                fields = line.split()
+                if len(fields) >= 5 and fields[0].split(".")[0] == jobid.split(".")[0] and fields[4] in PBS_ACTIVE:
+                    active.add(jobid)
+        return active
+    return None
+
+def Refresh(ledger, train=None):
+    """Updates the jobs whose outcome is not known yet. Returns the number of jobs that ended."""
+    trains = {row["train"]: row for row in ledger.execute("SELECT * FROM trains")}
+    query = "SELECT * FROM jobs WHERE state = 'submitted'"
+    args = []
+    if train:
+        query += " AND train = ?"
+        args.append(train)
+    jobs = ledger.execute(query, args).fetchall()
+    # Asked before reading the files of the jobs: a batch job that is over wrote them already.
+    # The local backend runs its jobs before they are recorded.
+    batch_job_ids = sorted(set(job["batch_job_id"] for job in jobs if job["batch_job_id"] and not job["batch_job_id"].startswith("local.")))
+    active = GetActiveBatchJobs(batch_job_ids) if batch_job_ids else None
+    nended = 0
+    for job in jobs:
+        state, exit_code, runtime, output_size = CheckJob(trains[job["train"]], job)
+        if state == "submitted" and active is not None and job["batch_job_id"] in batch_job_ids and not job["batch_job_id"] in active:
+            # Killed by the scheduler (time limit, preemption, node failure) before it wrote its outcome
+            logging.info("Job %d of train %s (batch job %s) ended without exit code", job["job"], job["train"], job["batch_job_id"])
+            state = "failed"
+        if state == "submitted":
+            continue
+        ledger.execute("UPDATE jobs SET state = ?, exit_code = ?, runtime = ?, output_size = ?, update_time = ? WHERE train = ? AND job = ?",
+                       (state, exit_code, runtime, output_size, time.time(), job["train"], job["job"]))
+        nended += 1
+    return nended
+
+def GetJobs(ledger, train=None, state=None):
+    query = "SELECT * FROM jobs WHERE 1"
+    args = []
+    if train:
+        query += " AND train = ?"
+        args.append(train)
+    if state:
+        query += " AND state = ?"
+        args.append(state)
+    return ledger.execute(query + " ORDER BY train, job", args).fetchall()
+
+def GetSummary(ledger, train=None):
+    """Number of jobs, output size and runtime by train and state."""
+    query = "SELECT train, state, COUNT(*) AS jobs, SUM(output_size) AS output_size, SUM(runtime) AS runtime FROM jobs"
+    args = []
+    if train:
+        query += " WHERE train = ?"
+        args.append(train)
+    return ledger.execute(query + " GROUP BY train, state ORDER BY train, state", args).fetchall()
+
+def PrintStatus(ledger, args):
+    if args.jobs:
+        print("{:<45} {:>5} {:>16} {:<10} {:>4} {:>9} {:>12} {:>3}".format("train", "job", "batch job", "state", "exit", "runtime", "output size", "try"))
+        for job in GetJobs(ledger, args.train, args.state):
+            print("{:<45} {:>5} {:>16} {:<10} {:>4} {:>9} {:>12} {:>3}".format(job["train"], job["job"], str(job["batch_job_id"]), job["state"],
+                  "" if job["exit_code"] is None else job["exit_code"], "" if job["runtime"] is None else "{:.0f}".format(job["runtime"]),
+                  "" if job["output_size"] is None else job["output_size"], job["attempts"]))
+        return
+    print("{:<45} {:<10} {:>6} {:>14} {:>12}".format("train", "state", "jobs", "output size", "job hours"))
+    for row in GetSummary(ledger, args.train):
+        if args.state and row["state"] != args.state:
+            continue
+        print("{:<45} {:<10} {:>6} {:>14} {:>12.1f}".format(row["train"], row["state"], row["jobs"], row["output_size"] or 0, (row["runtime"] or 0) / 3600.0))
+
+def ResubmitFailed(ledger, args):
+    # Imported here, submitLocalBatch records its submissions in the ledger
+    import submitLocalBatch
+    failed = {}
+    for job in GetJobs(ledger, args.train, "failed"):
+        failed.setdefault(job["train"], []).append(job["job"])
+    if not failed:
+        print("No failed jobs")
+        return 0
+    for train, jobs in sorted(failed.items()):
+        print("Train {}: resubmitting {} failed jobs {}".format(train, len(jobs), " ".join(str(job) for job in jobs)))
+        if args.dry_run:
+            continue
+        params = ledger.execute("SELECT * FROM trains WHERE train = ?", (train,)).fetchone()
+        # The local backend runs the jobs before returning
+        submit_time = time.time()
+        jobids = submitLocalBatch.ResubmitJobs(params, jobs)
+        RecordSubmission(ledger, train, params, jobids, submit_time)
+        # Recorded even if a later train cannot be submitted
+        ledger.commit()
+    return 0
+
+def main(args):
+    if args.local_path:
+        local_path = args.local_path
+    else:
+        local_path = aliuserconfig.LoadUserConfiguration(args.user_conf)["local_path"]
+    if not os.path.isfile(os.path.join(local_path, LEDGER_FILE)):
+        print("No job ledger in {}".format(local_path))
+        return 1
+    with OpenLedger(local_path) as ledger:
+        nended = Refresh(ledger, args.train)
+        logging.info("%d jobs ended since the last update", nended)
+        if args.command == "status":
+            PrintStatus(ledger, args)
+            return 0
+        if not args.failed:
+            print("Nothing to resubmit, use --failed to resubmit the failed jobs")
+            return 1
+        return ResubmitFailed(ledger, args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ledger of the jobs submitted with submitLocalBatch.py.')
+    parser.add_argument('-u', '--user-conf', metavar='USERCONF', default="userConf.yaml")
+    parser.add_argument('--local-path', metavar='DIR', default='', help='Directory of the trains (default: local_path of the user configuration)')
+    parser.add_argument('-d', '--debug', action = "store_true",  help = "Run with increased debug level")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    status_parser = subparsers.add_parser('status', help='Jobs by train and state')
+    status_parser.add_argument('--train', metavar='TRAIN', default=None)
+    status_parser.add_argument('--state', choices=STATES, default=None)
+    status_parser.add_argument('--jobs', action='store_true', help='List the jobs')
+    resubmit_parser = subparsers.add_parser('resubmit', help='Submit jobs again')
+    resubmit_parser.add_argument('--failed', action='store_true', help='Resubmit the failed jobs')
+    resubmit_parser.add_argument('--train', metavar='TRAIN', default=None)
+    resubmit_parser.add_argument('--dry-run', action='store_true', help='Only list the jobs')
+    args = parser.parse_args()
+
+    loglevel=logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    logging.basicConfig(format='[%(levelname)s]: %(message)s', level=loglevel)
+
+    sys.exit(main(args))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Per-phase resource accounting of a job (environment probe, build, POWHEG, HERWIG,
+# PDF installation, simulation), written as a JSON file at the end of the job
+# (also when it fails, or when the batch system ends it with SIGTERM), so that e.g. the events per CPU hour of a configuration
+# can be computed over many jobs.
+#
+# CPU times are the sum of the job process and of its terminated child processes.
+# Bytes read and written are taken from /proc/self/io, which includes the I/O of the
+# terminated children (rchar/wchar: all reads and writes, read_bytes/write_bytes:
+# storage only). The peak RSS of the children is the maximum over all the children
+# terminated so far: it belongs to the phase only if it grew during the phase.
+# Phases can be nested (the PDF installation is part of the HERWIG phase), and with
+# event streaming the generator runs (and is accounted) during the simulation.
+# The progress of the child processes (e.g. the last event counter found in their
+# output, see log_capture.py) is written as well, also if the job is killed.
+
+import atexit
+import json
+import os
+import platform
+import resource
+import signal
+import sys
+import time
+
+IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+
+def ReadProcIO():
+    """I/O counters of the process, empty if not available (not Linux)."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as fin:
+            for line in fin:
+                name, _, value = line.partition(":")
+                if name in IO_FIELDS:
+                    counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+class Snapshot:
+
+    def __init__(self):
+        self.wall = time.time()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = ReadProcIO()
+
+class Phase:
+    """Resources used between the start and the end of a phase (use it as a context manager).
+    The caller sets events_in and events_out."""
+
+    def __init__(self, name):
+        self.name = name
+        self.events_in = None
+        self.events_out = None
+        self.status = "running"
+        self.start = None
+        self.metrics = {}
+
+    def __enter__(self):
+        self.start = Snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.status = "done"
+        elif issubclass(exc_type, SystemExit) and not exc_value.code:
+            self.status = "done"
+        else:
+            self.status = "failed"
+        self.Stop()
+        return False
+
+    def Stop(self):
+        end = Snapshot()
+        start = self.start
+        self.metrics = {
+            "wall_time": end.wall - start.wall,
+            "user_cpu": (end.self_usage.ru_utime - start.self_usage.ru_utime) + (end.children_usage.ru_utime - start.children_usage.ru_utime),
+            "sys_cpu": (end.self_usage.ru_stime - start.self_usage.ru_stime) + (end.children_usage.ru_stime - start.children_usage.ru_stime),
+            "children_user_cpu": end.children_usage.ru_utime - start.children_usage.ru_utime,
+            "children_sys_cpu": end.children_usage.ru_stime - start.children_usage.ru_stime,
+            # ru_maxrss is in kB on Linux
+            "max_rss_kb": end.self_usage.ru_maxrss,
+            "children_max_rss_kb": end.children_usage.ru_maxrss if end.children_usage.ru_maxrss > start.children_usage.ru_maxrss else None,
+            "block_input": (end.self_usage.ru_inblock - start.self_usage.ru_inblock) + (end.children_usage.ru_inblock - start.children_usage.ru_inblock),
+            "block_output": (end.self_usage.ru_oublock - start.self_usage.ru_oublock) + (end.children_usage.ru_oublock - start.children_usage.ru_oublock),
+        }
+        for field in IO_FIELDS:
+            if field in start.io and field in end.io:
+                self.metrics[field] = end.io[field] - start.io[field]
+
+    def ToDict(self):
+        if self.status == "running":
+            # The job ended within the phase (e.g. exit() in a nested function)
+            self.status = "failed"
+            self.Stop()
+        result = {"name": self.name, "status": self.status, "events_in": self.events_in, "events_out": self.events_out}
+        result.update(self.metrics)
+        return result
+
+class JobMetrics:
+
+    def __init__(self):
+        self.start = Snapshot()
+        self.phases = []
+        self.info = {}
+        self.progress = {}
+        self.filename = None
+
+    def Phase(self, name):
+        phase = Phase(name)
+        self.phases.append(phase)
+        return phase
+
+    def RecordProgress(self, name, progress):
+        """progress is a dict updated while the job runs (e.g. LogCapture.progress)."""
+        self.progress[name] = progress
+
+    def ToDict(self):
+        total = Phase("job")
+        total.start = self.start
+        total.status = "done"
+        total.Stop()
+        result = {"host": platform.node(), "start_time": self.start.wall}
+        result.update(self.info)
+        result["phases"] = [phase.ToDict() for phase in self.phases]
+        if self.progress:
+            result["progress"] = {name: dict(progress) for name, progress in self.progress.items()}
+        result["total"] = total.ToDict()
+        return result
+
+    def Save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            return
+        tmpfile = "{}.tmp{}".format(filename, os.getpid())
+        with open(tmpfile, "w") as fout:
+            json.dump(self.ToDict(), fout, indent=2)
+            fout.write("\n")
+        os.replace(tmpfile, filename)
+
+    def SaveAtExit(self, filename):
+        """Writes the metrics to filename when the job ends, whatever the exit code,
+        also when it is terminated (SIGTERM). Called from the main thread."""
+        if self.filename is None:
+            atexit.register(self._SaveAtExit)
+            signal.signal(signal.SIGTERM, self._Terminate)
+        self.filename = os.path.abspath(filename)
+
+    def _Terminate(self, signum, frame):
+        # The batch systems end a job with SIGTERM (e.g. at the time limit), which does not
+        # run the atexit handlers: saved right away, the job may be killed before it exits
+        self._SaveAtExit()
+        raise SystemExit(128 + signum)
+
+    def _SaveAtExit(self):
+        try:
+            self.Save()
+        except (OSError, TypeError, ValueError) as e:
+            sys.stderr.write("Could not write the job metrics to {}: {}\n".format(self.filename, e))
+
+_metrics = JobMetrics()
+
+def GetJobMetrics():
+    """Returns the metrics of the job, shared by all the callers in the process."""
+    return _metrics
+
+def MeasurePhase(name):
+    """Starts a new phase of the job, e.g. with MeasurePhase("build") as phase: ..."""
+    return _metrics.Phase(name)
+
+def RecordProgress(name, progress):
+    _metrics.RecordProgress(name, progress)
@@ -1,14 +1,188 @@
+#!/usr/bin/env python3
+
+# LHAPDF sets: ID -> name table and a PDF set cache shared by the jobs of a node
+# (or of a shared file system). Each set is installed once, under a lock, into a
+# temporary directory that is moved into the cache only after its integrity was
+# checked. Jobs find the cache through LHAPDF_DATA_PATH.
+#
+# Pre-seeding the cache (e.g. on a login node, for compute nodes without network access):
+# ./lhapdf_utils.py seed --cache-dir /shared/lhapdf 11000 10042
+# ./lhapdf_utils.py seed --cache-dir /shared/lhapdf --from /path/to/LHAPDF/share/LHAPDF CT14nlo
+
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+from file_lock import FileLock
+
+# LHAPDF IDs of the first member of the most common sets (see the pdfsets.index of LHAPDF)
+PDF_SETS = {
+    10000: "cteq6",
+    10042: "cteq6l1",
+    10550: "cteq66",
+    10800: "CT10",
+    11000: "CT10nlo",
+    13000: "CT14nnlo",
+    13100: "CT14nlo",
+    13200: "CT14lo",
+    21000: "MSTW2008lo68cl",
+    21100: "MSTW2008nlo68cl",
+    21200: "MSTW2008nnlo68cl",
+    25000: "MMHT2014lo68cl",
+    25100: "MMHT2014nlo68cl",
+    25300: "MMHT2014nnlo68cl",
+    260000: "NNPDF30_nlo_as_0118",
+    261000: "NNPDF30_nnlo_as_0118",
+    263000: "NNPDF30_lo_as_0130",
+    303400: "NNPDF31_nlo_as_0118",
+    303600: "NNPDF31_nnlo_as_0118",
+    315000: "NNPDF31_lo_as_0118",
+    315200: "NNPDF31_lo_as_0130",
+}
+PDFSETS_INDEX = "pdfsets.index"
+INSTALL_TIMEOUT = 1800
+
+def GetDataPath(env=None):
+    """Directories where LHAPDF looks for the PDF sets."""
+    if env is None:
+        env = os.environ
+    return [d for d in env.get("LHAPDF_DATA_PATH", "").split(":") if d]
+
+def LookupPDFSetsIndex(lhapdf_id, data_path):
+    """Looks for lhapdf_id in the pdfsets.index files of the LHAPDF data directories.
+    Each line of the index is "<ID of the first member> <set name> <version>"."""
+    for d in data_path:
+        index = os.path.join(d, PDFSETS_INDEX)
+        if not os.path.isfile(index):
+            continue
+        with open(index) as fin:
+            for line in fin:
+                tokens = line.split()
+                if len(tokens) >= 2 and tokens[0] == str(lhapdf_id):
+                    return tokens[1]
+    return None
+
 def GetPDFName(lhapdf_id, add_extension=True):
-    if lhapdf_id == 11000:
-        pdfname = "CT10nlo"
-    elif lhapdf_id == 10550:
-        pdfname = "cteq66"
-    elif lhapdf_id == 10042:
-        pdfname = "cteq6l1"
+    lhapdf_id = int(lhapdf_id)
+    if lhapdf_id in PDF_SETS:
+        pdfname = PDF_SETS[lhapdf_id]
     else:
+        pdfname = LookupPDFSetsIndex(lhapdf_id, GetDataPath())
+    if not pdfname:
         print("LHAPDF ID {} not known.".format(lhapdf_id))
         exit(1)
 
     if add_extension:
         pdfname += ".LHgrid"
     return pdfname
+
+def CheckPDFSet(setdir, pdfname):
+    """Integrity check of an installed PDF set: the .info file must be present and
+    declare the number of members, and the data file of each member must be
+    present and complete (LHAPDF6 data files end with the block separator ---)."""
+    info = os.path.join(setdir, "{}.info".format(pdfname))
+    if not os.path.isfile(info):
+        return False
+    nmembers = -1
+    with open(info) as fin:
+        for line in fin:
+            if line.startswith("NumMembers:"):
+                nmembers = int(line.split(":")[1])
+                break
+    if nmembers <= 0:
+        return False
+    for imember in range(nmembers):
+        member = os.path.join(setdir, "{}_{:04d}.dat".format(pdfname, imember))
+        if not os.path.isfile(member):
+            return False
+        with open(member, "rb") as fin:
+            fin.seek(0, os.SEEK_END)
+            size = fin.tell()
+            fin.seek(max(0, size - 8))
+            if not fin.read().rstrip().endswith(b"---"):
+                return False
+    return True
+
+def FindPDFSet(pdfname, data_path):
+    """Returns the directory of the PDF set in data_path, or None if it is not installed."""
+    for d in data_path:
+        setdir = os.path.join(d, pdfname)
+        if os.path.isfile(os.path.join(setdir, "{}.info".format(pdfname))):
+            return setdir
+    return None
+
+def InstallPDFSet(cache_dir, pdfname, source_dir=None, env=None, logfile=None):
+    """Installs the PDF set pdfname into cache_dir, if it is not already there.
+    The set is copied from source_dir if given, otherwise downloaded with the
+    lhapdf tool. Only one process installs a given set, the others wait for
+    the lock and use it afterwards. Returns True if the set is available."""
+    setdir = os.path.join(cache_dir, pdfname)
+    if CheckPDFSet(setdir, pdfname):
+        return True
+    os.makedirs(cache_dir, exist_ok=True)
+    with FileLock(os.path.join(cache_dir, ".{}.lock".format(pdfname))):
+        if CheckPDFSet(setdir, pdfname):
+            return True
+        if os.path.exists(setdir):
+            print("PDF set '{}' in '{}' is corrupted, installing it again.".format(pdfname, cache_dir))
+            shutil.rmtree(setdir)
+        tmpdir = os.path.join(cache_dir, ".install_{}_{}".format(pdfname, os.getpid()))
+        os.makedirs(tmpdir)
+        try:
+            if source_dir:
+                print("Copying PDF set '{}' from '{}' to '{}'".format(pdfname, source_dir, cache_dir))
+                shutil.copytree(os.path.join(source_dir, pdfname), os.path.join(tmpdir, pdfname))
+            else:
+                print("Installing PDF set '{}' in '{}'".format(pdfname, cache_dir))
+                subprocess.call(["lhapdf", "--pdfdir={}".format(tmpdir), "install", pdfname], stdout=logfile, stderr=logfile, env=env, timeout=INSTALL_TIMEOUT)
+            if not CheckPDFSet(os.path.join(tmpdir, pdfname), pdfname):
+                print("Installation of the PDF set '{}' failed!".format(pdfname))
+                return False
+            os.rename(os.path.join(tmpdir, pdfname), setdir)
+        except (OSError, subprocess.SubprocessError) as e:
+            print("Installation of the PDF set '{}' failed: {}".format(pdfname, e))
+            return False
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return True
+
+def SetupPDFSet(lhapdf_id, cache_dir, env=None, logfile=None):
+    """Makes the PDF set lhapdf_id available to LHAPDF: if it is not part of the
+    release, it is installed in the shared cache_dir. Returns the value of
+    LHAPDF_DATA_PATH to be used (None if the set is not available)."""
+    data_path = GetDataPath(env)
+    pdfname = GetPDFName(lhapdf_id, False)
+    if FindPDFSet(pdfname, data_path):
+        print("PDF '{}' already installed.".format(pdfname))
+        return ":".join(data_path)
+    if not InstallPDFSet(cache_dir, pdfname, env=env, logfile=logfile):
+        return None
+    return ":".join([os.path.abspath(cache_dir)] + data_path)
+
+def main(args):
+    if args.command == "seed":
+        ok = True
+        for pdf in args.pdfsets:
+            pdfname = GetPDFName(pdf, False) if pdf.isdigit() else pdf
+            ok = InstallPDFSet(args.cache_dir, pdfname, args.source) and ok
+        return 0 if ok else 1
+    elif args.command == "check":
+        ok = True
+        for setdir in sorted(glob.glob(os.path.join(args.cache_dir, "*", "*.info"))):
+            pdfname = os.path.basename(os.path.dirname(setdir))
+            status = CheckPDFSet(os.path.dirname(setdir), pdfname)
+            print("{:30s} {}".format(pdfname, "OK" if status else "CORRUPTED"))
+            ok = ok and status
+        return 0 if ok else 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared LHAPDF set cache.')
+    parser.add_argument('command', choices=["seed", "check"], help='seed: install PDF sets in the cache, check: check the integrity of the cache')
+    parser.add_argument('pdfsets', metavar='PDF', nargs='*', help='LHAPDF IDs or set names')
+    parser.add_argument('--cache-dir', metavar='DIR', required=True)
+    parser.add_argument('--from', metavar='DIR', dest='source', default=None, help='Copy the sets from this LHAPDF data directory instead of downloading them')
+    args = parser.parse_intermixed_args()
+
+    sys.exit(main(args))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Utilities to handle the Les Houches Event (LHE) files produced by POWHEG
+
+import array
+import os
+import re
+import event_index
+
+EMPTY_EVENT = b"<event>\n      0  10001  1.0  1.0 -1.00000E+00  1.0\n</event>\n"
+LHE_FOOTER = b"</LesHouchesEvents>\n"
+LHE_TAGS = re.compile(rb"^(<init>|</init>|<event>|<event\s|</event>)", re.M)
+JOURNAL_SUFFIX = ".tail"
+TAIL_CHUNK_SIZE = 64 * 1024
+MAX_TAIL_SIZE = 16 * 1024 * 1024
+
+def IsEmptyEventHeader(header):
+    tokens = header.split()
+    return len(tokens) > 0 and tokens[0] == "0"
+
+def IndexLHEFile(lhefile):
+    """Builds the event index of an LHE file in a single pass."""
+    offsets = array.array("Q")
+    init = [-1, -1]
+    events_end = -1
+    with event_index.OpenEventFile(lhefile) as fin:
+        for start, eol, tag in event_index.ScanRecords(fin, LHE_TAGS):
+            if tag.startswith(b"<event"):
+                # Events follow the <init> block, anything before is part of the header
+                if init[1] >= 0:
+                    offsets.append(start)
+            elif tag == b"</event>":
+                events_end = eol
+            elif tag == b"<init>":
+                init[0] = start
+            elif tag == b"</init>":
+                init[1] = eol
+        # The whole (decompressed) content was read
+        size = fin.tell()
+    if len(offsets) > 0:
+        header_end = offsets[0]
+    else:
+        header_end = init[1]
+    if events_end < 0:
+        events_end = header_end
+    index = event_index.EventIndex(lhefile, offsets, header_end, events_end, {"init": init}, size)
+    UpdateLastEventHeader(index)
+    return index
+
+def UpdateLastEventHeader(index):
+    """Stores the header line (the line following <event>) of the last event in the index."""
+    if index.nevents == 0:
+        index.info["last_event_header"] = ""
+        return
+    lines = index.ReadEvent(index.nevents - 1).decode().splitlines()
+    if len(lines) > 1:
+        index.info["last_event_header"] = lines[1].strip()
+    else:
+        index.info["last_event_header"] = ""
+
+def GetLHEIndex(lhefile):
+    """Returns the event index of an LHE file, loading it from the sidecar file
+    if it is up to date, otherwise scanning the LHE file and saving the index."""
+    index = event_index.EventIndex.Load(lhefile)
+    if index:
+        return index
+    index = IndexLHEFile(lhefile)
+    index.Save()
+    return index
+
+def HasEmptyEvent(index):
+    return IsEmptyEventHeader(index.info.get("last_event_header", ""))
+
+def GetNumberOfEvents(index):
+    """Number of events in the LHE file, not counting the empty event added at the end."""
+    nevents = index.nevents
+    if HasEmptyEvent(index):
+        nevents -= 1
+    return nevents
+
+def FindLastTag(fin, tag, end, max_bytes=MAX_TAIL_SIZE):
+    """Reads the file backwards from offset end and returns the offset of the
+    last line starting with tag, or -1 if it is not found within max_bytes."""
+    pos = end
+    buf = b""
+    while pos > 0 and len(buf) < max_bytes:
+        step = min(TAIL_CHUNK_SIZE, pos)
+        pos -= step
+        fin.seek(pos)
+        buf = fin.read(step) + buf
+        i = buf.rfind(b"\n" + tag)
+        if i >= 0:
+            return pos + i + 1
+    if pos == 0 and buf.startswith(tag):
+        return 0
+    return -1
+
+def GetJournalFileName(lhefile):
+    return lhefile + JOURNAL_SUFFIX
+
+def WriteJournal(lhefile, offset, tail):
+    """Saves the end of the LHE file (from offset) before it is overwritten. The journal
+    is written to a temporary file and moved into place, so that it either exists
+    complete or not at all. Its header holds the offset and the length of the tail."""
+    journal = GetJournalFileName(lhefile)
+    tmpfile = "{}.tmp{}".format(journal, os.getpid())
+    with open(tmpfile, "wb") as fout:
+        fout.write("{} {}\n".format(offset, len(tail)).encode())
+        fout.write(tail)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmpfile, journal)
+
+def RecoverLHEFile(lhefile):
+    """Restores the end of an LHE file from the journal left behind by an
+    interrupted AppendEmptyEvent. Returns True if the file was recovered."""
+    journal = GetJournalFileName(lhefile)
+    if not os.path.isfile(journal):
+        return False
+    with open(journal, "rb") as fin:
+        try:
+            offset, length = [int(field) for field in fin.readline().split()]
+        except ValueError:
+            offset, length = -1, -1
+        tail = fin.read()
+    if offset < 0 or len(tail) != length:
+        # Not a complete journal: the LHE file was not touched yet
+        print("Ignoring the incomplete journal '{}' of the LHE file '{}'".format(journal, lhefile))
+        os.remove(journal)
+        return False
+    print("Recovering the end of the LHE file '{}' from '{}'".format(lhefile, journal))
+    with open(lhefile, "r+b") as fout:
+        fout.seek(offset)
+        fout.write(tail)
+        fout.truncate()
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.remove(journal)
+    return True
+
+def AppendEmptyEvent(lhefile):
+    """Adds an empty event after the last event of an LHE file, in place.
+    The file is read backwards from the end, so that memory usage and I/O
+    do not depend on the size of the file. The part of the file following
+    the last event (i.e. </LesHouchesEvents>) is saved in a journal before
+    being overwritten, so that an interrupted write can be undone with
+    RecoverLHEFile. Returns False if no event was found in the file."""
+    if event_index.GetCompression(lhefile):
+        return AppendEmptyEventCompressed(lhefile)
+    RecoverLHEFile(lhefile)
+    index = event_index.EventIndex.Load(lhefile)
+    with open(lhefile, "r+b") as fout:
+        fout.seek(0, os.SEEK_END)
+        size = fout.tell()
+        last_stop = FindLastTag(fout, b"</event>", size)
+        if last_stop < 0:
+            print("Could not find </event> in the LHE file '{}'!".format(lhefile))
+            return False
+        last_start = FindLastTag(fout, b"<event", last_stop)
+        fout.seek(last_stop)
+        fout.readline()
+        insert_pos = fout.tell()
+        if size - insert_pos > MAX_TAIL_SIZE:
+            print("Unexpected content after the last event in the LHE file '{}'!".format(lhefile))
+            return False
+        tail = fout.read()
+
+        # Check whether the empty event already exists
+        if last_start >= 0:
+            fout.seek(last_start)
+            fout.readline()
+            header = fout.readline().decode().strip()
+            if IsEmptyEventHeader(header):
+                print("Empty event already present in the LHE file '{}'!".format(lhefile))
+                print(header)
+                return True
+
+        WriteJournal(lhefile, insert_pos, tail)
+        fout.seek(insert_pos)
+        fout.write(EMPTY_EVENT)
+        fout.write(tail)
+        fout.truncate()
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.remove(GetJournalFileName(lhefile))
+
+    if index:
+        index.AppendEvent(insert_pos, insert_pos + len(EMPTY_EVENT))
+        UpdateLastEventHeader(index)
+        index.UpdateSourceStat()
+        index.Save()
+    return True
+
+def AppendEmptyEventCompressed(lhefile):
+    """A compressed LHE file cannot be modified in place: it is decompressed and
+    compressed again with the empty event, in a single streaming pass.
+    Prefer handing compressed files to the simulation through CreateLHEShardView,
+    which adds the empty event on the fly."""
+    index = GetLHEIndex(lhefile)
+    if index.nevents == 0:
+        print("Could not find any event in the LHE file '{}'!".format(lhefile))
+        return False
+    if HasEmptyEvent(index):
+        print("Empty event already present in the LHE file '{}'!".format(lhefile))
+        return True
+    tmpfile = "{}.tmp{}{}".format(event_index.StripCompressionSuffix(lhefile), os.getpid(), event_index.GetCompression(lhefile))
+    try:
+        event_index.WriteShard(index, 0, 1, tmpfile, index.nevents, EMPTY_EVENT)
+        os.replace(tmpfile, lhefile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    insert_pos = index.events_end
+    index.AppendEvent(insert_pos, insert_pos + len(EMPTY_EVENT))
+    index.data_size += len(EMPTY_EVENT)
+    index.info["last_event_header"] = EMPTY_EVENT.splitlines()[1].decode().strip()
+    index.UpdateSourceStat()
+    index.Save()
+    return True
+
+def ConcatenateLHEFiles(lhefile, others):
+    """Appends the events of the LHE files others (e.g. produced by POWHEG with other
+    seeds) to lhefile, in place, keeping only the header and the <init> block of
+    lhefile. The events are copied in the kernel (copy_file_range) and the event
+    index is extended without scanning the result. Compressed files and files
+    with an empty event at the end are not supported. Returns the number of events."""
+    index = event_index.ConcatenateEventFiles(GetLHEIndex(lhefile), [GetLHEIndex(other) for other in others])
+    UpdateLastEventHeader(index)
+    index.Save()
+    return index.nevents
+
+def WriteLHEShard(index, ishard, nshards, output):
+    """Writes shard ishard of nshards of an LHE file to output. The shard keeps
+    the <init> block and ends with its own empty event. Returns the number of
+    events in the shard (not counting the empty event)."""
+    return event_index.WriteShard(index, ishard, nshards, output, GetNumberOfEvents(index), EMPTY_EVENT)
+
+def CreateLHEShardView(index, ishard, nshards, fifo):
+    """Returns a (not yet started) ShardWriter feeding shard ishard of nshards
+    of an LHE file into the FIFO fifo, and the number of events in the shard."""
+    nevents = GetNumberOfEvents(index)
+    first, last = event_index.GetShardEventRange(nevents, ishard, nshards)
+    return event_index.ShardWriter(index, ishard, nshards, fifo, nevents, EMPTY_EVENT), last - first
+
+class LHEStreamRelay(event_index.StreamRelay):
+    """Relays the LHE events written by POWHEG to the simulation. Only complete
+    events are forwarded. At the end of the POWHEG output an empty event is
+    added before </LesHouchesEvents>, which stops PYTHIA cleanly (like
+    AppendEmptyEvent does for LHE files on disk)."""
+
+    def Relay(self, infd, outfd):
+        carry = b""
+        while True:
+            chunk = os.read(infd, event_index.CHUNK_SIZE)
+            if not chunk:
+                break
+            data = carry + chunk
+            footer = data.find(b"</LesHouchesEvents>")
+            if footer >= 0:
+                self.Forward(outfd, data[:footer])
+                carry = b""
+                self.complete = True
+                break
+            cut = data.rfind(b"</event>\n")
+            if cut < 0:
+                carry = data
+                continue
+            cut += len(b"</event>\n")
+            self.Forward(outfd, data[:cut])
+            carry = data[cut:]
+        if self.nevents == 0:
+            # Header and <init> block, without the beginning of a first event
+            init_end = carry.find(b"</init>\n")
+            if init_end >= 0:
+                self.Forward(outfd, carry[:init_end + len(b"</init>\n")])
+            else:
+                event_start = carry.find(b"<event")
+                self.Forward(outfd, carry if event_start < 0 else carry[:event_start])
+        # An incomplete event left by a POWHEG crash is dropped
+        event_index.WriteAll(outfd, EMPTY_EVENT + LHE_FOOTER)
+
+    def Forward(self, outfd, data):
+        self.nevents += data.count(b"</event>")
+        event_index.WriteAll(outfd, data)
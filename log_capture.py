@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Capture of the output of the child processes of a job (generators, simulation).
+# A LogCapture is used like a log file opened for writing: child processes get it
+# as stdout/stderr (it is the write end of a pipe) and the job can write its own
+# messages to it. A thread streams the output to the log file, which is rotated
+# when it exceeds a size cap (the previous part is kept as <log>.1, so at most twice
+# the cap is kept on disk and the grid log archive, *.log, only gets the last part).
+# The last lines are kept in memory for the failure reports, and the last value of
+# a few progress lines (e.g. event counters) is extracted while the job runs.
+
+import collections
+import os
+import re
+import threading
+
+# Size (bytes) above which a log file is rotated
+MAX_LOG_SIZE = 100 * 1024 ** 2
+# Number of lines kept in memory (and printed in the failure reports)
+TAIL_LINES = 100
+# Longer lines are cut (e.g. output without line breaks)
+MAX_LINE_LENGTH = 64 * 1024
+READ_SIZE = 64 * 1024
+
+# Progress lines: the last match of each pattern is kept, its first group as an integer
+# (True if the pattern has no group). Lines are split at \n and \r (progress bars).
+POWHEG_PROGRESS = {"events": re.compile(rb"events generated\s*:?\s*(\d+)", re.I)}
+HERWIG_PROGRESS = {"events": re.compile(rb"event>\s*(\d+)")}
+SIMULATION_PROGRESS = {"lhe_events_read": re.compile(rb"^\s*I\s+0\s+All included subprocesses\s+I\s+\d+\s+(\d+)\s+I"),
+                       "end_of_lhe_file": re.compile(rb"The end of the LHE file was reached")}
+LINE_BREAKS = re.compile(rb"[\r\n]")
+
+class LogCapture:
+
+    def __init__(self, logfile, progress_patterns=None, max_size=None, tail_lines=TAIL_LINES):
+        self.logfile = logfile
+        self.max_size = max_size if max_size else MAX_LOG_SIZE
+        self.patterns = progress_patterns if progress_patterns else {}
+        # All the keys exist from the start, the values are updated by the reader thread
+        self.progress = {name: None for name in self.patterns}
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lock = threading.Lock()
+        self.fout = open(logfile, "wb")
+        self.size = 0
+        self.carry = b""
+        self.rfd, self.wfd = os.pipe()
+        self.thread = threading.Thread(target=self.Read, name="log {}".format(os.path.basename(logfile)), daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def fileno(self):
+        """Write end of the pipe, given to the child processes as stdout/stderr."""
+        return self.wfd
+
+    def write(self, text):
+        """Messages of the job itself, written to the log file directly."""
+        self.Store(text.encode() if isinstance(text, str) else text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Closes the write end of the pipe of the job. The output of the child
+        processes still running keeps being captured until they exit."""
+        if self.wfd >= 0:
+            os.close(self.wfd)
+            self.wfd = -1
+
+    def Wait(self, timeout=None):
+        """Waits until all the child processes closed their output (i.e. exited) and
+        the log file is complete. Returns False if it timed out."""
+        self.close()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def Read(self):
+        try:
+            while True:
+                data = os.read(self.rfd, READ_SIZE)
+                if not data:
+                    break
+                self.Store(data)
+            if self.carry:
+                self.AddLine(self.carry)
+                self.carry = b""
+        finally:
+            os.close(self.rfd)
+            with self.lock:
+                self.fout.close()
+
+    def Store(self, data):
+        with self.lock:
+            if self.fout.closed:
+                return
+            if self.size > 0 and self.size + len(data) > self.max_size:
+                self.Rotate()
+            self.fout.write(data)
+            self.fout.flush()
+            self.size += len(data)
+            lines = LINE_BREAKS.split(self.carry + data)
+            self.carry = lines.pop()[:MAX_LINE_LENGTH]
+            for line in lines:
+                if line:
+                    self.AddLine(line[:MAX_LINE_LENGTH])
+
+    def Rotate(self):
+        self.fout.close()
+        os.replace(self.logfile, "{}.1".format(self.logfile))
+        self.fout = open(self.logfile, "wb")
+        self.size = 0
+
+    def AddLine(self, line):
+        self.tail.append(line)
+        for name, pattern in self.patterns.items():
+            match = pattern.search(line)
+            if match:
+                self.progress[name] = int(match.group(1)) if pattern.groups else True
+
+    def Tail(self):
+        """Last lines of the output."""
+        with self.lock:
+            return [line.decode(errors="replace") for line in self.tail]
+
+def TailFile(logfile, nlines=TAIL_LINES, max_bytes=READ_SIZE * 16):
+    """Last lines of a log file, reading at most max_bytes from its end."""
+    with open(logfile, "rb") as fin:
+        fin.seek(0, os.SEEK_END)
+        size = fin.tell()
+        fin.seek(max(0, size - max_bytes))
+        lines = fin.read().decode(errors="replace").splitlines()
+    if size > max_bytes and lines:
+        # The first line is probably incomplete
+        lines = lines[1:]
+    return lines[-nlines:]
+
+def PrintTail(lines, title):
+    print("{} (last {} lines):".format(title, len(lines)))
+    for line in lines:
+        print(line)
@@ -1,46 +1,133 @@
 #! /usr/bin/env python
+# Task farm running the jobs of a train inside a single MPI allocation: rank 0 is
+# the manager, it hands out the job numbers to the other ranks (the workers), which
+# ask for the next job as soon as they finished the previous one. The allocation
+# can therefore process more jobs than it has workers, and slow jobs do not keep
+# the other slots idle. The status of each job is written by the manager to
+# mpi_task_status.json in the work directory.
+#
+# srun -n NSLOTS python mpiwrapper.py NJOBS JOBOFFSET ENVSCRIPT WORKDIR "TASK" LOGFILETEMPLATE
 from mpi4py import MPI
+import json
 import logging
 import os
+import socket
 import subprocess
 import sys
+import time
 
-repo = os.path.dirname(sys.argv[0])
+repo = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+# Message tags: a worker sends READY (with the status of its previous job, if any),
+# the manager answers with TASK (the next job number) or STOP
+TAG_READY = 1
+TAG_TASK = 2
+TAG_STOP = 3
+
+STATUS_FILE = "mpi_task_status.json"
 
 def run_local_job(workdir, envscript, task, logfile):
     logging.info("Running \"%s\", logging to %s", task, logfile)
-    subprocess.call("shifter %s/shifterrun.sh %s %s \"%s\" &> %s" %(repo, envscript, workdir, task, logfile), shell=True)
+    with open(logfile, "w") as logwriter:
+        return subprocess.call(["shifter", "%s/shifterrun.sh" %repo, envscript, workdir, task], stdout=logwriter, stderr=subprocess.STDOUT)
 
 def adapt_jobid(content, jobid):
     result = content
     return result.replace("RANK", "%04d" %jobid)
 
-def cleanup(envscript, jobid):
+def cleanup(workdir, envscript, jobid):
+    # Same files as alifastsim/Tools.py write_clean_command (not imported: runs with the python 2 of the MPI job)
     FilesToDelete = []
     if "herwig" in envscript:
-        FilesToDelete.append("events_%04d.hepmc" %jobid)
-        FilesToDelete.append("herwig_%04d.in" %jobid)
-        FilesToDelete.append("herwig_%04d.run" %jobid)
+        for suffix in ["", ".gz", ".zst"]:
+            FilesToDelete.append("events_%04d.hepmc%s" %(jobid, suffix))
+            FilesToDelete.append("events_%04d.hepmc%s.idx" %(jobid, suffix))
+        FilesToDelete.append("herwig_setup_%04d.in" %jobid)
     elif "powheg" in envscript:
-        FilesToDelete.append("pwgevents-%04d.lhe" %jobid)
-        FilesToDelete.append("pwgevents-%04d.lhe.bak" %jobid)
+        for suffix in ["", ".gz", ".zst"]:
+            FilesToDelete.append("pwgevents-%04d.lhe%s" %(jobid, suffix))
+            FilesToDelete.append("pwgevents-%04d.lhe%s.idx" %(jobid, suffix))
     for f in FilesToDelete:
-        os.remove(f)
+        f = os.path.join(workdir, f)
+        if os.path.exists(f):
+            os.remove(f)
+
+def process_job(jobid, envscript, workdir, task, logfiletemplate):
+    """Runs a job and returns its status."""
+    start = time.time()
+    returncode = run_local_job(workdir, envscript, adapt_jobid(task, jobid), adapt_jobid(logfiletemplate, jobid))
+    cleanup(workdir, envscript, jobid)
+    return {"jobid": jobid, "returncode": returncode, "host": socket.gethostname(), "rank": MPI.COMM_WORLD.Get_rank(),
+            "start": start, "runtime": time.time() - start}
+
+def write_status(workdir, status):
+    statusfile = os.path.join(workdir, STATUS_FILE)
+    tmpfile = "%s.tmp%d" %(statusfile, os.getpid())
+    with open(tmpfile, "w") as statuswriter:
+        json.dump(status, statuswriter, indent=2, sort_keys=True)
+    os.rename(tmpfile, statusfile)
+
+def manager(comm, jobs, workdir):
+    """Hands out the jobs to the workers and collects their status. Returns the number of failed jobs."""
+    status = {}
+    for jobid in jobs:
+        status["%04d" %jobid] = {"jobid": jobid, "state": "pending"}
+    write_status(workdir, status)
+    pending = list(jobs)
+    nworkers = comm.Get_size() - 1
+    mpistatus = MPI.Status()
+    while nworkers:
+        result = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_READY, status=mpistatus)
+        worker = mpistatus.Get_source()
+        if result:
+            result["state"] = "done" if result["returncode"] == 0 else "failed"
+            status["%04d" %result["jobid"]] = result
+            logging.info("Job %d finished on worker %d with return code %d after %.0f s", result["jobid"], worker, result["returncode"], result["runtime"])
+        if pending:
+            jobid = pending.pop(0)
+            status["%04d" %jobid] = {"jobid": jobid, "state": "running", "rank": worker, "start": time.time()}
+            comm.send(jobid, dest=worker, tag=TAG_TASK)
+        else:
+            comm.send(None, dest=worker, tag=TAG_STOP)
+            nworkers -= 1
+        write_status(workdir, status)
+    failed = [jobstatus["jobid"] for jobstatus in status.values() if jobstatus["state"] != "done"]
+    logging.info("%d jobs done, %d failed %s", len(jobs) - len(failed), len(failed), sorted(failed))
+    return len(failed)
+
+def worker(comm, envscript, workdir, task, logfiletemplate):
+    result = None
+    mpistatus = MPI.Status()
+    while True:
+        comm.send(result, dest=0, tag=TAG_READY)
+        jobid = comm.recv(source=0, tag=MPI.ANY_TAG, status=mpistatus)
+        if mpistatus.Get_tag() == TAG_STOP:
+            break
+        result = process_job(jobid, envscript, workdir, task, logfiletemplate)
 
 if __name__ == "__main__":
-    njobs = sys.argv[1]
-    if MPI.COMM_WORLD.Get_rank() >= njobs:
-        sys.exit(0)     # More CPUs than jobs due to whole node allocation
     logging.basicConfig(format='[%(levelname)s]: %(message)s', level=logging.INFO)
-    logging.info("Starting worker %d ...", MPI.COMM_WORLD.Get_rank())
-    taskoffset = sys.argv[2]
+    njobs = int(sys.argv[1])
+    taskoffset = int(sys.argv[2])
     envscript = sys.argv[3]
     workdir = sys.argv[4]
     task = sys.argv[5]
     logfiletemplate = sys.argv[6]
-    jobid = MPI.COMM_WORLD.Get_rank()
-    workertask = adapt_jobid(task, jobid)
-    logfile = adapt_jobid(logfiletemplate, jobid)
-    run_local_job(workdir, envscript, workertask, logfile)
-    cleanup(envscript, jobid)
-    logging.info("Worker %d done", jobid)
+    jobs = list(range(taskoffset, njobs + taskoffset))
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    if comm.Get_size() == 1:
+        # No worker: the only rank runs all the jobs
+        results = [process_job(jobid, envscript, workdir, task, logfiletemplate) for jobid in jobs]
+        sys.exit(1 if any(result["returncode"] != 0 for result in results) else 0)
+    if rank == 0:
+        logging.info("Manager: %d jobs for %d workers", njobs, comm.Get_size() - 1)
+        nfailed = manager(comm, jobs, workdir)
+    else:
+        logging.info("Starting worker %d ...", rank)
+        worker(comm, envscript, workdir, task, logfiletemplate)
+        logging.info("Worker %d done", rank)
+        nfailed = 0
+    # The exit code of srun (and of the batch job) tells if all the jobs succeeded
+    nfailed = comm.bcast(nfailed, root=0)
+    sys.exit(1 if nfailed else 0)
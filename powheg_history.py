@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# History of the LHE events consumed by the simulation of POWHEG jobs, used to
+# derive the smallest safe powheg_buffer (the fraction of events POWHEG generates
+# on top of the requested ones, so that PYTHIA does not run out of LHE events).
+#
+# Each POWHEG job records in its job metrics (job_metrics*.json, key "powheg_events")
+# the number of events it had to simulate, the number of LHE events available and
+# the number of LHE events PYTHIA read (taken from the PYSTAT(1) table in the
+# simulation output by log_capture.py), together with a key of the configuration. The submit tools
+# collect the records of the same configuration under local_path.
+#
+# ./powheg_history.py config.yaml --history /path/to/local_path
+
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import math
+import os
+import sys
+import yaml
+
+# Minimum number of jobs needed to derive the buffer
+MIN_HISTORY_JOBS = 10
+# Added to the largest buffer needed by a job of the history
+SAFETY_MARGIN = 0.01
+# Directories below a train directory searched for job metrics (e.g. output/<job> of grid trains)
+HISTORY_DEPTH = 2
+
+def GetConfigurationKey(config):
+    """Key of the settings the LHE event consumption depends on (generator, process,
+    beams, PDF and POWHEG settings, except for the number of seeds per job)."""
+    settings = {name: config.get(name) for name in ["gen", "proc", "beam_type", "ebeam1", "ebeam2", "lhans"]}
+    settings["powheg_config"] = {name: value for name, value in config.get("powheg_config", {}).items() if name != "seeds_per_job"}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:20]
+
+def CreateRecord(config, events, lhe_events, progresses):
+    """Record of a job that simulated events out of lhe_events LHE events, from the
+    progress of its simulations (one per worker, see log_capture.SIMULATION_PROGRESS,
+    recorded in the job metrics). Returns None if a simulation did not print its
+    PYSTAT(1) table."""
+    consumed = 0
+    end_of_file = False
+    for progress in progresses:
+        if progress.get("lhe_events_read") is None:
+            return None
+        consumed += progress["lhe_events_read"]
+        end_of_file = end_of_file or bool(progress.get("end_of_lhe_file"))
+    if not progresses:
+        return None
+    return {"key": GetConfigurationKey(config), "events": events, "lhe_events": lhe_events, "lhe_events_consumed": consumed, "end_of_lhe_file": end_of_file}
+
+def ReadHistory(config, history_dir):
+    """Records of the jobs run with the same configuration, from the job metrics found in the
+    trains of the same generator and process under history_dir (FastSim_<gen>_<proc>_<ts>,
+    at most HISTORY_DEPTH directories below the train directory)."""
+    key = GetConfigurationKey(config)
+    records = []
+    traindir = glob.escape("FastSim_{}_{}_".format(config.get("gen"), config.get("proc"))) + "*"
+    patterns = [os.path.join(glob.escape(history_dir), traindir, *(["*"] * depth), "job_metrics*.json") for depth in range(HISTORY_DEPTH + 1)]
+    for fname in itertools.chain.from_iterable(glob.iglob(pattern) for pattern in patterns):
+        try:
+            with open(fname) as fin:
+                record = json.load(fin).get("powheg_events")
+        except (OSError, ValueError):
+            continue
+        if record and record.get("key") == key and record.get("events", 0) > 0:
+            records.append(record)
+    return records
+
+def GetNeededBuffer(record):
+    """Buffer the job needed. For a job that ran out of LHE events it is only known
+    to be larger than the buffer it had (the safety margin is added by GetPowhegBuffer)."""
+    if record["end_of_lhe_file"]:
+        return float(record["lhe_events"]) / record["events"] - 1.0
+    return float(record["lhe_events_consumed"]) / record["events"] - 1.0
+
+def GetPowhegBuffer(config, history_dir, min_jobs=MIN_HISTORY_JOBS):
+    """Smallest buffer that would have been enough for all the jobs of the history,
+    plus a safety margin, rounded up to 0.1%. Returns None if the history has
+    less than min_jobs jobs with this configuration."""
+    records = ReadHistory(config, history_dir)
+    if len(records) < min_jobs:
+        return None
+    buffer = max(0.0, max(GetNeededBuffer(record) for record in records) + SAFETY_MARGIN)
+    return math.ceil(buffer * 1000) / 1000.0
+
+def main(args):
+    with open(args.config) as fin:
+        config = yaml.load(fin, yaml.SafeLoader)
+    records = ReadHistory(config, args.history)
+    print("{} jobs with this configuration ({}) found in {}".format(len(records), GetConfigurationKey(config), args.history))
+    if records:
+        needed = [GetNeededBuffer(record) for record in records]
+        print("Needed buffer: min {:.2f}%, max {:.2f}%, {} jobs ran out of LHE events".format(min(needed) * 100, max(needed) * 100,
+              len([record for record in records if record["end_of_lhe_file"]])))
+    buffer = GetPowhegBuffer(config, args.history, args.min_jobs)
+    if buffer is None:
+        print("Not enough jobs to derive the POWHEG buffer (at least {} needed)".format(args.min_jobs))
+        return 1
+    print("powheg_buffer: {}".format(buffer))
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='POWHEG buffer derived from the LHE events consumed by previous jobs.')
+    parser.add_argument('config', metavar='config.yaml', help='YAML configuration file')
+    parser.add_argument('--history', metavar='DIR', required=True, help='Directory with the job metrics of previous trains (e.g. local_path)')
+    parser.add_argument('--min-jobs', metavar='N', default=MIN_HISTORY_JOBS, type=int)
+    args = parser.parse_args()
+
+    sys.exit(main(args))
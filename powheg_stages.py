@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Transition between two stages of a POWHEG train submitted as a pipeline of batch
+# jobs (submitLocalBatch.py --powheg-pipeline): run as a batch job depending on
+# the jobs of the previous stage, it checks that each of them produced its output
+# and installs the input file of the next stage as powheg.input. It fails if an
+# output is missing, so that the jobs of the next stage (depending on it) never run.
+#
+# ./powheg_stages.py TRAIN_DIR --stage 2 --check-stage 1 --check-xgrid-iter 3 --check-jobs 10
+
+import argparse
+import os
+import shutil
+import sys
+from alifastsim import GeneratePowhegInput as alipowhegtools
+
+# Output file of each job of stages 1 (per x-grid iteration), 2 and 3
+STAGE_OUTPUTS = {1: "pwggridinfo-btl-xg{xgrid_iter}-{job:04d}.dat", 2: "pwggrid-{job:04d}.dat", 3: "pwgubound-{job:04d}.dat"}
+
+def GetStageSteps(xgrid_iterations=3):
+    """Steps (stage, x-grid iteration) of a POWHEG train, stage 4 being the event generation and the simulation."""
+    return [(1, xgrid_iter) for xgrid_iter in range(1, xgrid_iterations + 1)] + [(2, 1), (3, 1), (4, 1)]
+
+def GetMissingOutputs(workdir, powheg_stage, xgrid_iter, njobs, joboffset=1):
+    """Output files of the jobs of a stage that are missing or empty."""
+    missing = []
+    for job in range(joboffset, njobs + joboffset):
+        output = os.path.join(workdir, STAGE_OUTPUTS[powheg_stage].format(xgrid_iter=xgrid_iter, job=job))
+        if not os.path.isfile(output) or os.path.getsize(output) == 0:
+            missing.append(output)
+    return missing
+
+def InstallStageInput(workdir, powheg_stage, xgrid_iter=1):
+    """Installs the input file of a stage (generated at submission) as powheg.input."""
+    source = os.path.join(workdir, alipowhegtools.GetParallelInputFileName(powheg_stage, xgrid_iter))
+    tmpfile = os.path.join(workdir, "powheg.input.tmp{}".format(os.getpid()))
+    shutil.copy(source, tmpfile)
+    os.replace(tmpfile, os.path.join(workdir, "powheg.input"))
+    print("Installed {} as powheg.input".format(source))
+
+def main(args):
+    if args.check_stage:
+        missing = GetMissingOutputs(args.workdir, args.check_stage, args.check_xgrid_iter, args.check_jobs)
+        if missing:
+            print("POWHEG stage {} (x-grid iteration {}): {} of {} outputs missing:".format(args.check_stage, args.check_xgrid_iter, len(missing), args.check_jobs))
+            for output in missing:
+                print(output)
+            return 1
+        print("POWHEG stage {} (x-grid iteration {}): all {} outputs found".format(args.check_stage, args.check_xgrid_iter, args.check_jobs))
+    InstallStageInput(args.workdir, args.stage, args.xgrid_iter)
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the outputs of a POWHEG stage and prepares the next one.')
+    parser.add_argument('workdir', metavar='TRAIN_DIR')
+    parser.add_argument('--stage', type=int, required=True, help='Stage to be prepared')
+    parser.add_argument('--xgrid-iter', default=1, type=int)
+    parser.add_argument('--check-stage', type=int, default=0, help='Stage whose outputs are checked')
+    parser.add_argument('--check-xgrid-iter', default=1, type=int)
+    parser.add_argument('--check-jobs', default=0, type=int, help='Number of jobs of the checked stage')
+    args = parser.parse_args()
+
+    sys.exit(main(args))
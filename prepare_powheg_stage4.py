@@ -6,6 +6,7 @@ import os
 import glob
 import yaml
 import UserConfiguration
+import event_index
 
 def CopyFiles(TrainName, LocalPath):
     Dest = "./{}".format(TrainName)
@@ -26,8 +27,26 @@ def CopyFiles(TrainName, LocalPath):
     for fpattern in AdditionalFilesToCopy:
         for file in glob.glob("{}/{}".format(Origin, fpattern)): shutil.copy(file, DestAdd)
 
+def CopyEvents(TrainName, LocalPath, Compression):
+    """Copies the LHE files of the train, compressing the plain text ones on the fly
+    (Compression is "gz", "zst" or "none"). The event indexes are carried over."""
+    Dest = "./{}".format(TrainName)
+    Origin = "{0}/{1}".format(LocalPath, TrainName)
 
-def main(UserConf, yamlFileName, unixTS):
+    for file in glob.glob("{}/pwgevents-????.lhe*".format(Origin)):
+        if file.endswith(event_index.INDEX_SUFFIX): continue
+        output = "{}/{}".format(Dest, os.path.basename(file))
+        if Compression != "none" and not event_index.GetCompression(file):
+            output += ".{}".format(Compression)
+            size = event_index.CompressEventFile(file, output)
+        else:
+            # copy2 keeps the modification time, so that the index stays valid
+            shutil.copy2(file, output)
+            if os.path.isfile(event_index.GetIndexFileName(file)): shutil.copy2(event_index.GetIndexFileName(file), event_index.GetIndexFileName(output))
+            size = os.path.getsize(output)
+        print("Copied {} to {} ({} -> {} bytes)".format(file, output, os.path.getsize(file), size))
+
+def main(UserConf, yamlFileName, unixTS, copyEvents):
     f = open(yamlFileName, 'r')
     config = yaml.load(f)
     f.close()
@@ -40,6 +59,8 @@ def main(UserConf, yamlFileName, unixTS):
 
     TrainName = "FastSim_{0}_{1}_{2}".format(Gen, Proc, unixTS)
     CopyFiles(TrainName, LocalPath)
+    if copyEvents:
+        CopyEvents(TrainName, LocalPath, copyEvents)
 
 
 if __name__ == '__main__':
@@ -50,8 +71,11 @@ if __name__ == '__main__':
                         default="userConf.yaml")
     parser.add_argument('--ts', metavar='TS',
                         default=None)
+    parser.add_argument('--copy-events', metavar='COMPRESSION',
+                        default=None, choices=["none", "gz", "zst"],
+                        help='Also copy the LHE files, compressed with gz or zst (can be passed to runFastSim.py with --input-events)')
     args = parser.parse_args()
 
     userConf = UserConfiguration.LoadUserConfiguration(args.user_conf)
 
-    main(userConf, args.config, args.ts)
+    main(userConf, args.config, args.ts, args.copy_events)
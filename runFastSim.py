@@ -4,29 +4,36 @@ import time
 import datetime
 import platform
 import os
-import shutil
 import subprocess
 import sys
 import argparse
 import random
 import glob
+import shutil
 import math
 import yaml
 from time import sleep
 import lhapdf_utils
-
-ALIENV = "/cvmfs/alice.cern.ch/bin/alienv"
-
-def alienv_exec(cmd, pkg):
-    if isinstance(cmd, list):
-        cmd = " ".join(cmd)
-    cmd = "'" + cmd + "'"
-    cmd = [ ALIENV, "setenv", pkg, "-c", cmd ]
-    print("ALIENV> executing %s" % " ".join(cmd))
-    cmd = " ".join(cmd)
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    out, err = proc.communicate()
-    return proc.returncode, out.decode(sys.stdout.encoding), err.decode(sys.stdout.encoding)
+import alienv_utils
+import build_cache
+import event_index
+try:
+    # Copied next to runFastSim.py by the submit tools
+    import staging
+except ImportError:
+    from alifastsim import staging
+import lhe_utils
+import hepmc_utils
+import herwig_utils
+import job_metrics
+import sim_workers
+import powheg_history
+import log_capture
+
+POWHEG_PKG = "VO_ALICE@POWHEG::r3178-alice1-1"
+HERWIG_PKG = "VO_ALICE@Herwig::v7.1.2-alice1-3"
+# Timeout (in seconds) of the setup commands run in a separately loaded package
+SETUP_TIMEOUT = 1800
 
 def GetAliPhysicsVersion(ver):
     if ver == "_last_":
@@ -37,71 +44,151 @@ def GetAliPhysicsVersion(ver):
 
 class PowhegResult:
 
-    def __init__(self, events_generated, lhe_file, log_file):
+    def __init__(self, events_generated, lhe_file, log_file, process=None, relay=None):
         self.lhe_file = lhe_file
         self.log_file = log_file
         self.events_generated = events_generated
+        # Only set when streaming: POWHEG is still running and its events are relayed to lhe_file
+        self.process = process
+        self.relay = relay
 
 def GetNumberOfPowhegEvents(lhefile):
     if os.path.isfile(lhefile):
-        proc = subprocess.Popen(["grep", "-c", "<event", lhefile], stdout=subprocess.PIPE)
-        output = proc.stdout.read()
-        nevents = int(output)
+        nevents = lhe_utils.GetNumberOfEvents(lhe_utils.GetLHEIndex(lhefile))
     else:
         nevents = 0
     return nevents
 
 class HerwigResult:
 
-    def __init__(self, events_generated, hep_file, log_file):
+    def __init__(self, events_generated, hep_file, log_file, process=None, relay=None):
         self.hep_file = hep_file
         self.log_file = log_file
         self.events_generated = events_generated
+        # Only set when streaming: Herwig is still running and its events are relayed to hep_file
+        self.process = process
+        self.relay = relay
 
 def GetNumberOfHerwigEvents(hepfile):
     if os.path.isfile(hepfile):
-        proc = subprocess.Popen(["grep", "-c", "E ", hepfile], stdout=subprocess.PIPE)
-        output = proc.stdout.read()
-        nevents = int(output)
+        nevents = hepmc_utils.GetNumberOfEvents(hepmc_utils.GetHepMCIndex(hepfile))
     else:
         nevents = 0
     return nevents
 
 def AddEmptyEvent(lhefile):
-    backup_filename = lhefile + ".bak"
-    os.rename(lhefile, backup_filename)
-    with open(backup_filename, 'r') as fin:
-        lhe = fin.read().splitlines()
-    last_event_stop_index = -1
-    last_event_start_index = -1
-    for i, line in reversed(list(enumerate(lhe))):
-        if last_event_stop_index < 0 and line == "</event>":
-            last_event_stop_index = i
+    lhe_utils.AppendEmptyEvent(lhefile)
+
+def StartPowheg(powhegExe, job_number, log_file, load_packages_separately):
+    """Starts POWHEG in the background. job_number is the seed index given
+    to POWHEG in parallel mode, None in single mode. Its output is captured
+    in log_file (size capped, see log_capture.py)."""
+    with log_capture.LogCapture(log_file, log_capture.POWHEG_PROGRESS) as myfile:
+        job_metrics.RecordProgress(os.path.splitext(log_file)[0], myfile.progress)
+        if load_packages_separately:
+            session = alienv_utils.GetSession(POWHEG_PKG)
+            session.Run("which {}".format(powhegExe), SETUP_TIMEOUT).Write(myfile)
+            print("Running POWHEG...")
+            proc = session.Popen([powhegExe], stdout=myfile, stderr=myfile, stdin=subprocess.PIPE)
+        else:
+            print("Running POWHEG...")
+            proc = subprocess.Popen([powhegExe], stdout=myfile, stderr=myfile, stdin=subprocess.PIPE)
+        if job_number is not None:
+            print([powhegExe, str(job_number)])
+            proc.stdin.write(str.encode(str(job_number)))
+        proc.stdin.close()
+    proc.log_capture = myfile
+    return proc
+
+def WaitForGenerator(proc):
+    """Waits for a generator started with its output captured, and for its log file to be complete."""
+    proc.wait()
+    proc.log_capture.Wait()
+    return proc.returncode
+
+def StreamPowheg(powhegExe, job_number, lhefile, log_file, load_packages_separately):
+    """Starts POWHEG writing its events into a FIFO, which are relayed to the
+    FIFO read by the simulation as soon as they are generated."""
+    relay = StartEventStream(lhefile, lhe_utils.LHEStreamRelay)
+    proc = StartPowheg(powhegExe, job_number, log_file, load_packages_separately)
+    print("Streaming POWHEG events through '{}'".format(relay.sink))
+    return PowhegResult(-1, os.path.basename(relay.sink), log_file, proc, relay)
+
+def StartEventStream(hepfile, relay_class):
+    """Replaces the event file of a generator by a FIFO and starts relaying
+    its content to the FIFO read by the simulation."""
+    if os.path.exists(hepfile):
+        os.remove(hepfile)
+    os.mkfifo(hepfile)
+    relay = relay_class(hepfile, "stream_{}".format(hepfile))
+    relay.start()
+    return relay
+
+def FinishEventStream(gen_result, gen_name):
+    """Stops the generator once the simulation is done (the remaining events are not
+    needed) and returns the number of events that were passed to the simulation,
+    or -1 if the generator failed."""
+    stopped = False
+    if gen_result.process.poll() is None:
+        print("Simulation done, stopping {}.".format(gen_name))
+        gen_result.process.terminate()
+        stopped = True
+    WaitForGenerator(gen_result.process)
+    gen_result.relay.Finish()
+    os.remove(gen_result.relay.source)
+    if not gen_result.relay.complete and not gen_result.relay.broken_pipe:
+        print("{} stopped before completing its event file.".format(gen_name))
+    print("{} {} events were streamed to the simulation.".format(gen_result.relay.nevents, gen_name))
+    if not stopped and gen_result.process.returncode != 0:
+        print("{} exited with return code {}.".format(gen_name, gen_result.process.returncode))
+        return -1
+    return gen_result.relay.nevents
+
+def WaitForSimulation(sim, generator):
+    """Waits for the simulation to finish. Returns False if it failed, or if the
+    generator feeding it through a FIFO failed (the simulation is then stopped)."""
+    while sim.poll() is None:
+        if generator and generator.poll():
+            print("The event generator exited with return code {}, stopping the simulation.".format(generator.returncode))
+            sim.terminate()
+            sim.wait()
+            return False
+        sleep(1)
+    if sim.returncode != 0:
+        print("The simulation exited with return code {}.".format(sim.returncode))
+    return sim.returncode == 0
+
+def GetPowhegSeedIndices(job_number, seeds_per_job, seed_stride):
+    """Seed indices (lines of pwgseeds.dat) used by a job at stage 4. The first one
+    is the job number, the others are beyond the job numbers of the train
+    (seed_stride), so that the files of different jobs never collide."""
+    return [job_number + iseed * seed_stride for iseed in range(seeds_per_job)]
+
+def RunPowhegSeeds(powhegExe, job_number, seeds_per_job, seed_stride, lhefile, load_packages_separately):
+    """Runs seeds_per_job POWHEG processes at stage 4 concurrently, each with its own
+    seed index, and concatenates their events into lhefile (single <init> block)."""
+    indices = GetPowhegSeedIndices(job_number, seeds_per_job, seed_stride)
+    print("Running {} POWHEG processes with seed indices {}".format(len(indices), indices))
+    procs = [StartPowheg(powhegExe, index, "Powheg_Stage_4_Job_{:04d}.log".format(index), load_packages_separately) for index in indices]
+    lhefiles = []
+    for index, proc in zip(indices, procs):
+        WaitForGenerator(proc)
+        output = "pwgevents-{:04d}.lhe".format(index)
+        if proc.returncode != 0 or not os.path.isfile(output):
+            print("POWHEG with seed index {} failed (return code {}), see Powheg_Stage_4_Job_{:04d}.log".format(index, proc.returncode, index))
             continue
-        if last_event_stop_index > 0 and line == "<event>":
-            last_event_start_index = i
-            break
-    if last_event_stop_index < 0:
-        print("Could not find </event> in the LHE file '{}'!".format(lhefile))
-        os.rename(backup_filename, lhefile)
-        return
-
-    # Check whether the empty event already exists
-    event_header = lhe[last_event_start_index + 1].strip().split()
-    if int(event_header[0]) == 0:
-        print("Empty event already present in the LHE file '{}'!".format(lhefile))
-        print(lhe[last_event_start_index + 1])
-        os.rename(backup_filename, lhefile)
-
+        lhefiles.append(output)
+    if not lhefiles:
         return
-    lhe.insert(last_event_stop_index + 1, "<event>")
-    lhe.insert(last_event_stop_index + 2, "      0  10001  1.0  1.0 -1.00000E+00  1.0")
-    lhe.insert(last_event_stop_index + 3, "</event>")
-    with open(lhefile, 'w') as fout:
-        for line in lhe:
-            fout.write(line + "\n")
-
-def RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separately):
+    if lhefiles[0] != lhefile:
+        os.replace(lhefiles[0], lhefile)
+        event_index.RemoveIndex(lhefiles[0])
+    lhe_utils.ConcatenateLHEFiles(lhefile, lhefiles[1:])
+    for f in lhefiles[1:]:
+        os.remove(f)
+        event_index.RemoveIndex(f)
+
+def RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separately, stream_events=False, seeds_per_job=1, seed_stride=0):
     print("Running POWHEG simulation at stage {}!".format(powheg_stage))
 
     with open("powheg.input", 'r') as fin:
@@ -110,22 +197,17 @@ def RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separat
         print(line)
 
     LogFileName = "Powheg_Stage_{}_Job_{:04d}.log".format(powheg_stage, job_number)
-    if load_packages_separately:
-        with open(LogFileName, "w") as myfile:
-            shell = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=myfile, stderr=myfile)
-            shell.stdin.write(str.encode("alienv enter VO_ALICE@POWHEG::r3178-alice1-1\n"))
-            shell.stdin.write(str.encode("which {}\n".format(powhegExe)))
-            shell.stdin.write(str.encode("{} {}\n".format(powhegExe, job_number)))
-            shell.communicate()
+    lhefile = "pwgevents-{:04d}.lhe".format(job_number)
+    if powheg_stage == 4 and seeds_per_job > 1:
+        if stream_events:
+            print("Running POWHEG with {} seeds, streaming disabled.".format(seeds_per_job))
+        RunPowhegSeeds(powhegExe, job_number, seeds_per_job, seed_stride, lhefile, load_packages_separately)
+    elif stream_events and powheg_stage == 4:
+        return StreamPowheg(powhegExe, job_number, lhefile, LogFileName, load_packages_separately)
     else:
-        print("Running POWHEG...")
-        with open(LogFileName, "w") as myfile:
-            print([powhegExe, str(job_number)])
-            p = subprocess.Popen([powhegExe], stdout=myfile, stderr=myfile, stdin=subprocess.PIPE)
-            p.communicate(input=str.encode(str(job_number)))
+        WaitForGenerator(StartPowheg(powhegExe, job_number, LogFileName, load_packages_separately))
 
     if powheg_stage == 4:
-        lhefile = "pwgevents-{:04d}.lhe".format(job_number)
         nevents = GetNumberOfPowhegEvents(lhefile)
         result = PowhegResult(nevents, lhefile, LogFileName)
     else:
@@ -133,7 +215,7 @@ def RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separat
 
     return result
 
-def RunPowhegSingle(powhegExe, load_packages_separately):
+def RunPowhegSingle(powhegExe, load_packages_separately, stream_events=False):
     print("Running POWHEG simulation!")
 
     with open("powheg.input", "a") as myfile:
@@ -145,26 +227,25 @@ def RunPowhegSingle(powhegExe, load_packages_separately):
     for line in powheg_input:
         print(line)
 
-    if load_packages_separately:
-        with open("powheg.log", "w") as myfile:
-            shell = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=myfile, stderr=myfile)
-            shell.stdin.write(str.encode("alienv enter VO_ALICE@POWHEG::r3178-alice1-1\n"))
-            shell.stdin.write(str.encode("which {}\n".format(powhegExe)))
-            shell.stdin.write(str.encode("{}\n".format(powhegExe)))
-            shell.communicate()
-    else:
-        print("Running POWHEG...")
-        with open("powheg.log", "w") as myfile:
-            subprocess.call([powhegExe], stdout=myfile, stderr=myfile)
-
     lhefile = "pwgevents.lhe"
+    if stream_events:
+        return StreamPowheg(powhegExe, None, lhefile, "powheg.log", load_packages_separately)
+
+    WaitForGenerator(StartPowheg(powhegExe, None, "powheg.log", load_packages_separately))
+
     nevents = GetNumberOfPowhegEvents(lhefile)
 
     result = PowhegResult(nevents, lhefile, "powheg.log")
 
     return result
 
-def Powheg(LHEfile, proc, powheg_stage, job_number, load_packages_separately):
+def PrintPowhegLog(log_file):
+    if os.path.isfile(log_file):
+        log_capture.PrintTail(log_capture.TailFile(log_file), "Check log file {}".format(log_file))
+    else:
+        print("No log file was found.")
+
+def Powheg(LHEfile, proc, powheg_stage, job_number, load_packages_separately, add_empty_event=True, stream_events=False, seeds_per_job=1, seed_stride=0):
     if LHEfile:
         nevents = GetNumberOfPowhegEvents(LHEfile)
         if nevents > 0:
@@ -194,9 +275,13 @@ def Powheg(LHEfile, proc, powheg_stage, job_number, load_packages_separately):
             print("Powheg found in '{}'".format(powhegPath))
 
         if powheg_stage > 0 and powheg_stage <= 4:
-            powheg_result = RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separately)
+            powheg_result = RunPowhegParallel(powhegExe, powheg_stage, job_number, load_packages_separately, stream_events, seeds_per_job, seed_stride)
         else:
-            powheg_result = RunPowhegSingle(powhegExe, load_packages_separately)
+            powheg_result = RunPowhegSingle(powhegExe, load_packages_separately, stream_events)
+
+        if powheg_result.relay:
+            # The end of the stream is handled by the relay
+            return powheg_result
 
         if not os.path.isfile(powheg_result.lhe_file) or powheg_result.events_generated <= 0:
             if powheg_stage > 0 and powheg_stage <= 3:
@@ -204,23 +289,17 @@ def Powheg(LHEfile, proc, powheg_stage, job_number, load_packages_separately):
                 exit(0)
             else:
                 print("POWHEG at stage {} did not produce any event!!!".format(powheg_stage))
-                if os.path.isfile(powheg_result.log_file):
-                    print("Check log file below.")
-                    with open(powheg_result.log_file, "r") as myfile:
-                        powheg_log = myfile.read().splitlines()
-                    for line in powheg_log:
-                        print(line)
-                else:
-                    print("No log file was found.")
+                PrintPowhegLog(powheg_result.log_file)
                 exit(1)
         else:
             print("POWHEG generated {} events, stored in {}".format(powheg_result.events_generated, powheg_result.lhe_file))
 
-    AddEmptyEvent(powheg_result.lhe_file)
+    if add_empty_event:
+        AddEmptyEvent(powheg_result.lhe_file)
     
     return powheg_result
 
-def RunHerwig(nevents, pdfid, job_number, load_packages_separately):
+def RunHerwig(nevents, pdfid, job_number, load_packages_separately, stream_events=False, lhapdf_cache="lhapdf", herwig_cache="herwig_cache", processes=1):
     print("Running HERWIG simulation!")
 
     rnd = random.randint(0, 1073741824)  # 2^30
@@ -233,103 +312,67 @@ def RunHerwig(nevents, pdfid, job_number, load_packages_separately):
     if not "HERWIG_ROOT" in os.environ and "HERWIGPATH" in os.environ:
         os.environ["HERWIG_ROOT"] = os.environ["HERWIGPATH"]
 
-    pdfname = lhapdf_utils.GetPDFName(pdfid, False)
-    hepfile = "events.hepmc"
-    if load_packages_separately:
-        herwig_pkg = "VO_ALICE@Herwig::v7.1.2-alice1-3"
-        print("Starting a separate shell to load the Herwig package...")
-        with open("herwig_stdout.log", "w") as myfile:
-            cmd = "which Herwig"
-            rc,out,err = alienv_exec(cmd, herwig_pkg)
-            myfile.write("Command '{}' exited with return code '{}'\n".format(cmd, rc))
-            myfile.write(out)
-            myfile.write("\n")
-            myfile.write(err)
-            myfile.write("\n")
-
-            # Verify that PDF is installed
-            cmd = "lhapdf list --installed"
-            rc,out,err = alienv_exec(cmd, herwig_pkg)
-            myfile.write("Command '{}' exited with return code '{}'\n".format(cmd, rc))
-            myfile.write(out)
-            myfile.write("\n")
-            myfile.write(err)
-            myfile.write("\n")
-            if pdfname in out:
-                print("PDF '{}' already installed.".format(pdfname))
-            else:
-                if "LHAPDF_DATA_PATH" in os.environ:
-                    os.environ["LHAPDF_DATA_PATH"] = "./:" + os.environ["LHAPDF_DATA_PATH"]
-                else:
-                    os.environ["LHAPDF_DATA_PATH"] = "./"
-                os.environ["LHAPDF_PDFSETS_ROOT"] = "./"
-                cmd = "lhapdf --pdfdir=./ install {}".format(pdfname)
-                rc, out, err = alienv_exec(cmd, herwig_pkg)
-                myfile.write("Command '{}' exited with return code '{}'\n".format(cmd, rc))
-                myfile.write(out)
-                myfile.write("\n")
-                myfile.write(err)
-                myfile.write("\n")
-                out = subprocess.check_output(["ls"]).decode(sys.stdout.encoding)
-                myfile.write(out)
-                myfile.write("\n")
-            cmd = "export LHAPDF_DATA_PATH=./:$LHAPDF_DATA_PATH;export LHAPDF_PDFSETS_ROOT=./;Herwig read --repo=$HERWIG_ROOT/share/Herwig/HerwigDefaults.rpo herwig.in"
-            rc, out, err = alienv_exec(cmd, herwig_pkg)
-            myfile.write("Command '{}' exited with return code '{}'\n".format(cmd, rc))
-            myfile.write(out)
-            myfile.write("\n")
-            myfile.write(err)
-            myfile.write("\n")
-            out = subprocess.check_output(["ls"]).decode(sys.stdout.encoding)
-            myfile.write(out)
-            myfile.write("\n")
-            cmd = "export LHAPDF_DATA_PATH=./:$LHAPDF_DATA_PATH;export LHAPDF_PDFSETS_ROOT=./;Herwig run herwig.run -s {} -N {}\n".format(rnd, nevents)
-            rc, out, err = alienv_exec(cmd, herwig_pkg)
-            myfile.write("Command '{}' exited with return code '{}'\n".format(cmd, rc))
-            myfile.write(out)
-            myfile.write("\n")
-            myfile.write(err)
-            myfile.write("\n")
-    else:
-        if TestHerwig():
-            print("Running HERWIG...")
-            with open("herwig_stdout_%d.log" %(job_number), "w") as myfile:
-                # Verify that PDF is installed
-                pdfsetlist = subprocess.check_output(["lhapdf", "list", "--installed"]).decode(sys.stdout.encoding).splitlines()
-                if pdfname in pdfsetlist:
-                    print("PDF '{}' already installed.".format(pdfname))
-                else:
-                    os.environ["LHAPDF_DATA_PATH"] = "./"
-                    subprocess.call(["lhapdf", "--pdfdir=./", "install", pdfname], stdout=myfile, stderr=myfile)
-                # generate herwig.in file with dedicated hepevent file
-                hwgfile = "herwig_%04d.in" %job_number
-                hepfile = "events_%04d.hepmc" %job_number
-                runtag = "herwig_%04d" %job_number
-                with open("herwig.in", "r") as reader: 
-                    with open(hwgfile, "w") as writer:
-                        for line in reader:
-                            if "events.hepmc" in line:
-                                line = line.replace("events.hepmc", hepfile)
-                            if "saverun" in line and "herwig" in line:
-                                line = line.replace("herwig", runtag)
-                            writer.write(line)
-                        writer.close()
-                    reader.close()
-                subprocess.call(["Herwig", "--repo=%s/share/Herwig/HerwigDefaults.rpo" %(os.environ["HERWIG_ROOT"]), "read", hwgfile], stdout=myfile, stderr=myfile)
-                if os.path.isfile("%s.run" %runtag):
-                    subprocess.call(["Herwig", "--repo=%s/share/Herwig/HerwigDefaults.rpo" %(os.environ["HERWIG_ROOT"]), "run", "%s.run" %runtag, "-s", str(rnd), "-N", str(nevents)], stdout=myfile, stderr=myfile)
-                else:
-                    print("Something went wrong in the HERWIG run configuration.")
+    hepfile = "events_%04d.hepmc" %job_number
+    setupfile = "herwig_setup_%04d.in" %job_number
+    logname = "herwig_stdout_%d.log" %(job_number)
+    # The output of all the HERWIG commands is captured in the same (size capped) log file
+    with log_capture.LogCapture(logname, log_capture.HERWIG_PROGRESS) as myfile:
+        job_metrics.RecordProgress("herwig", myfile.progress)
+        if load_packages_separately:
+            print("Loading the Herwig package...")
+            session = alienv_utils.GetSession(HERWIG_PKG)
+            session.Run("which Herwig", SETUP_TIMEOUT).Write(myfile)
+            # The PDF set is installed only once in the shared cache, if it is not part of the release
+            with job_metrics.MeasurePhase("pdf"):
+                data_path = lhapdf_utils.SetupPDFSet(pdfid, lhapdf_cache, session.env, myfile)
+            if data_path is None:
+                return HerwigResult(0, hepfile, logname)
+            env = dict(session.env, LHAPDF_DATA_PATH=data_path, LHAPDF_PDFSETS_ROOT=os.path.abspath(lhapdf_cache))
+            if not "HERWIG_ROOT" in env and "HERWIGPATH" in env:
+                env["HERWIG_ROOT"] = env["HERWIGPATH"]
+        elif TestHerwig():
+            with job_metrics.MeasurePhase("pdf"):
+                data_path = lhapdf_utils.SetupPDFSet(pdfid, lhapdf_cache, None, myfile)
+            if data_path is None:
+                return HerwigResult(0, hepfile, logname)
+            os.environ["LHAPDF_DATA_PATH"] = data_path
+            env = None
         else:
             print("HERWIG not found. Aborting...")
+            return HerwigResult(0, hepfile, logname)
+
+        # "Herwig read" is run only once per train, the jobs share the run file
+        myfile.flush()
+        runfile = herwig_utils.PrepareHerwigRun("herwig.in", "./", herwig_cache, env, myfile)
+        if runfile is None:
+            return HerwigResult(0, hepfile, logname)
+        print("Running HERWIG...")
+        if processes > 1:
+            # The processes share the run file, their events are concatenated
+            if stream_events:
+                print("Running {} HERWIG processes, streaming disabled.".format(processes))
+            herwig_utils.RunHerwigParallel(runfile, setupfile, hepfile, nevents, rnd, "job%04d" %job_number, processes, env, myfile)
+        else:
+            herwig_utils.WriteSetupFile(setupfile, hepfile, nevents)
+            cmd = herwig_utils.GetRunCommand(runfile, setupfile, rnd, nevents, "job%04d" %job_number, env)
+            myfile.write("Running '{}'\n".format(" ".join(cmd)))
+            myfile.flush()
+            if stream_events:
+                relay = StartEventStream(hepfile, hepmc_utils.HepMCStreamRelay)
+                proc = subprocess.Popen(cmd, stdout=myfile, stderr=subprocess.STDOUT, env=env)
+                proc.log_capture = myfile
+                return HerwigResult(-1, os.path.basename(relay.sink), logname, proc, relay)
+            subprocess.call(cmd, stdout=myfile, stderr=subprocess.STDOUT, env=env)
+    myfile.Wait()
 
     if os.path.isfile(hepfile):
         nevents_generated = GetNumberOfHerwigEvents(hepfile)
     else:
         print("Something went wrong in the HERWIG simulation.")
+        log_capture.PrintTail(myfile.Tail(), "Check log file {}".format(logname))
         nevents_generated = 0
 
-    result = HerwigResult(nevents_generated, hepfile, "herwig_stdout.log")
+    result = HerwigResult(nevents_generated, hepfile, logname)
 
     return result
 
@@ -342,7 +385,7 @@ def TestHerwig():
     print("Herwig found in '{}'".format(herwigPath))
     return True
 
-def Herwig(HEPfile, nevents, pdfid, job_number, load_packages_separately):
+def Herwig(HEPfile, nevents, pdfid, job_number, load_packages_separately, stream_events=False, lhapdf_cache="lhapdf", herwig_cache="herwig_cache", processes=1):
     if HEPfile:
         nevents_generated = GetNumberOfHerwigEvents(HEPfile)
         if nevents_generated > 0:
@@ -352,11 +395,127 @@ def Herwig(HEPfile, nevents, pdfid, job_number, load_packages_separately):
             print("No events found in file {}!".format(HEPfile))
             exit(1)
     else:
-        herwig_result = RunHerwig(nevents, pdfid, job_number, load_packages_separately)
+        herwig_result = RunHerwig(nevents, pdfid, job_number, load_packages_separately, stream_events, lhapdf_cache, herwig_cache, processes)
     
     return herwig_result
 
-def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_events, minpthard, maxpthard, debug_level):
+def CompressEventFile(eventfile, compression):
+    """Replaces an event file and its index by their compressed version."""
+    output = eventfile + compression
+    size = os.path.getsize(eventfile)
+    compressed_size = event_index.CompressEventFile(eventfile, output)
+    print("Compressed {} to {}: {} -> {} bytes".format(eventfile, output, size, compressed_size))
+    os.remove(eventfile)
+    event_index.RemoveIndex(eventfile)
+
+def ShardEventFile(eventfile, shard, num_shards, shard_mode):
+    """Exposes shard number shard of num_shards of an LHE or HepMC file as a separate
+    event file, either as a FIFO fed by a background thread (shard_mode "fifo")
+    or as a file copied in the kernel (shard_mode "copy"). The original file is
+    not modified; a compressed file is decompressed on the fly. Returns the shard
+    file name, the number of events in the shard and the shard writer (None in
+    "copy" mode)."""
+    if shard < 0 or shard >= num_shards:
+        print("Shard {} out of range (number of shards is {})!".format(shard, num_shards))
+        exit(1)
+    basename, ext = os.path.splitext(os.path.basename(event_index.StripCompressionSuffix(eventfile)))
+    shardfile = "{}_shard_{:04d}{}".format(basename, shard, ext)
+    if ext == ".lhe":
+        index = lhe_utils.GetLHEIndex(eventfile)
+        write_shard = lhe_utils.WriteLHEShard
+        create_shard_view = lhe_utils.CreateLHEShardView
+    else:
+        index = hepmc_utils.GetHepMCIndex(eventfile)
+        write_shard = hepmc_utils.WriteHepMCShard
+        create_shard_view = hepmc_utils.CreateHepMCShardView
+
+    if shard_mode == "fifo":
+        shard_writer, nevents = create_shard_view(index, shard, num_shards, shardfile)
+        shard_writer.start()
+    else:
+        shard_writer = None
+        nevents = write_shard(index, shard, num_shards, shardfile)
+    print("Using shard {} of {} of the events in file {} ({} events, via {})".format(shard, num_shards, eventfile, nevents, shard_mode))
+    return os.path.abspath(shardfile), nevents, shard_writer
+
+def ShardEventFileForWorkers(eventfile, shard, num_shards, workers, shard_mode):
+    """Splits shard number shard of num_shards further into one shard per worker
+    (shards shard * workers ... shard * workers + workers - 1 of num_shards * workers).
+    Returns the list of shards (file name, number of events, shard writer)."""
+    return [ShardEventFile(eventfile, shard * workers + iworker, num_shards * workers, shard_mode) for iworker in range(workers)]
+
+def GetScratchSize(path):
+    """Size (bytes) of the files in the work directory of the job, without following symbolic links."""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+def GetSimulationFiles():
+    """Files needed by the simulation in its work directory. Hard links keep the
+    modification times (copies are made in order, the compiled macro after its
+    source), so that ACLiC does not compile the macro again."""
+    FilesToStage = ["AnalysisCode.so", "runJetSimulation.C", "start_simulation.C"]
+    if os.path.isfile("AnalysisCode.rootmap"): FilesToStage.append("AnalysisCode.rootmap")
+    FilesToStage.extend(build_cache.ExpandPatterns("./", build_cache.MACRO_PRODUCTS))
+    FilesToStage.extend(glob.glob(r'./*.h'))
+    FilesToStage.extend(f for f in glob.glob(r'./*.pcm') if not f in FilesToStage)
+    return FilesToStage
+
+def GetSimulationCommand(fname, events, proc, gen, rnd, LHEfile, HEPfile, beamType, ebeam1, ebeam2, always_d_mesons, extended_event_info, minpthard, maxpthard, debug_level):
+    return ["aliroot", "-b", "-l", "-q", "start_simulation.C(\"{0}\", {1}, \"{2}\", \"{3}\", {4}, \"{5}\", \"{6}\", \"{7}\", {8}, {9}, {10}, {11}, {12}, {13}, {14})".format(fname, events, proc, gen, rnd, LHEfile, HEPfile, beamType, ebeam1, ebeam2, int(always_d_mesons), int(extended_event_info), minpthard, maxpthard, debug_level)]
+
+def RunSimulationWorkers(fname, events, rnd, nworkers, worker_views, get_command, worker_memory, stage_mode, env=None, max_concurrency=0, checkpoint=None):
+    """Splits the simulation of events over nworkers workers (chunks) with distinct
+    seeds, each reading its own shard in worker_views if the events are read from
+    a file, runs them (at most max_concurrency at a time, if given) and merges
+    their results. The workers recorded as done in checkpoint are not run again.
+    Returns False if a worker or the merging failed."""
+    if worker_views:
+        worker_events = sim_workers.SplitEvents(events, [view[1] for view in worker_views])
+    else:
+        worker_events = sim_workers.SplitEvents(events, [events] * nworkers)
+    FilesToStage = GetSimulationFiles()
+    workers = []
+    done_workers = checkpoint.GetDoneWorkers() if checkpoint else []
+    for iworker in range(nworkers):
+        if worker_events[iworker] == 0 or (checkpoint and checkpoint.IsDone(iworker)):
+            continue
+        view_file = worker_views[iworker][0] if worker_views else ""
+        worker_name = "{}_w{:02d}".format(fname, iworker)
+        work_dir = os.path.abspath(os.path.join("workers_{}".format(fname), "w{:02d}".format(iworker)))
+        os.makedirs(work_dir, exist_ok=True)
+        staging.StageFiles({f: os.path.join(work_dir, os.path.basename(f)) for f in FilesToStage}, stage_mode)
+        lhefile = view_file if view_file.endswith(".lhe") else ""
+        hepfile = view_file if view_file.endswith(".hepmc") else ""
+        # Distinct seed for each worker, derived from the seed of the job (the same when the job is restarted)
+        cmd = get_command(worker_name, worker_events[iworker], (rnd + iworker) % 1073741824, lhefile, hepfile)
+        workers.append(sim_workers.Worker(worker_name, work_dir, cmd, os.path.abspath("sim_{}.log".format(worker_name)), env, iworker))
+    concurrency = sim_workers.GetConcurrency(len(workers), worker_memory)
+    if max_concurrency > 0:
+        concurrency = min(concurrency, max_concurrency)
+    if done_workers:
+        print("{} workers already done: {}".format(len(done_workers), ", ".join(worker.name for worker in done_workers)))
+    print("Running {} events in {} workers ({} at a time, {} MB each): {}".format(events, len(workers), concurrency, worker_memory, worker_events))
+    pool = sim_workers.WorkerPool(max(concurrency, 1), worker_memory, checkpoint)
+    if not pool.RunAll(workers):
+        print("The simulation failed in at least one of the workers, see the sim_{}_wNN.log files".format(fname))
+        return False
+    # Workers done in a previous attempt of the job may have a different name (e.g. another time stamp)
+    workers = sorted(done_workers + workers, key=lambda worker: worker.ichunk)
+    with open("merge_{}.log".format(fname), "w") as myfile:
+        if not sim_workers.MergeResults(workers, fname, [worker.name for worker in workers], "./", env, myfile):
+            return False
+    sim_workers.RemoveWorkDirs(workers)
+    if checkpoint:
+        checkpoint.Remove()
+    return True
+
+def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_events, minpthard, maxpthard, debug_level, shard, num_shards, shard_mode, workers, worker_memory, chunks):
     print("------------------ job starts ---------------------")
     dateNow = datetime.datetime.now()
     print(dateNow)
@@ -378,12 +537,13 @@ def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_even
         load_packages_separately = False
 
     if not load_packages_separately:
-        try:
-            rootPath = subprocess.check_output(["which", "root"]).decode(sys.stdout.encoding).rstrip()
-            alirootPath = subprocess.check_output(["which", "aliroot"]).decode(sys.stdout.encoding).rstrip()
-        except subprocess.CalledProcessError:
-            print("Environment is not configured correctly!")
-            exit()
+        with job_metrics.MeasurePhase("environment"):
+            try:
+                rootPath = subprocess.check_output(["which", "root"]).decode(sys.stdout.encoding).rstrip()
+                alirootPath = subprocess.check_output(["which", "aliroot"]).decode(sys.stdout.encoding).rstrip()
+            except subprocess.CalledProcessError:
+                print("Environment is not configured correctly!")
+                exit()
 
         print("Root: " + rootPath)
         print("AliRoot: " + alirootPath)
@@ -403,11 +563,66 @@ def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_even
     else:
         powheg_buffer = 0.0
 
+    # Number of POWHEG processes (seed indices) run concurrently by each job at stage 4
+    if "powheg_config" in config and "seeds_per_job" in config["powheg_config"]:
+        powheg_seeds_per_job = config["powheg_config"]["seeds_per_job"]
+    else:
+        powheg_seeds_per_job = 1
+    powheg_seed_stride = 0
+    if powheg_seeds_per_job > 1:
+        # The seed indices of a job must not collide with the ones of the other jobs
+        if not "numbjobs" in config:
+            print("numbjobs is needed in the configuration to run more than one POWHEG seed per job!")
+            exit(1)
+        numbjobs = config["numbjobs"]
+        if isinstance(numbjobs, list):
+            # Number of jobs per pt hard bin
+            numbjobs = max(numbjobs)
+        powheg_seed_stride = numbjobs + 1
+
     if "extended_event_info" in config:
         extended_event_info = config["extended_event_info"]
     else:
         extended_event_info = False
 
+    if "stream_events" in config:
+        stream_events = config["stream_events"]
+    else:
+        stream_events = False
+    if stream_events and (input_events or num_shards > 1):
+        print("Events are read from a file, streaming disabled.")
+        stream_events = False
+    # Number of chunks of the simulation, run by at most workers processes at a time
+    if chunks <= 0:
+        if "sim_chunks" in config:
+            chunks = config["sim_chunks"]
+        else:
+            chunks = 1
+    chunks = max(chunks, workers)
+    if stream_events and chunks > 1:
+        print("The events are split over {} workers, streaming disabled.".format(chunks))
+        stream_events = False
+
+    # Size (MB) above which the log files of the generators and of the simulation are rotated
+    if "max_log_size" in config:
+        log_capture.MAX_LOG_SIZE = config["max_log_size"] * 1024 ** 2
+
+    # Memory budget of each simulation worker (MB)
+    if worker_memory <= 0:
+        if "worker_memory" in config:
+            worker_memory = config["worker_memory"]
+        else:
+            worker_memory = sim_workers.WORKER_MEMORY
+
+    # Generated LHE/HepMC files are compressed at the end of the job ("gz" or "zst")
+    if "compress_events" in config and config["compress_events"]:
+        compress_events = ".{}".format(config["compress_events"])
+        if not compress_events in event_index.COMPRESSION_SUFFIXES:
+            print("Compression '{}' not supported!".format(config["compress_events"]))
+            exit(1)
+    else:
+        compress_events = ""
+
     if batch_job == "grid":
         fname = "{0}_{1}".format(gen, proc)
     elif batch_job == "lbnl3":
@@ -418,16 +633,63 @@ def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_even
 
     print("Running {0} MC production on: {1}".format(proc, " ".join(platform.uname())))
 
+    # Resources used by each phase of the job, written when the job ends (also if it fails)
+    metrics = job_metrics.GetJobMetrics()
+    metrics.info.update({"gen": gen, "proc": proc, "config": os.path.basename(yamlConfigFile), "batch_job": batch_job, "job_number": job_number, "events_requested": events})
+    if batch_job == "grid":
+        metrics.SaveAtExit(os.path.join(dname, "job_metrics.json"))
+    else:
+        metrics.SaveAtExit(os.path.join(dname, "job_metrics_{0}.json".format(fname)))
+
+    # Progress of a simulation in chunks: a restarted job reuses the events and the seed
+    # of the previous attempt and only runs the chunks that are not done
+    checkpoint = None
+    generate_events = not input_events
+    resumed = False
+    if chunks > 1:
+        checkpoint = sim_workers.Checkpoint(os.path.join(dname, "checkpoint_{}_{}_{:04d}.json".format(gen, proc, job_number)))
+        resumed = checkpoint.Load(events, chunks)
+        if resumed and not input_events and checkpoint.event_file:
+            if os.path.isfile(checkpoint.event_file):
+                input_events = checkpoint.event_file
+            else:
+                print("Event file {} of the previous attempt not found, generating new events.".format(checkpoint.event_file))
+
     LHEfile = ""
     HEPfile = ""
+    # Shards of the event file in use (file name, number of events, shard writer)
+    event_views = []
+    if shard < 0:
+        shard = job_number % num_shards
+    # Compressed input files are decompressed on the fly through a single shard view,
+    # the workers (chunks) of a job read distinct shards
+    use_event_view = num_shards > 1 or chunks > 1 or event_index.GetCompression(input_events) != ""
 
     if "powheg" in gen:
-        powheg_result = Powheg(input_events, proc, powheg_stage, job_number, load_packages_separately)
-        LHEfile = powheg_result.lhe_file
-        if powheg_buffer > 0:
-            max_events = int(math.floor(powheg_result.events_generated / (1.0 + powheg_buffer) + 0.5))
+        # When sharding, the file may be shared with other jobs: each shard gets its own empty event
+        with job_metrics.MeasurePhase("powheg") as phase:
+            powheg_result = Powheg(input_events, proc, powheg_stage, job_number, load_packages_separately, not use_event_view, stream_events, powheg_seeds_per_job, powheg_seed_stride)
+            LHEfile = powheg_result.lhe_file
+            if powheg_result.relay:
+                # The simulation stops at the empty event added at the end of the stream
+                print("Streaming POWHEG events, the number of events is limited by the POWHEG output.")
+                events_available = events
+            else:
+                # The event index was stored next to the LHE file when counting the events, this is O(1)
+                events_available = GetNumberOfPowhegEvents(LHEfile)
+                phase.events_out = events_available
+        if chunks > 1:
+            event_views = ShardEventFileForWorkers(LHEfile, shard, num_shards, chunks, shard_mode)
+            events_available = sum(view[1] for view in event_views)
+        elif use_event_view:
+            event_views = [ShardEventFile(LHEfile, shard, num_shards, shard_mode)]
+            LHEfile, events_available, _ = event_views[0]
+        if powheg_result.relay:
+            max_events = events_available
+        elif powheg_buffer > 0:
+            max_events = int(math.floor(events_available / (1.0 + powheg_buffer) + 0.5))
         else:
-            max_events = powheg_result.events_generated
+            max_events = events_available
         if max_events == 0:
             print("Error no events generated by POWHEG!")
             exit(1)
@@ -436,9 +698,38 @@ def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_even
             events = max_events
     
     if "herwig" in gen:
-        herwig_result = Herwig(input_events, events, config["lhans"], job_number, load_packages_separately)
+        # PDF sets installed by the jobs are shared through this directory
+        if "lhapdf_cache" in config:
+            lhapdf_cache = config["lhapdf_cache"]
+        else:
+            lhapdf_cache = os.path.join(dname, "lhapdf")
+        # The HERWIG run file is built once per train and shared through this directory
+        if "herwig_cache" in config:
+            herwig_cache = config["herwig_cache"]
+        else:
+            herwig_cache = os.path.join(dname, "herwig_cache")
+        # Number of concurrent HERWIG processes (seeds) per job
+        if "herwig_config" in config and "processes" in config["herwig_config"]:
+            herwig_processes = config["herwig_config"]["processes"]
+        else:
+            herwig_processes = 1
+        with job_metrics.MeasurePhase("herwig") as phase:
+            herwig_result = Herwig(input_events, events, config["lhans"], job_number, load_packages_separately, stream_events, lhapdf_cache, herwig_cache, herwig_processes)
+            if not herwig_result.relay:
+                phase.events_out = herwig_result.events_generated
         HEPfile = herwig_result.hep_file
-        max_events = herwig_result.events_generated
+        if herwig_result.relay:
+            # HERWIG generates exactly the requested number of events
+            print("Streaming HERWIG events.")
+            max_events = events
+        else:
+            max_events = herwig_result.events_generated
+        if chunks > 1:
+            event_views = ShardEventFileForWorkers(HEPfile, shard, num_shards, chunks, shard_mode)
+            max_events = sum(view[1] for view in event_views)
+        elif use_event_view:
+            event_views = [ShardEventFile(HEPfile, shard, num_shards, shard_mode)]
+            HEPfile, max_events, _ = event_views[0]
         if max_events == 0:
             print("Error no events generated by HERWIG!")
             exit(1)
@@ -446,51 +737,119 @@ def main(events, powheg_stage, job_number, yamlConfigFile, batch_job, input_even
             print("Reducing the number of requested events to match the event found in the HEP file: {}".format(max_events))
             events = max_events
 
+    # With streaming the simulation is stopped if the event generator fails
+    generator = None
+    if "powheg" in gen and powheg_result.relay:
+        generator = powheg_result.process
+    if "herwig" in gen and herwig_result.relay:
+        generator = herwig_result.process
+
     rnd = random.randint(0, 1073741824)  # 2^30
+    if checkpoint:
+        if checkpoint.seed is None:
+            checkpoint.seed = rnd
+        else:
+            rnd = checkpoint.seed
+        if "powheg" in gen:
+            checkpoint.event_file = os.path.join(dname, powheg_result.lhe_file)
+        elif "herwig" in gen:
+            checkpoint.event_file = os.path.join(dname, herwig_result.hep_file)
+        checkpoint.Save()
     print("Setting seed to {0}".format(rnd))
 
+    # With load_packages_separately the analysis code is built and run in the environment of the AliPhysics package
+    sim_env = None
     if load_packages_separately:
         AliPhysicsVersion = GetAliPhysicsVersion(config["grid_config"]["aliphysics"])
         aliphysics_pkg = "VO_ALICE@AliPhysics::{aliphysics}".format(aliphysics=AliPhysicsVersion)
-        with open("sim_{0}.log".format(fname), "w") as myfile:
-            shell = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=myfile, stderr=myfile)
-            shell.stdin.write("alienv enter {}\n".format(aliphysics_pkg))
-            shell.stdin.write("which aliroot\n")
-            shell.stdin.write("make\n")
-            shell.stdin.write("aliroot -b -l -q 'start_simulation.C(\"{0}\", {1}, \"{2}\", \"{3}\", {4}, \"{5}\", \"{6}\", \"{7}\", {8}, {9}, {10}, {11}, {12}, {13}, {14})'\n".format(fname, events, proc, gen, rnd, LHEfile, HEPfile, beamType, ebeam1, ebeam2, int(always_d_mesons), int(extended_event_info), minpthard, maxpthard, debug_level))
-            shell.communicate()
+        with job_metrics.MeasurePhase("environment"):
+            session = alienv_utils.GetSession(aliphysics_pkg)
+            result = session.Run("which aliroot", SETUP_TIMEOUT)
+            print(result.out)
+            sim_env = session.env
+
+    # Only one job compiles (holding the lock of the build cache), the others reuse the compiled code
+    if "build_cache" in config:
+        cache_dir = config["build_cache"]
     else:
-        if not os.path.exists("AnalysisCode.so"):
-            # Avoid that multiple jobs compile at the same time
-            print("Compiling analysis code...")
-            subprocess.call(["make"])
+        cache_dir = os.path.join(dname, "build_cache")
+    with job_metrics.MeasurePhase("build"), open("build_{0}.log".format(fname), "w") as myfile:
+        build_ok = build_cache.PrepareBuild(dname, cache_dir, build_cache.GetBuildTag(env=sim_env), myfile, sim_env)
+    if not build_ok:
+        print("Could not build the analysis code, see build_{0}.log".format(fname))
+        exit(1)
+
+    if "stage_mode" in config:
+        stage_mode = config["stage_mode"]
+    else:
+        stage_mode = "link"
+    if batch_job == "lbnl3":
+        work_dir = "output/{}".format(fname)
+        # The work directory already exists if the job is restarted
+        os.makedirs(work_dir, exist_ok=True)
+        FilesToStage = GetSimulationFiles()
+        report = staging.StageFiles({f: os.path.join(work_dir, os.path.basename(f)) for f in FilesToStage}, stage_mode)
+        print("Staging of {}: {}".format(work_dir, report))
+        if "powheg" in gen: LHEfile = os.path.abspath(LHEfile)
+        if "herwig" in gen: HEPfile = os.path.abspath(HEPfile)
+        os.chdir(work_dir)
+
+    sim_phase = job_metrics.MeasurePhase("simulation")
+    sim_phase.events_in = events
+    with sim_phase:
+        print("Running simulation...")
+        get_command = lambda name, nevents, seed, lhefile, hepfile: GetSimulationCommand(name, nevents, proc, gen, seed, lhefile, hepfile, beamType, ebeam1, ebeam2, always_d_mesons, extended_event_info, minpthard, maxpthard, debug_level)
+        if chunks > 1:
+            sim_ok = RunSimulationWorkers(fname, events, rnd, chunks, event_views, get_command, worker_memory, stage_mode, sim_env, workers, checkpoint)
         else:
-            print("Not compiling again as the library was already found ...")
-
-        if batch_job == "lbnl3":
-            work_dir = "output/{}".format(fname)
-            os.makedirs(work_dir)
-            shutil.copy("AnalysisCode.so", work_dir)
-            if os.path.isfile("AnalysisCode.rootmap"): shutil.copy("AnalysisCode.rootmap", work_dir)
-            shutil.copy("runJetSimulation.C", work_dir)
-            shutil.copy("start_simulation.C", work_dir)
-            for hdr_file in glob.glob(r'./*.h'): shutil.copy(hdr_file, work_dir)
-            for pcm_file in glob.glob(r'./*.pcm'): shutil.copy(pcm_file, work_dir)
-            if "powheg" in gen: LHEfile = "../../{}".format(LHEfile)
-            if "herwig" in gen: HEPfile = "../../{}".format(HEPfile)
-            os.chdir(work_dir)
+            with log_capture.LogCapture("sim_{0}.log".format(fname), log_capture.SIMULATION_PROGRESS) as myfile:
+                job_metrics.RecordProgress("simulation", myfile.progress)
+                sim = subprocess.Popen(get_command(fname, events, rnd, LHEfile, HEPfile), stdout=myfile, stderr=myfile, env=sim_env)
+                sim_ok = WaitForSimulation(sim, generator)
+            myfile.Wait()
+            if not sim_ok:
+                log_capture.PrintTail(myfile.Tail(), "The simulation failed, check log file sim_{0}.log".format(fname))
+
+        if "powheg" in gen and powheg_result.relay:
+            if FinishEventStream(powheg_result, "POWHEG") <= 0:
+                print("POWHEG did not produce any event!!!")
+                PrintPowhegLog(os.path.join(dname, powheg_result.log_file))
+                exit(1)
 
-        print("Running simulation...")
-        with open("sim_{0}.log".format(fname), "w") as myfile:
-            subprocess.call(["aliroot", "-b", "-l", "-q", "start_simulation.C(\"{0}\", {1}, \"{2}\", \"{3}\", {4}, \"{5}\", \"{6}\", \"{7}\", {8}, {9}, {10}, {11}, {12}, {13}, {14})".format(fname, events, proc, gen, rnd, LHEfile, HEPfile, beamType, ebeam1, ebeam2, int(always_d_mesons), int(extended_event_info), minpthard, maxpthard, debug_level)], stdout=myfile, stderr=myfile)
+        if "herwig" in gen and herwig_result.relay:
+            if FinishEventStream(herwig_result, "HERWIG") <= 0:
+                print("Something went wrong in the HERWIG simulation.")
+                exit(1)
+        sim_phase.events_out = events if sim_ok else 0
+        # Within the phase, so that it is recorded as failed
+        if not sim_ok:
+            exit(1)
+
+    # LHE events consumed by the simulation, used by the submit tools to derive the POWHEG buffer
+    if "powheg" in gen and not powheg_result.relay and not resumed:
+        # Progress of the simulation, or of each of its workers, extracted from their output
+        progresses = [progress for name, progress in metrics.progress.items() if name == "simulation" or name.startswith("simulation_")]
+        record = powheg_history.CreateRecord(config, events, events_available, progresses)
+        if record:
+            print("{} LHE events read by the simulation of {} events ({} available)".format(record["lhe_events_consumed"], events, events_available))
+            metrics.info["powheg_events"] = record
+
+    for view_file, _, view_writer in event_views:
+        if view_writer:
+            view_writer.Finish()
+        else:
+            os.remove(view_file)
+
+    if compress_events and generate_events:
+        if "powheg" in gen and not powheg_result.relay:
+            CompressEventFile(os.path.join(dname, powheg_result.lhe_file), compress_events)
+        if "herwig" in gen and not herwig_result.relay:
+            CompressEventFile(os.path.join(dname, herwig_result.hep_file), compress_events)
 
     print("Done")
     print("...see results in the log files")
 
-    subprocess.call(["ls", "-l"])
-
-    print("############### SCRATCH SIZE ####################")
-    subprocess.call(["du", "-sh"])
+    metrics.info["scratch_size"] = GetScratchSize(".")
 
     print("------------------ job ends ----------------------")
     dateNow = datetime.datetime.now()
@@ -503,7 +862,7 @@ if __name__ == '__main__':
     parser.add_argument('--numevents', metavar='NEVT',
                         default=50000, type=int)
     parser.add_argument('--input-events', metavar='file.lhe',
-                        default='')
+                        default='', help='LHE or HepMC input file, can be compressed (.gz, .zst)')
     parser.add_argument('--minpthard', metavar="MINPTHARD",
                         default=-1, type=float)
     parser.add_argument('--maxpthard', metavar='MAXPTHARD',
@@ -516,6 +875,24 @@ if __name__ == '__main__':
                         default=0, type=int)
     parser.add_argument('-d', metavar='debug_level',
                         default=0, type=int)
+    parser.add_argument('--num-shards', metavar='N',
+                        default=1, type=int,
+                        help='Split the input events into N contiguous shards and only simulate one of them')
+    parser.add_argument('--shard', metavar='K',
+                        default=-1, type=int,
+                        help='Shard to be simulated (default: job number modulo the number of shards)')
+    parser.add_argument('--shard-mode', metavar='MODE',
+                        default='fifo', choices=['fifo', 'copy'],
+                        help='Expose the shard through a FIFO (no copy on disk) or as a file copied in the kernel')
+    parser.add_argument('--workers', metavar='N',
+                        default=1, type=int,
+                        help='Split the events over N concurrent simulations (distinct seeds or input shards), merged at the end')
+    parser.add_argument('--worker-memory', metavar='MB',
+                        default=0, type=int,
+                        help='Memory budget of each worker, limits the number of concurrent workers (default: worker_memory in the YAML file, or {})'.format(sim_workers.WORKER_MEMORY))
+    parser.add_argument('--chunks', metavar='N',
+                        default=0, type=int,
+                        help='Run the simulation in N chunks (distinct seeds or input shards), recording the chunks done in a checkpoint file so that a restarted job skips them (default: sim_chunks in the YAML file, or the number of workers)')
     args = parser.parse_args()
 
-    main(args.numevents, args.powheg_stage, args.job_number, args.config, args.batch_job, args.input_events, args.minpthard, args.maxpthard, args.d)
+    main(args.numevents, args.powheg_stage, args.job_number, args.config, args.batch_job, args.input_events, args.minpthard, args.maxpthard, args.d, args.shard, args.num_shards, args.shard_mode, args.workers, args.worker_memory, args.chunks)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# In-job fan-out of the simulation (runFastSim.py --workers N): the events of a job
+# are split over N simulation processes (distinct seeds, or distinct shards of the
+# input events), each running in its own work directory. At most as many workers
+# run concurrently as the memory budget per worker allows; their AnalysisResults
+# files are merged with hadd at the end, under the names of a single job.
+# The same mechanism runs the simulation in chunks (runFastSim.py --chunks N), with
+# a checkpoint file recording the chunks that are done, so that a job that was
+# killed can be restarted without simulating them again.
+
+import concurrent.futures
+import glob
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import job_metrics
+import log_capture
+
+# Memory budget per worker (MB) if not configured
+WORKER_MEMORY = 2000
+# Time (s) to wait between two checks of the available memory before starting a worker
+MEMORY_POLL_INTERVAL = 10
+# Time (s) a worker may take to allocate its memory after it started
+MEMORY_RAMP_UP = 300
+
+def GetAvailableMemory():
+    """Available memory (MB) of the node (MemAvailable), or of the cgroup if it is
+    more restrictive. Returns None if it cannot be determined."""
+    available = None
+    try:
+        with open("/proc/meminfo") as fin:
+            for line in fin:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    for limit_file, usage_file in [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]:
+        try:
+            with open(limit_file) as fin:
+                limit = fin.read().strip()
+            with open(usage_file) as fin:
+                usage = int(fin.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit():
+            cgroup_available = (int(limit) - usage) // 1024 ** 2
+            if available is None or cgroup_available < available:
+                available = cgroup_available
+        break
+    return available
+
+def GetNumberOfCores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+def GetConcurrency(nworkers, memory_per_worker):
+    """Number of workers that can run at the same time, given the cores available
+    to the job and the memory budget per worker (MB)."""
+    concurrency = min(nworkers, GetNumberOfCores())
+    available = GetAvailableMemory()
+    if memory_per_worker > 0 and available is not None:
+        concurrency = min(concurrency, max(1, available // memory_per_worker))
+    return concurrency
+
+def SplitEvents(events, capacities):
+    """Splits events over the workers proportionally to their capacities (e.g. the
+    number of events in their shard of the input), without exceeding them."""
+    total = sum(capacities)
+    if total == 0:
+        return [0] * len(capacities)
+    events = min(events, total)
+    split = [events * c // total for c in capacities]
+    for i in range(len(split)):
+        if sum(split) == events:
+            break
+        if split[i] < capacities[i]:
+            split[i] += 1
+    return split
+
+class MemoryGate:
+    """Starts processes needing memory_per_process MB each only if this memory is
+    available (or if no other process is running). The memory of the processes
+    started less than MEMORY_RAMP_UP s ago is reserved, as they may not have
+    allocated it yet. Used by the worker pool and by the local batch tools."""
+
+    def __init__(self, memory_per_process):
+        self.memory_per_process = memory_per_process
+        self.running = 0
+        self.starts = []
+        self.lock = threading.Lock()
+
+    def Acquire(self):
+        """Waits until a process can start. Returns its reservation (start time), to be given to Release."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.starts = [start for start in self.starts if now - start < MEMORY_RAMP_UP]
+                available = GetAvailableMemory()
+                if available is not None:
+                    available -= len(self.starts) * self.memory_per_process
+                if self.running == 0 or available is None or available >= self.memory_per_process:
+                    self.running += 1
+                    self.starts.append(now)
+                    return now
+            time.sleep(MEMORY_POLL_INTERVAL)
+
+    def Release(self, reservation):
+        with self.lock:
+            self.running -= 1
+            if reservation in self.starts:
+                self.starts.remove(reservation)
+
+class Worker:
+
+    def __init__(self, name, workdir, cmd, logfile, env=None, ichunk=0):
+        self.name = name
+        self.workdir = workdir
+        self.cmd = cmd
+        self.logfile = logfile
+        self.env = env
+        self.ichunk = ichunk
+        self.returncode = None
+
+class WorkerPool:
+    """Runs the workers, at most concurrency at a time. A worker is started only if
+    the memory budget is available (or if no other worker is running)."""
+
+    def __init__(self, concurrency, memory_per_worker, checkpoint=None):
+        self.concurrency = concurrency
+        self.memory = MemoryGate(memory_per_worker)
+        self.checkpoint = checkpoint
+
+    def Run(self, worker):
+        reservation = self.memory.Acquire()
+        try:
+            print("Starting worker {} in {}".format(worker.name, worker.workdir))
+            with log_capture.LogCapture(worker.logfile, log_capture.SIMULATION_PROGRESS) as myfile:
+                job_metrics.RecordProgress("simulation_{}".format(worker.name), myfile.progress)
+                worker.returncode = subprocess.call(worker.cmd, cwd=worker.workdir, stdout=myfile, stderr=myfile, env=worker.env)
+            myfile.Wait()
+            print("Worker {} exited with return code {}".format(worker.name, worker.returncode))
+            if worker.returncode != 0:
+                log_capture.PrintTail(myfile.Tail(), "Worker {}, log file {}".format(worker.name, worker.logfile))
+            if worker.returncode == 0 and self.checkpoint:
+                self.checkpoint.MarkDone(worker.ichunk, worker)
+        finally:
+            self.memory.Release(reservation)
+        return worker.returncode
+
+    def RunAll(self, workers):
+        """Returns True if all the workers succeeded."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            returncodes = list(executor.map(self.Run, workers))
+        return all(rc == 0 for rc in returncodes)
+
+def MergeResults(workers, name, worker_names, destdir, env=None, logfile=None):
+    """Merges the AnalysisResults files of the workers into destdir with hadd, under
+    the names the single job would have produced (the worker name in the file
+    name is replaced by name). Returns False if the merging failed."""
+    outputs = {}
+    for worker, worker_name in zip(workers, worker_names):
+        for f in sorted(glob.glob(os.path.join(worker.workdir, "AnalysisResults*.root"))):
+            output = os.path.basename(f).replace(worker_name, name)
+            outputs.setdefault(output, []).append(f)
+    if not outputs:
+        print("No output found in the work directories of the workers!")
+        return False
+    for output, files in outputs.items():
+        print("Merging {} files into {}".format(len(files), output))
+        if subprocess.call(["hadd", "-f", os.path.join(destdir, output)] + files, stdout=logfile, stderr=logfile, env=env) != 0:
+            print("Merging of {} failed!".format(output))
+            return False
+    return True
+
+def RemoveWorkDirs(workers):
+    """Removes the directories holding the work directories of the workers, including
+    those of workers that failed in a previous attempt of the job."""
+    for workers_dir in set(os.path.dirname(worker.workdir) for worker in workers):
+        shutil.rmtree(workers_dir, ignore_errors=True)
+
+class Checkpoint:
+    """Progress of a job running its simulation in chunks: the base seed, the event
+    file the chunks read (if any) and the chunks that are done, with their work
+    directories. It is saved after each chunk, so that a restarted job skips the
+    chunks that are done and only merges at the end."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.seed = None
+        self.events = 0
+        self.nchunks = 0
+        self.event_file = ""
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def Load(self, events, nchunks):
+        """Loads the checkpoint of a previous attempt of the job. Returns False (and
+        starts from scratch) if there is none or if it was made with a different
+        number of events or chunks."""
+        self.events = events
+        self.nchunks = nchunks
+        if not os.path.isfile(self.filename):
+            return False
+        try:
+            with open(self.filename) as fin:
+                content = json.load(fin)
+        except (OSError, ValueError) as e:
+            print("Could not read the checkpoint file {}: {}".format(self.filename, e))
+            return False
+        if content.get("events") != events or content.get("nchunks") != nchunks:
+            print("Checkpoint file {} made for {} events in {} chunks, starting from scratch.".format(self.filename, content.get("events"), content.get("nchunks")))
+            return False
+        self.seed = content["seed"]
+        self.event_file = content.get("event_file", "")
+        # Chunks whose output is gone are simulated again
+        self.chunks = {int(ichunk): chunk for ichunk, chunk in content["chunks"].items() if os.path.isdir(chunk["workdir"])}
+        print("Resuming from checkpoint {}: {} of {} chunks done".format(self.filename, len(self.chunks), nchunks))
+        return True
+
+    def Save(self):
+        content = {"seed": self.seed, "events": self.events, "nchunks": self.nchunks, "event_file": self.event_file,
+                   "chunks": {str(ichunk): chunk for ichunk, chunk in self.chunks.items()}}
+        tmpfile = "{}.tmp{}".format(self.filename, os.getpid())
+        with open(tmpfile, "w") as fout:
+            json.dump(content, fout, indent=2)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmpfile, self.filename)
+
+    def IsDone(self, ichunk):
+        return ichunk in self.chunks
+
+    def MarkDone(self, ichunk, worker):
+        with self.lock:
+            self.chunks[ichunk] = {"name": worker.name, "workdir": worker.workdir}
+            self.Save()
+
+    def GetDoneWorkers(self):
+        return [Worker(chunk["name"], chunk["workdir"], None, None, ichunk=ichunk) for ichunk, chunk in sorted(self.chunks.items())]
+
+    def Remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
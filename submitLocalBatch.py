@@ -16,8 +16,12 @@ from alifastsim import GeneratePowhegInput as alipowhegtools
 from alifastsim import Tools as alisimtools
 from alifastsim import cernbatchtools as alicernsub
 from alifastsim import nerscbatchtools as alinerscsub
+from alifastsim import localbatchtools as alilocalsub
 from alifastsim import simtask as alisimtask
 from alifastsim import PackageTools as alipackagetools
+import job_ledger
+import powheg_history
+import powheg_stages
 
 repo = os.path.abspath(os.path.dirname(sys.argv[0]))
 
@@ -29,41 +33,122 @@ class submit_exception(Exception):
     def __str__(self):
         return "Submitting job failed..."
 
-def get_batchtools():
+def get_batchtools(batchconfig):
+    with open(batchconfig, "r") as breader:
+        bcdata = yaml.load(breader, yaml.SafeLoader)
+    if "backend" in bcdata and bcdata["backend"] == "local":
+        return alilocalsub.localbatchtools(batchconfig)
     if alinerscsub.is_nersc_system():
         return alinerscsub.nerscbatchtools()
     return alicernsub.cernbatchtools()
 
+def CreateSimTask(LocalDest, ExeFile, Events, yamlFileName, PowhegStage=0):
+    simtask_optionals = {"--numevents": "{Events}".format(Events=Events)}
+    if PowhegStage:
+        simtask_optionals["--powheg-stage"] = "{PowhegStage}".format(PowhegStage=PowhegStage)
+    simtask_optionals["--batch-job"] = "lbnl3"
+    simtask_defaults = ["{LocalDest}/{yamlFileName}".format(LocalDest=LocalDest, yamlFileName=os.path.basename(yamlFileName))]
+    return alisimtask.simtask("{LocalDest}/{ExeFile}".format(LocalDest=LocalDest, ExeFile=ExeFile), simtask_defaults, simtask_optionals, "--job-number")
+
+def GetJobTemplates(PowhegStage=0, XGridIter=1):
+    """Names of the job script and of the log file of the jobs (RANK is replaced by the job number)."""
+    if not PowhegStage:
+        return "RunJob_RANK.sh", "JobOutput_RANK.log"
+    if PowhegStage == 1:
+        return "RunJob_Stage_{}_XGridIter_{}_RANK.sh".format(PowhegStage, XGridIter), "JobOutput_Stage_{}_XGridIter_{}_RANK.log".format(PowhegStage, XGridIter)
+    return "RunJob_{}_RANK.sh".format(PowhegStage), "JobOutput_Stage_{}_RANK.log".format(PowhegStage)
+
 def SubmitParallel(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript):
-    batchtools = get_batchtools()
-    JobRunscriptTemplate = "RunJob_RANK.sh"
-    JobLogfileTemplate = "JobOutput_RANK.log"
+    batchtools = get_batchtools(batchconfig)
+    JobRunscriptTemplate, JobLogfileTemplate = GetJobTemplates()
+    mysimtask = CreateSimTask(LocalDest, ExeFile, Events, yamlFileName)
+    return batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, envscript, batchconfig, Jobs, 0)
 
-    simtask_optionals = {"--numevents": "{Events}".format(Events=Events), "--batch-job": "lbnl3"}
-    simtask_defaults = ["{LocalDest}/{yamlFileName}".format(LocalDest=LocalDest, yamlFileName=os.path.basename(yamlFileName))]
-    mysimtask = alisimtask.simtask("{LocalDest}/{ExeFile}".format(LocalDest=LocalDest, ExeFile=ExeFile), simtask_defaults, simtask_optionals, "--job-number")
-    batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, envscript, batchconfig, Jobs, 0)
+def GetPowhegStageJobs(Jobs):
+    return {1: 10, 2: 20, 3: 10, 4: Jobs} # Dictionary in stage:jobs
 
-def SubmitParallelPowheg(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript, PowhegStage, XGridIter):
-    batchtools = get_batchtools()
-    input_file_name = alipowhegtools.GetParallelInputFileName(PowhegStage, XGridIter)
-    shutil.copy("{}/{}".format(LocalDest, input_file_name), "{}/powheg.input".format(LocalDest))
-    njobconfigStage = {1: 10, 2: 20, 3: 10, 4: Jobs} # Dictionary in stage:jobs
+def SubmitParallelPowheg(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript, PowhegStage, XGridIter, dependency=None, copy_input=True):
+    batchtools = get_batchtools(batchconfig)
+    if copy_input:
+        input_file_name = alipowhegtools.GetParallelInputFileName(PowhegStage, XGridIter)
+        shutil.copy("{}/{}".format(LocalDest, input_file_name), "{}/powheg.input".format(LocalDest))
+    njobconfigStage = GetPowhegStageJobs(Jobs)
 
-    simtask_optionals = {"--numevents": "{Events}".format(Events=Events), "--powheg-stage": "{PowhegStage}".format(PowhegStage=PowhegStage), "--batch-job": "lbnl3"}
-    simtask_defaults = ["{LocalDest}/{yamlFileName}".format(LocalDest=LocalDest, yamlFileName=os.path.basename(yamlFileName))]
-    mysimtask = alisimtask.simtask("{LocalDest}/{ExeFile}".format(LocalDest=LocalDest, ExeFile=ExeFile), simtask_defaults, simtask_optionals, "--job-number")
-    JobRunscriptTemplate = ""
-    JobLogfileTemplate = ""
-    if PowhegStage == 1:
-        JobRunscriptTemplate = "RunJob_Stage_{}_XGridIter_{}_RANK.sh".format(PowhegStage, XGridIter)
-        JobLogfileTemplate = "JobOutput_Stage_{}_XGridIter_{}_RANK.log".format(PowhegStage, XGridIter)
-    else:
-        JobRunscriptTemplate = "RunJob_{}_RANK.sh".format(PowhegStage)
-        JobLogfileTemplate = "JobOutput_Stage_{}_RANK.log".format(PowhegStage)
-    batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, envscript, batchconfig, njobconfigStage[PowhegStage], 1)
+    mysimtask = CreateSimTask(LocalDest, ExeFile, Events, yamlFileName, PowhegStage)
+    JobRunscriptTemplate, JobLogfileTemplate = GetJobTemplates(PowhegStage, XGridIter)
+    return batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, envscript, batchconfig, njobconfigStage[PowhegStage], 1, dependency)
+
+def SubmitPowhegStagePreparation(LocalDest, batchconfig, envscript, PowhegStage, XGridIter, CheckStage, CheckXGridIter, CheckJobs, dependency):
+    """Submits the job which checks the outputs of the previous stage and installs the input of the next one."""
+    batchtools = get_batchtools(batchconfig)
+    simtask_optionals = {"--stage": "{}".format(PowhegStage), "--xgrid-iter": "{}".format(XGridIter), "--check-stage": "{}".format(CheckStage),
+                         "--check-xgrid-iter": "{}".format(CheckXGridIter), "--check-jobs": "{}".format(CheckJobs)}
+    mysimtask = alisimtask.simtask("{}/powheg_stages.py".format(repo), [LocalDest], simtask_optionals, None)
+    JobRunscriptTemplate = "RunJob_Prepare_Stage_{}_XGridIter_{}_RANK.sh".format(PowhegStage, XGridIter)
+    JobLogfileTemplate = "JobOutput_Prepare_Stage_{}_XGridIter_{}_RANK.log".format(PowhegStage, XGridIter)
+    # Job number 0: no POWHEG job has this number, the clean-up of the job script does not touch their files.
+    # A single serial job, not an MPI allocation of whole nodes
+    return batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, envscript, batchconfig, 1, 0, dependency, serial=True)
+
+def SubmitPowhegPipeline(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript):
+    """Submits all the POWHEG stages (x-grid iterations of stage 1, stages 2 and 3, and
+    the event generation and simulation of stage 4) at once, each stage depending on
+    a job checking the outputs of the previous one."""
+    njobconfigStage = GetPowhegStageJobs(Jobs)
+    dependency = None
+    previous = None
+    for PowhegStage, XGridIter in powheg_stages.GetStageSteps():
+        if previous:
+            PreviousStage, PreviousXGridIter = previous
+            dependency = SubmitPowhegStagePreparation(LocalDest, batchconfig, envscript, PowhegStage, XGridIter,
+                                                      PreviousStage, PreviousXGridIter, njobconfigStage[PreviousStage], dependency)
+            logging.info("Stage %d (x-grid iteration %d) prepared by batch job(s) %s", PowhegStage, XGridIter, " ".join(dependency))
+        dependency = SubmitParallelPowheg(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript, PowhegStage, XGridIter, dependency, previous is None)
+        logging.info("Stage %d (x-grid iteration %d) submitted as batch job(s) %s", PowhegStage, XGridIter, " ".join(dependency))
+        previous = (PowhegStage, XGridIter)
+    return dependency
+
+def GetJobRanges(JobNumbers):
+    """Ranges of consecutive job numbers, as (first job, number of jobs)."""
+    ranges = []
+    for job in sorted(JobNumbers):
+        if ranges and ranges[-1][0] + ranges[-1][1] == job:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append((job, 1))
+    return ranges
 
-def SubmitProcessingJobs(TrainName, LocalPath, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, copy_files, PowhegStage, XGridIter, HerwigTune):
+def ResubmitJobs(Train, JobNumbers):
+    """Submits again jobs of a train recorded in the job ledger (Train: its parameters in the
+    ledger). Returns the batch job ID of each job."""
+    LocalDest = Train["local_dest"]
+    batchtools = get_batchtools(Train["batch_config"])
+    if Train["powheg_stage"]:
+        shutil.copy("{}/{}".format(LocalDest, alipowhegtools.GetParallelInputFileName(Train["powheg_stage"], 1)), "{}/powheg.input".format(LocalDest))
+    mysimtask = CreateSimTask(LocalDest, Train["exe_file"], Train["events"], Train["config"], Train["powheg_stage"])
+    JobRunscriptTemplate, JobLogfileTemplate = GetJobTemplates(Train["powheg_stage"])
+    jobids = {}
+    for firstjob, njobs in GetJobRanges(JobNumbers):
+        logging.info("Resubmitting jobs %d to %d of train %s", firstjob, firstjob + njobs - 1, Train["train"])
+        submitted = batchtools.submitJobs(repo, mysimtask, LocalDest, JobRunscriptTemplate, JobLogfileTemplate, Train["envscript"], Train["batch_config"], njobs, firstjob)
+        for ijob, job in enumerate(range(firstjob, firstjob + njobs)):
+            # Job arrays and MPI jobs have one batch job ID for all the jobs
+            jobids[job] = submitted[ijob] if len(submitted) == njobs else submitted[0]
+    return jobids
+
+def RecordJobs(TrainName, LocalPath, LocalDest, ExeFile, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, envscript, PowhegStage, JobOffset, BatchJobIds, SubmitTime):
+    """Records the simulation jobs of the train in the job ledger of LocalPath."""
+    Train = {"gen": Gen, "proc": Proc, "local_dest": os.path.abspath(LocalDest), "exe_file": ExeFile, "events": Events,
+             "config": os.path.basename(yamlFileName), "batch_config": os.path.abspath(batchconfig), "envscript": envscript,
+             "powheg_stage": PowhegStage, "log_template": GetJobTemplates(PowhegStage)[1]}
+    jobids = {}
+    for ijob, job in enumerate(range(JobOffset, Jobs + JobOffset)):
+        # Job arrays and MPI jobs have one batch job ID for all the jobs
+        jobids[job] = BatchJobIds[ijob] if len(BatchJobIds) == Jobs else BatchJobIds[0]
+    with job_ledger.OpenLedger(LocalPath) as ledger:
+        job_ledger.RecordSubmission(ledger, TrainName, Train, jobids, SubmitTime)
+
+def SubmitProcessingJobs(TrainName, LocalPath, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, copy_files, PowhegStage, XGridIter, HerwigTune, StageMode="link", PowhegSeedsPerJob=1, PowhegBuffer=None, PowhegPipeline=False):
     logging.info("Submitting processing jobs for train {0}".format(TrainName))
 
     ExeFile = "runFastSim.py"
@@ -81,9 +166,11 @@ def SubmitProcessingJobs(TrainName, LocalPath, Events, Jobs, Gen, Proc, yamlFile
         FilesToDelete = []
         FilesToCopy["%s/%s" %(repo, yamlFileName)] = "%s/%s" %(LocalDest, os.path.basename(yamlFileName))
         FilesToCopy["%s/%s" %(repo, ExeFile)] = "%s/%s" %(LocalDest, ExeFile)
+        # Imported by runFastSim.py from the train directory
+        FilesToCopy["%s/alifastsim/staging.py" %repo] = "%s/staging.py" %LocalDest
         Sourcefiles = ["OnTheFlySimulationGenerator.cxx", "OnTheFlySimulationGenerator.h",
-                        "runJetSimulation.C", "start_simulation.C",
-                        "lhapdf_utils.py",
+                        "runJetSimulation.C", "start_simulation.C", "compile_simulation.C",
+                        "lhapdf_utils.py", "alienv_utils.py", "file_lock.py", "build_cache.py", "event_index.py", "lhe_utils.py", "hepmc_utils.py", "herwig_utils.py", "job_metrics.py", "sim_workers.py", "powheg_history.py", "log_capture.py",
                         "Makefile", "HepMC.tar",
                         "THepMCParser_dev.h", "THepMCParser_dev.cxx",
                         "AliGenExtFile_dev.h", "AliGenExtFile_dev.cxx",
@@ -97,16 +184,16 @@ def SubmitProcessingJobs(TrainName, LocalPath, Events, Jobs, Gen, Proc, yamlFile
         if "pythia8" in Gen:
             Sourcefiles.append("powheg_pythia8_conf.cmnd")
         if "powheg" in Gen:
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 1)
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 2)
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 3)
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 2)
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 3)
-            alipowhegtools.main(yamlFileName, LocalDest, Events, 4)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 1, PowhegBuffer)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 2, PowhegBuffer)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 1, 3, PowhegBuffer)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 2, powheg_buffer=PowhegBuffer)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 3, powheg_buffer=PowhegBuffer)
+            alipowhegtools.main(yamlFileName, LocalDest, Events, 4, powheg_buffer=PowhegBuffer)
             with open("{}/pwgseeds.dat".format(LocalDest), "w") as myfile:
-                if Jobs > 20:
-                    nseeds = Jobs
-                else:
+                # Jobs running several POWHEG processes at stage 4 use several seeds each
+                nseeds = alipowhegtools.GetNumberOfSeeds(Jobs, PowhegSeedsPerJob)
+                if nseeds < 20:
                     nseeds = 20
                 for iseed in range(1, nseeds + 1):
                     rnd = random.randint(0, 1073741824)  # 2^30
@@ -121,22 +208,31 @@ def SubmitProcessingJobs(TrainName, LocalPath, Events, Jobs, Gen, Proc, yamlFile
         for f in Sourcefiles:
             FilesToCopy["%s/%s" %(repo, f)] = "%s/%s" %(LocalDest, f)
 
-        alisimtools.copy_to_workdir(FilesToCopy)
+        alisimtools.copy_to_workdir(FilesToCopy, StageMode)
 
         logging.info("Compiling analysis code...")
-        get_batchtools().run_build(repo, LocalDest, envscript)
+        get_batchtools(batchconfig).run_build(repo, LocalDest, envscript)
         for file in FilesToDelete: 
             os.remove(file)
 
-    if "powheg" in Gen:
-        SubmitParallelPowheg(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript, PowhegStage, XGridIter)
+    # The local backend runs the jobs before returning
+    SubmitTime = time.time()
+    if "powheg" in Gen and PowhegPipeline:
+        BatchJobIds = SubmitPowhegPipeline(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript)
+        RecordJobs(TrainName, LocalPath, LocalDest, ExeFile, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, envscript, 4, 1, BatchJobIds, SubmitTime)
+    elif "powheg" in Gen:
+        BatchJobIds = SubmitParallelPowheg(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript, PowhegStage, XGridIter)
+        # The jobs of the stages 1 to 3 do not simulate events
+        if PowhegStage == 4:
+            RecordJobs(TrainName, LocalPath, LocalDest, ExeFile, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, envscript, 4, 1, BatchJobIds, SubmitTime)
     else:
-        SubmitParallel(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript)
+        BatchJobIds = SubmitParallel(LocalDest, ExeFile, Events, Jobs, yamlFileName, batchconfig, envscript)
+        RecordJobs(TrainName, LocalPath, LocalDest, ExeFile, Events, Jobs, Gen, Proc, yamlFileName, batchconfig, envscript, 0, 0, BatchJobIds, SubmitTime)
 
 
     logging.info("Done.")
 
-def main(UserConf, yamlFileName, batchconfig, continue_powheg, powheg_stage, XGridIter):
+def main(UserConf, yamlFileName, batchconfig, continue_powheg, powheg_stage, XGridIter, powheg_pipeline=False):
     f = open(yamlFileName, 'r')
     config = yaml.load(f, yaml.SafeLoader)
     f.close()
@@ -146,9 +242,21 @@ def main(UserConf, yamlFileName, batchconfig, continue_powheg, powheg_stage, XGr
     HerwigTune = None
     if "herwig_config" in config and "tune" in config["herwig_config"]:
         HerwigTune = config["herwig_config"]["tune"]
+    StageMode = "link"
+    if "stage_mode" in config:
+        StageMode = config["stage_mode"]
+    PowhegSeedsPerJob = alipowhegtools.GetSeedsPerJob(config)
 
     LocalPath = UserConf["local_path"]
     logging.info("Local working directory: %s", LocalPath)
+    # Without a fixed powheg_buffer, the buffer is derived from the LHE events consumed by the jobs of previous trains
+    PowhegBuffer = None
+    if "powheg" in Gen and not "powheg_buffer" in config:
+        PowhegBuffer = powheg_history.GetPowhegBuffer(config, LocalPath)
+        if PowhegBuffer is None:
+            logging.info("Not enough POWHEG jobs with this configuration in %s, using the default POWHEG buffer", LocalPath)
+        else:
+            logging.info("POWHEG buffer derived from the previous trains: %s", PowhegBuffer)
     if not continue_powheg:
         unixTS = int(time.time())
         copy_files = True
@@ -159,7 +267,7 @@ def main(UserConf, yamlFileName, batchconfig, continue_powheg, powheg_stage, XGr
         logging.info("Continue job with timestamp {0}".format(unixTS))
     TrainName = "FastSim_{0}_{1}_{2}".format(Gen, Proc, unixTS)
     try:
-        SubmitProcessingJobs(TrainName, LocalPath, config["numevents"], config["numbjobs"], Gen, Proc, yamlFileName, batchconfig, copy_files, powheg_stage, XGridIter, HerwigTune)
+        SubmitProcessingJobs(TrainName, LocalPath, config["numevents"], config["numbjobs"], Gen, Proc, yamlFileName, batchconfig, copy_files, powheg_stage, XGridIter, HerwigTune, StageMode, PowhegSeedsPerJob, PowhegBuffer, powheg_pipeline)
     except submit_exception as e:
         logging.error("%s", e)
 
@@ -172,6 +280,7 @@ if __name__ == '__main__':
     parser.add_argument('--continue-powheg', metavar='timestamp', default=None)
     parser.add_argument('--powheg-stage', type=int)
     parser.add_argument('--xgrid-iter', default=1, type=int)
+    parser.add_argument('--powheg-pipeline', action='store_true', help='Submit all the POWHEG stages at once, chained with batch job dependencies')
     args = parser.parse_args()
 
     loglevel=logging.INFO
@@ -185,4 +294,4 @@ if __name__ == '__main__':
 
     userConf = aliuserconfig.LoadUserConfiguration(args.user_conf)
 
-    main(userConf, args.config, args.batch_conf, args.continue_powheg, args.powheg_stage, args.xgrid_iter)
+    main(userConf, args.config, args.batch_conf, args.continue_powheg, args.powheg_stage, args.xgrid_iter, args.powheg_pipeline)
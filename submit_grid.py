@@ -28,6 +28,7 @@ from alifastsim import GenerateHerwigInput as aliherwigtools
 from alifastsim import Tools as alisimtools
 from alifastsim import GridTools as aligridtools
 from alifastsim import PackageTools as alipackagetools
+import powheg_history
 
 
 def GenerateProcessingJDL(Exe, AlienDest, Packages, ValidationScript, FilesToCopy, TTL, Events, Jobs, yamlFileName, MinPtHard, MaxPtHard, PowhegStage):
@@ -38,7 +39,7 @@ Executable = \"{dest}/{executable}\"; \n\
 TTL = \"{TTL}\"; \n\
 OutputDir = \"{dest}/output/#alien_counter_03i#\"; \n\
 Output = {{ \n\
-\"log_archive.zip:stderr,stdout,*.log@disk=1\", \n\
+\"log_archive.zip:stderr,stdout,*.log,job_metrics.json@disk=1\", \n\
 \"root_archive.zip:AnalysisResults*.root@disk=2\" \n\
 }}; \n\
 Arguments = \"{yamlFileName} --numevents {Events} --minpthard {MinPtHard} --maxpthard {MaxPtHard} --batch-job grid --job-number #alien_counter# --powheg-stage {PowhegStage}\"; \n\
@@ -196,7 +197,7 @@ def SubmitMergingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Offlin
 
     alisimtools.subprocess_call(["ls", LocalDest])
 
-def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Offline, GridUpdate, TTL, Events, Jobs, Gen, Proc, yamlFileName, PtHardList, OldPowhegInit, PowhegStage, HerwigTune, LoadPackagesSeparately):
+def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Offline, GridUpdate, TTL, Events, Jobs, Gen, Proc, yamlFileName, PtHardList, OldPowhegInit, PowhegStage, HerwigTune, LoadPackagesSeparately, PowhegSeedsPerJob=1, PowhegBuffer=None):
     logging.info("Submitting processing jobs for train {0}".format(TrainName))
 
     ValidationScript = "FastSim_validation.sh"
@@ -206,8 +207,8 @@ def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Off
     FilesToDelete = [JdlFile]
 
     FilesToCopy = [yamlFileName, "OnTheFlySimulationGenerator.cxx", "OnTheFlySimulationGenerator.h",
-                   "runJetSimulation.C", "start_simulation.C",
-                   "lhapdf_utils.py",
+                   "runJetSimulation.C", "start_simulation.C", "compile_simulation.C",
+                   "lhapdf_utils.py", "alienv_utils.py", "file_lock.py", "build_cache.py", "alifastsim/staging.py", "event_index.py", "lhe_utils.py", "hepmc_utils.py", "herwig_utils.py", "job_metrics.py", "sim_workers.py", "powheg_history.py", "log_capture.py",
                    "Makefile", "HepMC.tar",
                    "AliGenExtFile_dev.h", "AliGenExtFile_dev.cxx",
                    "AliGenReaderHepMC_dev.h", "AliGenReaderHepMC_dev.cxx",
@@ -228,10 +229,10 @@ def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Off
     if "powheg" in Gen:
         if OldPowhegInit:
             if PowhegStage == 0:
-                alipowhegtools.main(yamlFileName, "./", Events, 0)
+                alipowhegtools.main(yamlFileName, "./", Events, 0, powheg_buffer=PowhegBuffer)
                 FilesToCopy.extend(["data/{}/pwggrid.dat".format(OldPowhegInit), "data/{}/pwgubound.dat".format(OldPowhegInit)])
             elif PowhegStage == 4:
-                alipowhegtools.main(yamlFileName, "./", Events, 4)
+                alipowhegtools.main(yamlFileName, "./", Events, 4, powheg_buffer=PowhegBuffer)
                 os.rename(alipowhegtools.GetParallelInputFileName(4), "powheg.input")
                 EssentialFilesToCopy = ["pwggrid-????.dat", "pwggridinfo-btl-xg?-????.dat", "pwgubound-????.dat"]
 
@@ -242,7 +243,8 @@ def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Off
                 FilesToDelete.append(seed_file_name)
                 FilesToCopy.append(seed_file_name)
                 with open(seed_file_name, "w") as seed_file:
-                    for iseed in range(0, Jobs + 1):
+                    # Jobs running several POWHEG processes at stage 4 use several seeds each
+                    for iseed in range(0, alipowhegtools.GetNumberOfSeeds(Jobs + 1, PowhegSeedsPerJob)):
                         seed_file.write(str(random.randint(0, 1073741824)))
                         seed_file.write("\n")
             else:
@@ -253,7 +255,7 @@ def SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Off
                 logging.error("Not implemented for POWHEG stage {}".format(PowhegStage))
                 exit(1)
             else:
-                alipowhegtools.main(yamlFileName, "./", Events, 0)
+                alipowhegtools.main(yamlFileName, "./", Events, 0, powheg_buffer=PowhegBuffer)
         FilesToCopy.append("powheg.input")
         FilesToDelete.append("powheg.input")
         if not LoadPackagesSeparately:
@@ -411,6 +413,7 @@ def main(UserConf, yamlFileName, Offline, GridUpdate, OldPowhegInit, PowhegStage
         HerwigTune = config["herwig_config"]["tune"]
     else:
         HerwigTune = None
+    PowhegSeedsPerJob = alipowhegtools.GetSeedsPerJob(config)
 
     try:
         rootPath = subprocess.check_output(["which", "root"]).decode(sys.stdout.encoding).rstrip()
@@ -442,6 +445,15 @@ def main(UserConf, yamlFileName, Offline, GridUpdate, OldPowhegInit, PowhegStage
     logging.info("Local working directory: {0}".format(LocalPath))
     logging.info("Alien working directory: {0}".format(AlienPath))
 
+    # Without a fixed powheg_buffer, the buffer is derived from the LHE events consumed by the jobs of previous trains
+    PowhegBuffer = None
+    if "powheg" in Gen and not "powheg_buffer" in config:
+        PowhegBuffer = powheg_history.GetPowhegBuffer(config, LocalPath)
+        if PowhegBuffer is None:
+            logging.info("Not enough POWHEG jobs with this configuration in %s, using the default POWHEG buffer", LocalPath)
+        else:
+            logging.info("POWHEG buffer derived from the previous trains: %s", PowhegBuffer)
+
     if Merge:
         if Merge == "last":
             TrainName = GetLastTrainName(AlienPath, Gen, Proc)
@@ -462,7 +474,7 @@ def main(UserConf, yamlFileName, Offline, GridUpdate, OldPowhegInit, PowhegStage
         unixTS = int(time.time())
         logging.info("The timestamp for this job is %d. You will need it to submit merging jobs and download you final results.", unixTS)
         TrainName = "FastSim_{0}_{1}_{2}".format(Gen, Proc, unixTS)
-        SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Offline, GridUpdate, TTL, Events, Jobs, Gen, Proc, yamlFileName, PtHardList, OldPowhegInit, PowhegStage, HerwigTune, LoadPackagesSeparately)
+        SubmitProcessingJobs(TrainName, LocalPath, AlienPath, AliPhysicsVersion, Offline, GridUpdate, TTL, Events, Jobs, Gen, Proc, yamlFileName, PtHardList, OldPowhegInit, PowhegStage, HerwigTune, LoadPackagesSeparately, PowhegSeedsPerJob, PowhegBuffer)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Local final merging for LEGO train results.')